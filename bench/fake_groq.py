@@ -0,0 +1,248 @@
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+'''
+Local stand-in for the Groq (OpenAI-compatible) chat completions API, for benchmarks.
+Point the app at it with GROQ_BASE_URL=http://127.0.0.1:<port> (or Groq(base_url=...)).
+
+It answers POST /openai/v1/chat/completions after a configurable delay, produces text at a configurable
+token rate, returns JSON that fits the app's prompts when response_format is json_object, supports
+stream=True, can inject 429 and 500 errors at a given rate, can answer for some models as if they were decommissioned,
+and can break a given fraction of its JSON answers to exercise the repair calls of everglen_structured.
+'''
+class FakeGroqConfig:
+    def __init__(self, latency=0.3, tokens_per_second=500.0, completion_tokens=200, rate_limit_rate=0.0, server_error_rate=0.0, retry_after=1, decommissioned_models=(), invalid_json_rate=0.0):
+        # Seconds before the first byte of every response
+        self.latency = latency
+        # Speed at which completion tokens are "generated"
+        self.tokens_per_second = tokens_per_second
+        # Length of free-text completions
+        self.completion_tokens = completion_tokens
+        # Fractions of requests answered with 429 / 500
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.retry_after = retry_after
+        # Models answered with Groq's 400 model_decommissioned error
+        self.decommissioned_models = set(decommissioned_models)
+        # Fraction of JSON answers with a null first field, or a null value in the first item when that field is a
+        # list of objects; repair calls are always answered correctly
+        self.invalid_json_rate = invalid_json_rate
+
+class FakeGroqStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.server_errors = 0
+        self.invalid_json = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "rate_limited": self.rate_limited,
+                "server_errors": self.server_errors,
+                "invalid_json": self.invalid_json,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens
+            }
+
+FILLER_WORDS = ["Maya", "laughed", "and", "the", "hallway", "went", "quiet", "as", "Everglen", "High", "waited", "for", "someone", "to", "say", "something", "honest."]
+
+def filler_text(tokens):
+    return " ".join(random.choice(FILLER_WORDS) for _ in range(tokens))
+
+def json_reply(system_prompt):
+    # Picks a reply matching the JSON schema described in the system prompt
+    if "\"scenes\"" in system_prompt:
+        return {"title": "The Quiet Hallway", "characters": ["Maya"], "plot": filler_text(40), "scenes": [{"title": f"Scene {number}", "summary": filler_text(30)} for number in range(1, 4)]}
+    if "\"plot_holes\"" in system_prompt:
+        return {"plot_holes": [filler_text(15)]}
+    if "\"facts\"" in system_prompt:
+        return {"facts": [filler_text(10) for _ in range(5)]}
+    if "\"characters\"" in system_prompt and "\"plot\"" in system_prompt:
+        return {"title": "The Quiet Hallway", "characters": ["Maya"], "plot": filler_text(40)}
+    if "\"characters\"" in system_prompt:
+        return {"characters": [{"name": "Maya", "high_school_clique": "drama club", "personality": "bold, anxious", "age": 16, "gender": "female", "current_job": "barista", "additional_desc": "human"}]}
+    if "\"summary\"" in system_prompt:
+        return {"summary": filler_text(40), "character_states": {"Maya": "nervous"}, "open_threads": [filler_text(8)]}
+    return {"text": filler_text(20)}
+
+def repair_reply(system_prompt):
+    # Repair calls carry the JSON schema of the whole answer, or of its broken parts keyed by path ("characters.0");
+    # the $defs tell the answers apart, and a part that is a list item gets the first item of the list
+    if "\"Scene\"" in system_prompt:
+        reply = json_reply("\"scenes\"")
+    elif "\"Character\"" in system_prompt:
+        reply = json_reply("\"characters\"")
+    else:
+        reply = json_reply(system_prompt)
+    if not system_prompt.startswith("You fix the parts"):
+        return reply
+    parts = {}
+    for path in json.loads(system_prompt.split("\n", 1)[1]).get("required", []):
+        field, _, index = path.partition(".")
+        value = reply.get(field)
+        parts[path] = value[0] if index and isinstance(value, list) and value else value
+    return parts
+
+def estimate_prompt_tokens(messages):
+    return sum(len(str(message.get("content", ""))) for message in messages) // 4
+
+def make_handler(config, stats):
+    class FakeGroqHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not self.path.endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": "Unknown path " + self.path, "type": "invalid_request_error"}})
+                return
+            stats.add(requests=1)
+            if body.get("model") in config.decommissioned_models:
+                self.send_json(400, {"error": {"message": f"The model `{body['model']}` has been decommissioned", "type": "invalid_request_error", "code": "model_decommissioned"}})
+                return
+            time.sleep(config.latency)
+
+            roll = random.random()
+            if roll < config.rate_limit_rate:
+                stats.add(rate_limited=1)
+                self.send_json(429, {"error": {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded"}}, {"retry-after": str(config.retry_after)})
+                return
+            if roll < config.rate_limit_rate + config.server_error_rate:
+                stats.add(server_errors=1)
+                self.send_json(500, {"error": {"message": "Internal server error", "type": "internal_server_error"}})
+                return
+
+            messages = body.get("messages", [])
+            system_prompt = messages[0]["content"] if messages else ""
+            if (body.get("response_format") or {}).get("type") == "json_object":
+                if system_prompt.startswith("You fix"):
+                    reply = repair_reply(system_prompt)
+                elif random.random() < config.invalid_json_rate:
+                    reply = json_reply(system_prompt)
+                    stats.add(invalid_json=1)
+                    broken = next(iter(reply))
+                    if isinstance(reply[broken], list) and reply[broken] and isinstance(reply[broken][0], dict):
+                        reply[broken][0][next(iter(reply[broken][0]))] = None
+                    else:
+                        reply[broken] = None
+                else:
+                    reply = json_reply(system_prompt)
+                text = json.dumps(reply)
+            else:
+                text = filler_text(min(config.completion_tokens, body.get("max_tokens") or config.completion_tokens))
+            words = text.split(" ")
+            prompt_tokens = estimate_prompt_tokens(messages)
+            stats.add(prompt_tokens=prompt_tokens, completion_tokens=len(words))
+            model = body.get("model", "fake-model")
+            completion_id = "chatcmpl-" + uuid.uuid4().hex
+
+            if body.get("stream"):
+                self.stream(completion_id, model, words, prompt_tokens)
+                return
+
+            time.sleep(len(words) / config.tokens_per_second)
+            self.send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop", "logprobs": None}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+            })
+
+        def stream(self, completion_id, model, words, prompt_tokens):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for index, word in enumerate(words):
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": word if index == 0 else " " + word}, "finish_reason": None, "logprobs": None}]
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf8"))
+                self.wfile.flush()
+                time.sleep(1 / config.tokens_per_second)
+            # Groq sends the usage of a stream with its last chunk, under x_groq
+            last = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop", "logprobs": None}],
+                "x_groq": {"id": completion_id, "error": None, "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}}
+            }
+            self.wfile.write(f"data: {json.dumps(last)}\n\n".encode("utf8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+    return FakeGroqHandler
+
+class FakeGroqServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections when hundreds of calls start at once
+    request_queue_size = 1024
+
+def start_fake_groq(config, host="127.0.0.1", port=0):
+    # Starts the server on a background thread and returns (server, stats); server.server_address has the port
+    stats = FakeGroqStats()
+    server = FakeGroqServer((host, port), make_handler(config, stats))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-groq", daemon=True).start()
+    return server, stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Groq chat completions server for benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds before the first byte")
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--completion-tokens", type=int, default=200, help="length of free-text completions")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry-after seconds sent with 429s")
+    parser.add_argument("--decommissioned-models", default="", help="comma-separated models answered as decommissioned")
+    parser.add_argument("--invalid-json-rate", type=float, default=0.0, help="fraction of JSON answers that do not match their schema")
+    args = parser.parse_args()
+
+    config = FakeGroqConfig(args.latency, args.tokens_per_second, args.completion_tokens, args.rate_limit_rate, args.server_error_rate, args.retry_after,
+        [model for model in args.decommissioned_models.split(",") if model], args.invalid_json_rate)
+    server, stats = start_fake_groq(config, args.host, args.port)
+    print(f"Fake Groq listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(json.dumps(stats.as_dict()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+'''
+Load-test benchmark for the Flask app that spends no Groq quota.
+
+By default this starts bench/fake_groq.py and the app itself (on a separate bench database and LLM cache)
+in this process, then runs each scenario at a fixed concurrency and reports throughput and
+p50/p95/p99 latency. Use --app-url to drive an app that is already running instead; it should have
+GROQ_BASE_URL pointing at a fake_groq.py server.
+
+Examples:
+    python bench/run_bench.py
+    python bench/run_bench.py --scenarios generate,scan --requests 200 --concurrency 32 --fake-latency 0.5
+    python bench/run_bench.py --rate-limit-rate 0.1 --max-p95 generate=5000 --json bench_output.json
+'''
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_groq import FakeGroqConfig, start_fake_groq
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["generate", "save", "save_imported", "scan", "series_list"]
+
+STORY_TEXT = (
+    "Maya walked into Everglen High ten minutes late, holding two coffees and a secret. "
+    "Jonah was already at her locker, pretending not to wait for her.\n\n"
+    "By lunch, the whole drama club knew about the audition, and Maya knew that Jonah knew."
+)
+
+def form_encode(data, prefix=None):
+    # Same nested foo[bar][baz] encoding the UI sends, which byteNonsense decodes
+    pairs = []
+    for key, value in data.items():
+        name = f"{prefix}[{key}]" if prefix else key
+        if isinstance(value, dict):
+            pairs.extend(form_encode(value, name))
+        else:
+            pairs.append((name, str(value)))
+    return pairs
+
+class AppClient:
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(form_encode(data)).encode("utf8") if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        # The app reads the raw body, so it must not be sent as a form
+        request.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def post_json(self, path, data):
+        status, body = self.request("POST", path, data)
+        if status != 200:
+            raise RuntimeError(f"{path} returned {status}: {body[:200]!r}")
+        return json.loads(body)
+
+def seed(client):
+    # One series and a small cast with relationships for the scenarios to use
+    series = client.post_json("/api/series/add", {"series_name": "Benchmark " + uuid.uuid4().hex[:6], "series_desc": "Created by bench/run_bench.py"})
+    character_ids = []
+    for name, age, gender in [("Maya", 16, "female"), ("Jonah", 17, "male"), ("Priya", 16, "female")]:
+        character = client.post_json("/api/characters/add", {
+            "name": name, "age": age, "gender": gender, "personality": "curious, guarded",
+            "high_school_clique": "drama club", "current_job": "barista", "additional_desc": "human",
+            "cultural_background": "Everglen, NY"
+        })
+        character_ids.append(character["character_id"])
+    client.post_json("/api/relationships/add", {"relation_subject": character_ids[0], "relation_object": character_ids[1], "relation": "best friends"})
+    client.post_json("/api/relationships/add", {"relation_subject": character_ids[1], "relation_object": character_ids[2], "relation": "rivals"})
+    return {"series_id": series["series_id"], "character_ids": character_ids}
+
+def make_request(scenario, world, unique_prompts):
+    # Returns (method, path, data) for one request of the scenario
+    nonce = f" ({uuid.uuid4().hex[:8]})" if unique_prompts else ""
+    characters = {str(index): {"id": character_id} for index, character_id in enumerate(world["character_ids"])}
+    series = {"id": world["series_id"]}
+    if scenario == "generate":
+        return "POST", "/api/stories/generate", {"location": "Everglen, NY", "summary": "Maya auditions for the spring musical" + nonce, "series": series, "characters": characters}
+    if scenario == "save":
+        return "POST", "/api/stories/save", {
+            "story_origin": "generated_from_plot", "series": series, "characters": characters,
+            "story_title": "The Audition", "plot": "Maya auditions.", "location": "Everglen, NY", "full_story": STORY_TEXT + nonce
+        }
+    if scenario == "save_imported":
+        return "POST", "/api/stories/save", {
+            "story_origin": "imported", "series": series, "characters": characters,
+            "story_title": "The Audition", "full_story": STORY_TEXT + nonce
+        }
+    if scenario == "scan":
+        return "POST", "/api/characters/scan", {"story": STORY_TEXT + nonce}
+    if scenario == "series_list":
+        return "GET", "/api/series/list", None
+    raise ValueError("Unknown scenario " + scenario)
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def run_scenario(client, scenario, world, requests, concurrency, unique_prompts):
+    latencies = []
+    errors = {}
+    lock = threading.Lock()
+
+    def one_request(_):
+        method, path, data = make_request(scenario, world, unique_prompts)
+        started = time.perf_counter()
+        try:
+            status, _ = client.request(method, path, data)
+        except Exception as e:
+            status = type(e).__name__
+        latency = time.perf_counter() - started
+        with lock:
+            latencies.append(latency)
+            if status != 200:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "throughput_rps": requests / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0
+    }
+
+def start_app(fake_groq_url, respect_rate_limits):
+    # Imports the app with its database, LLM cache and Groq endpoint pointed away from the real ones.
+    # Everything it writes goes in one temporary folder, the database's -wal and -shm files included
+    bench_dir = tempfile.mkdtemp(prefix="everglen-bench-")
+    os.environ["GROQ_BASE_URL"] = fake_groq_url
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+    # Absolute, or Flask-SQLAlchemy would put it in the repository's instance folder
+    os.environ["EVERGLEN_DB_NAME"] = os.path.join(bench_dir, "bench.db")
+    os.environ["LLM_CACHE_PATH"] = os.path.join(bench_dir, "llm_cache.db")
+    os.environ.setdefault("PLOT_HOLE_ANALYSIS_ON_SAVE", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if not respect_rate_limits:
+        os.environ["GROQ_REQUESTS_PER_MINUTE"] = "1000000"
+        os.environ["GROQ_TOKENS_PER_MINUTE"] = "1000000000"
+    sys.path.insert(0, REPO_ROOT)
+    from werkzeug.serving import make_server
+    from everglen_web import app
+
+    # Werkzeug logs every request at INFO, which would drown out the report
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="everglen-bench-app", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", bench_dir
+
+def print_report(results, fake_stats):
+    header = f"{'scenario':<15}{'requests':>9}{'conc':>6}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(f"{result['scenario']:<15}{result['requests']:>9}{result['concurrency']:>6}{sum(result['errors'].values()):>8}"
+              f"{result['throughput_rps']:>9.1f}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['max_ms']:>10.1f}")
+    if fake_stats is not None:
+        print("fake groq: " + json.dumps(fake_stats))
+
+def parse_thresholds(values):
+    thresholds = {}
+    for value in values or []:
+        scenario, milliseconds = value.split("=")
+        thresholds[scenario] = float(milliseconds)
+    return thresholds
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Everglen Flask app against a fake Groq server.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--app-url", help="benchmark an already running app instead of starting one")
+    parser.add_argument("--cached-prompts", action="store_true", help="repeat identical prompts so the LLM cache can answer them")
+    parser.add_argument("--respect-rate-limits", action="store_true", help="keep the app's Groq rate limiter at its configured budget")
+    parser.add_argument("--fake-latency", type=float, default=0.3)
+    parser.add_argument("--fake-tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--fake-completion-tokens", type=int, default=200)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of fake Groq responses that are 429s")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="fraction of fake Groq responses that are 500s")
+    parser.add_argument("--max-p95", action="append", metavar="SCENARIO=MS", help="fail (exit 1) when a scenario's p95 is above MS")
+    parser.add_argument("--json", dest="json_path", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    fake_stats = None
+    bench_dir = None
+    if args.app_url:
+        app_url = args.app_url
+    else:
+        config = FakeGroqConfig(args.fake_latency, args.fake_tokens_per_second, args.fake_completion_tokens, args.rate_limit_rate, args.server_error_rate)
+        fake_server, fake_stats = start_fake_groq(config)
+        app_url, bench_dir = start_app(f"http://127.0.0.1:{fake_server.server_address[1]}", args.respect_rate_limits)
+
+    client = AppClient(app_url, args.timeout)
+    world = seed(client)
+    results = []
+    try:
+        for scenario in [name.strip() for name in args.scenarios.split(",") if name.strip()]:
+            results.append(run_scenario(client, scenario, world, args.requests, args.concurrency, not args.cached_prompts))
+    finally:
+        if bench_dir is not None:
+            shutil.rmtree(bench_dir, ignore_errors=True)
+
+    print_report(results, fake_stats.as_dict() if fake_stats is not None else None)
+    if args.json_path:
+        with open(args.json_path, "w") as output:
+            json.dump({"results": results, "fake_groq": fake_stats.as_dict() if fake_stats is not None else None}, output, indent=4)
+
+    failed = False
+    for scenario, limit in parse_thresholds(args.max_p95).items():
+        for result in results:
+            if result["scenario"] == scenario and result["p95_ms"] > limit:
+                print(f"FAIL: {scenario} p95 {result['p95_ms']:.1f} ms is above {limit:.1f} ms")
+                failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+from everglen_web import db
+from everglen_models import StoryDB, EpisodeAnalysisDB, EpisodeFacts, EpisodePlotHoles
+from everglen_llm import PRIORITY_BACKGROUND
+from everglen_structured import structured_completion
+from everglen_bible import series_lock
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+import os
+'''
+Incremental plot-hole analysis for a series.
+
+Map: every episode is reduced once to a short digest of the facts it establishes.
+Check: every episode is checked only against the accumulated digest of the episodes before it,
+never against the full text of the whole series.
+Both results are stored per episode with the hashes they were made from, and so is the accumulated
+digest after each episode (consolidated or not), so re-running the analysis after a save only calls Groq
+for the episodes whose text, or whose earlier context, actually changed. The stored digests do not depend
+on the LLM cache: a consolidation is only redone when the facts it was made from change.
+'''
+ANALYSIS_WORKERS = int(os.getenv("PLOT_HOLE_ANALYSIS_WORKERS", "4"))
+# When the accumulated digest grows past this many characters it is consolidated into a shorter one
+DIGEST_BUDGET_CHARS = int(os.getenv("PLOT_HOLE_DIGEST_BUDGET_CHARS", "24000"))
+MAX_FACTS_PER_EPISODE = 15
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+def completion_json(output_model, messages, max_tokens):
+    return structured_completion(
+        output_model,
+        task="continuity",
+        messages=messages,
+        max_tokens=max_tokens,
+        top_p=1,
+        stream=False,
+        stop=None,
+        priority=PRIORITY_BACKGROUND,
+    )
+
+def digest_episode(story: str) -> list:
+    output = completion_json(EpisodeFacts, [
+        {
+            "role": "system",
+            "content": (
+                "You are a story analyzer. List the facts established in this episode that later episodes must stay consistent with, "
+                "such as the names, ages, jobs and relationships of characters, where things happen, what happened, and who knows what. "
+                f"Give at most {MAX_FACTS_PER_EPISODE} short facts. "
+                "Ensure that the output is in JSON format with the following schema:\n"
+                "{\n"
+                "  \"facts\": {\"type\": \"array\", \"items\": {\"type\": \"string\"}}\n"
+                "}\n"
+            )
+        },
+        {
+            "role": "user",
+            "content": f"Episode: {story}"
+        }
+    ], 512)
+    return output.facts[:MAX_FACTS_PER_EPISODE]
+
+def consolidate_facts(facts: list) -> list:
+    output = completion_json(EpisodeFacts, [
+        {
+            "role": "system",
+            "content": (
+                "You are a story analyzer. Merge the following facts about a series, listed in chronological order, into a shorter list. "
+                "When a later fact replaces an earlier one, keep only the latest state. Keep every fact a later episode could contradict. "
+                "Ensure that the output is in JSON format with the following schema:\n"
+                "{\n"
+                "  \"facts\": {\"type\": \"array\", \"items\": {\"type\": \"string\"}}\n"
+                "}\n"
+            )
+        },
+        {
+            "role": "user",
+            "content": "Facts:\n" + "\n".join(facts)
+        }
+    ], 1024)
+    return output.facts
+
+def check_episode(story: str, previous_facts: list) -> list:
+    output = completion_json(EpisodePlotHoles, [
+        {
+            "role": "system",
+            "content": (
+                "You are a story analyzer. You are given the facts established by the earlier episodes of a series, in chronological order, "
+                "followed by the next episode. Find any plot holes in the new episode, including anything that is inconsistent with the earlier facts. "
+                "Ensure that the output is in JSON format with the following schema:\n"
+                "{\n"
+                "  \"plot_holes\": {\"type\": \"array\", \"items\": {\"type\": \"string\"}}\n"
+                "}\n"
+            )
+        },
+        {
+            "role": "user",
+            "content": ("Earlier facts:\n" + "\n".join(previous_facts) if previous_facts else "This is the first episode.")
+                + f"\n\nNew episode: {story}\n\nList all plot holes in the new episode."
+        }
+    ], 1024)
+    return output.plot_holes
+
+def map_concurrently(function, items):
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(ANALYSIS_WORKERS, len(items))) as executor:
+        return list(executor.map(function, items))
+
+def analyze_series(series_id):
+    '''
+    Brings the stored analysis of every episode in the series up to date and returns the results.
+    One analysis at a time per series in this process, so two jobs do not write the same rows at once.
+    Only episodes with a changed text get a new digest, and only episodes whose text or earlier context
+    changed are checked again.
+    '''
+    with series_lock(series_id, "analysis"):
+        stories = StoryDB.query.filter_by(series_id=series_id).order_by(StoryDB.episode_number.asc()).all()
+        analyses = {
+            analysis.story_id: analysis
+            for analysis in EpisodeAnalysisDB.query.filter(EpisodeAnalysisDB.story_id.in_([story.id for story in stories])).all()
+        }
+        hashes = {story.id: content_hash(story.full_story) for story in stories}
+
+        # Map step: digests for new or edited episodes, all at once
+        stale = [story for story in stories if story.id not in analyses or analyses[story.id].content_hash != hashes[story.id]]
+        new_digests = map_concurrently(digest_episode, [story.full_story for story in stale])
+        for story, digest in zip(stale, new_digests):
+            analysis = analyses.get(story.id) or EpisodeAnalysisDB(story_id=story.id)
+            analysis.content_hash = hashes[story.id]
+            analysis.digest = json.dumps(digest)
+            analysis.context_hash = None
+            analysis.analyzed_at = datetime.utcnow()
+            analyses[story.id] = db.session.merge(analysis)
+        db.session.commit()
+
+        # Work out what each episode has to be consistent with, consolidating when the digest gets too long.
+        # An accumulated digest made from the same facts as last time is reused, consolidations included
+        contexts = []
+        accumulated = []
+        for story in stories:
+            contexts.append(accumulated)
+            analysis = analyses[story.id]
+            source_hash = content_hash(json.dumps(accumulated) + str(story.episode_number) + analysis.digest)
+            if analysis.accumulated_hash == source_hash:
+                accumulated = json.loads(analysis.accumulated_digest)
+                continue
+            accumulated = accumulated + [f"Episode {story.episode_number}: {fact}" for fact in json.loads(analysis.digest)]
+            if len(json.dumps(accumulated)) > DIGEST_BUDGET_CHARS:
+                accumulated = consolidate_facts(accumulated)
+            analysis.accumulated_digest = json.dumps(accumulated)
+            analysis.accumulated_hash = source_hash
+        db.session.commit()
+
+        # Check step: every episode whose text or context changed, all at once
+        to_check = []
+        for story, context in zip(stories, contexts):
+            context_hash = content_hash(hashes[story.id] + json.dumps(context))
+            if analyses[story.id].context_hash != context_hash:
+                to_check.append((story, context, context_hash))
+        plot_holes = map_concurrently(lambda item: check_episode(item[0].full_story, item[1]), to_check)
+        for (story, context, context_hash), episode_plot_holes in zip(to_check, plot_holes):
+            analysis = analyses[story.id]
+            analysis.context_hash = context_hash
+            analysis.plot_holes = json.dumps(episode_plot_holes)
+            analysis.analyzed_at = datetime.utcnow()
+        db.session.commit()
+
+        return {"series_id": int(series_id), "episodes_analyzed": len(to_check), "episodes": series_plot_holes(stories, analyses, hashes)}
+
+def get_series_plot_holes(series_id):
+    # Stored results only, no Groq calls
+    stories = StoryDB.query.filter_by(series_id=series_id).order_by(StoryDB.episode_number.asc()).all()
+    analyses = {
+        analysis.story_id: analysis
+        for analysis in EpisodeAnalysisDB.query.filter(EpisodeAnalysisDB.story_id.in_([story.id for story in stories])).all()
+    }
+    hashes = {story.id: content_hash(story.full_story) for story in stories}
+    return {"series_id": int(series_id), "episodes": series_plot_holes(stories, analyses, hashes)}
+
+def series_plot_holes(stories, analyses, hashes):
+    episodes = []
+    for story in stories:
+        analysis = analyses.get(story.id)
+        analyzed = analysis is not None and analysis.plot_holes is not None
+        episodes.append({
+            "story_id": story.id,
+            "episode_number": story.episode_number,
+            "story_title": story.story_title,
+            "plot_holes": json.loads(analysis.plot_holes) if analyzed else None,
+            # False when the episode changed since it was analyzed (earlier episodes changing is only seen on the next run)
+            "up_to_date": analyzed and analysis.content_hash == hashes[story.id],
+            "analyzed_at": analysis.analyzed_at.isoformat() if analysis is not None else None
+        })
+    return episodes
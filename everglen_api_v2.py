@@ -0,0 +1,312 @@
+from everglen_web import db, logger, load_cast, save_story_to_series, save_imported_story, generate_story, plot_scenes, expand_plot_to_story, story_humanizer_nonjson, GenerationError, STORY_LIST_FIELDS, STORY_LIST_DEFAULT_FIELDS
+from everglen_models import Character, Series, CharacterDB, RelationshipDB, SeriesDB, StoryDB
+from everglen_bible import bible_context
+from everglen_structured import StructuredOutputError
+from everglen_bulk import character_row, insert_rows
+from everglen_graph import relationship_graph
+from everglen_prompts import prompt_fragments
+from everglen_response_cache import cached_response
+from flask import Blueprint, Response, request
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from sqlalchemy import func
+from typing import List, Optional
+import orjson
+'''
+JSON API, version 2.
+
+Request bodies are JSON, validated straight into the Character and Series models (or the request models
+below, built the same way) by pydantic's parser, without going through byteNonsense or an intermediate dict.
+Responses are built from the selected columns of each row and encoded with orjson, so listing a large cast
+or a series with long stories skips both the ORM objects and the json module.
+
+Every field is named as in the models: a character is {"id", "name", "age", "gender", "personality", ...},
+the same record the POST and PUT routes take. Invalid bodies get a 400 listing every invalid field:
+    {"errors": [{"field": "age", "error": "Input should be a valid integer"}], "message": "INVALID_REQUEST", "status": "ERROR"}
+'''
+api_v2 = Blueprint('api_v2', __name__, url_prefix='/api/v2')
+
+'''
+Request models.
+'''
+class RelationshipRequest(BaseModel):
+    # Relationship with the two characters given by id, as stored in RelationshipDB
+    relation_subject: int
+    relation_object: int
+    relation: str
+
+class StorySaveRequest(BaseModel):
+    series_id: int
+    character_ids: List[int] = Field(default_factory=list)
+    # "generated_from_plot" keeps the title, plot and location; "imported" leaves them to the enrich_story job
+    story_origin: str
+    full_story: str
+    story_title: str = ""
+    plot: str = ""
+    location: str = ""
+
+class StoryGenerateRequest(BaseModel):
+    summary: str
+    location: str
+    series_id: Optional[int] = None
+    character_ids: List[int] = Field(default_factory=list)
+    continuity_type: str = "usual"
+
+class StoryHumanizeRequest(BaseModel):
+    original_story: str
+    character_ids: List[int] = Field(default_factory=list)
+
+# Built once, building a TypeAdapter costs more than validating a whole cast with it
+cast_request = TypeAdapter(List[Character])
+
+'''
+Helpers.
+'''
+def json_response(data, status=200):
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')
+
+def error_response(message, status, **details):
+    return json_response({**details, 'message': message, 'status': 'ERROR'}, status)
+
+def parse_body(model):
+    # The validated body, or the 400 response listing what is wrong with it; model is a pydantic model or a TypeAdapter
+    body = request.get_data()
+    try:
+        if isinstance(model, TypeAdapter):
+            return model.validate_json(body), None
+        return model.model_validate_json(body), None
+    except ValidationError as e:
+        errors = [{"field": ".".join(str(part) for part in error['loc']), "error": error['msg']} for error in e.errors()]
+        return None, error_response('INVALID_REQUEST', 400, errors=errors)
+
+# Columns of a character record, in the order they are selected; native_languages is stored as JSON text
+CHARACTER_FIELDS = {
+    'id': CharacterDB.id,
+    'name': CharacterDB.character_name,
+    'age': CharacterDB.character_age,
+    'gender': CharacterDB.character_gender,
+    'personality': CharacterDB.character_personality,
+    'high_school_clique': CharacterDB.high_school_clique,
+    'cultural_background': CharacterDB.cultural_background,
+    'native_languages': CharacterDB.native_languages,
+    'current_job': CharacterDB.current_job,
+    'outfit': CharacterDB.outfit,
+    'additional_desc': CharacterDB.additional_desc
+}
+CHARACTER_KEYS = tuple(CHARACTER_FIELDS)
+
+def character_records(query):
+    records = []
+    for row in query:
+        record = dict(zip(CHARACTER_KEYS, row))
+        if record['native_languages']:
+            try:
+                record['native_languages'] = orjson.loads(record['native_languages'])
+            except orjson.JSONDecodeError:
+                # Plain text from before the column held JSON lists is returned as it is, like v1 does
+                pass
+        records.append(record)
+    return records
+
+def relationship_record(edge):
+    return {'id': edge['relation_id'], 'relation_subject': edge['relation_subject'], 'relation_object': edge['relation_object'], 'relation': edge['relation']}
+
+def missing_characters(character_ids):
+    # The ids that are not in the database, with one query
+    character_ids = set(character_ids)
+    if not character_ids:
+        return []
+    found = {row.id for row in db.session.query(CharacterDB.id).filter(CharacterDB.id.in_(list(character_ids)))}
+    return sorted(character_ids - found)
+
+'''
+Characters.
+'''
+@api_v2.route('/characters', methods=['GET'])
+@cached_response("characters")
+def characters_list():
+    query = db.session.query(*CHARACTER_FIELDS.values()).order_by(CharacterDB.character_name.asc())
+    return json_response(character_records(query))
+
+@api_v2.route('/characters/<int:character_id>', methods=['GET'])
+@cached_response("characters", "relationships")
+def characters_view(character_id):
+    character = character_records(db.session.query(*CHARACTER_FIELDS.values()).filter(CharacterDB.id == character_id))
+    if not character:
+        return error_response('CHARACTER_NOT_FOUND', 404, character_id=character_id)
+    return json_response({
+        'character': character[0],
+        'relationships': [relationship_record(edge) for edge in relationship_graph.neighbors(character_id)]
+    })
+
+@api_v2.route('/characters', methods=['POST'])
+def characters_add():
+    # Takes one character, or an array of them that goes in with multi-row INSERTs
+    is_cast = request.get_data().lstrip()[:1] == b'['
+    characters, invalid = parse_body(cast_request if is_cast else Character)
+    if invalid:
+        return invalid
+    if not is_cast:
+        newCharacter = CharacterDB(**character_row(characters))
+        db.session.add(newCharacter)
+        db.session.commit()
+        logger.info("character added character_id=%s", newCharacter.id)
+        return json_response({'character_id': newCharacter.id, 'message': 'CHARACTER_ADDED', 'status': 'OK'})
+    character_ids = insert_rows(CharacterDB, [character_row(character) for character in characters])
+    db.session.commit()
+    logger.info("characters added count=%d", len(character_ids))
+    return json_response({'character_ids': character_ids, 'message': 'CHARACTERS_ADDED', 'status': 'OK'})
+
+@api_v2.route('/characters/<int:character_id>', methods=['PUT'])
+def characters_edit(character_id):
+    updated, invalid = parse_body(Character)
+    if invalid:
+        return invalid
+    character = CharacterDB.query.filter_by(id=character_id).first()
+    if character is None:
+        return error_response('CHARACTER_NOT_FOUND', 404, character_id=character_id)
+    for column, value in character_row(updated).items():
+        setattr(character, column, value)
+    db.session.commit()
+    prompt_fragments.invalidate("character", character.id)
+    return json_response({'character_id': character_id, 'message': 'PROFILE_UPDATED', 'status': 'OK'})
+
+'''
+Relationships.
+'''
+@api_v2.route('/relationships', methods=['POST'])
+def relationships_add():
+    relationship, invalid = parse_body(RelationshipRequest)
+    if invalid:
+        return invalid
+    missing = missing_characters([relationship.relation_subject, relationship.relation_object])
+    if missing:
+        return error_response('CHARACTER_NOT_FOUND', 404, character_ids=missing)
+    newConnection = RelationshipDB(
+        char_subject_id = relationship.relation_subject,
+        char_object_id = relationship.relation_object,
+        relation = relationship.relation
+    )
+    db.session.add(newConnection)
+    db.session.commit()
+    relationship_graph.add(newConnection.id, newConnection.char_subject_id, newConnection.char_object_id, newConnection.relation, newConnection.version)
+    return json_response({'relation_id': newConnection.id, 'message': 'CONNECTION_ADDED', 'status': 'OK'})
+
+@api_v2.route('/relationships/<int:relation_id>', methods=['PUT'])
+def relationships_edit(relation_id):
+    relationship, invalid = parse_body(RelationshipRequest)
+    if invalid:
+        return invalid
+    relationship_to_edit = RelationshipDB.query.filter_by(id=relation_id).first()
+    if relationship_to_edit is None:
+        return error_response('CONNECTION_NOT_FOUND', 404, relation_id=relation_id)
+    missing = missing_characters([relationship.relation_subject, relationship.relation_object])
+    if missing:
+        return error_response('CHARACTER_NOT_FOUND', 404, character_ids=missing)
+    relationship_to_edit.char_subject_id = relationship.relation_subject
+    relationship_to_edit.char_object_id = relationship.relation_object
+    relationship_to_edit.relation = relationship.relation
+    db.session.commit()
+    relationship_graph.update(relationship_to_edit.id, relationship_to_edit.char_subject_id, relationship_to_edit.char_object_id, relationship_to_edit.relation, relationship_to_edit.version)
+    prompt_fragments.invalidate("relationship", relationship_to_edit.id)
+    return json_response({'relation_id': relation_id, 'message': 'CONNECTION_UPDATED', 'status': 'OK'})
+
+'''
+Series and stories.
+'''
+@api_v2.route('/series', methods=['GET'])
+@cached_response("series", "stories")
+def series_list():
+    # Series with their episode counts; the stories themselves are listed per series
+    episode_counts = dict(db.session.query(StoryDB.series_id, func.count(StoryDB.id)).group_by(StoryDB.series_id).all())
+    series = db.session.query(SeriesDB.id, SeriesDB.series_name, SeriesDB.series_desc).order_by(SeriesDB.id.asc())
+    return json_response([
+        {'id': row.id, 'series_name': row.series_name, 'series_desc': row.series_desc, 'episodes': episode_counts.get(row.id, 0)}
+        for row in series
+    ])
+
+@api_v2.route('/series', methods=['POST'])
+def series_add():
+    series, invalid = parse_body(Series)
+    if invalid:
+        return invalid
+    newseries = SeriesDB(series_name = series.series_name, series_desc = series.series_desc)
+    db.session.add(newseries)
+    db.session.commit()
+    logger.info("series added series_id=%s", newseries.id)
+    return json_response({'series_id': newseries.id, 'message': 'SERIES_ADDED', 'status': 'OK'})
+
+@api_v2.route('/series/<int:series_id>/stories', methods=['GET'])
+@cached_response("series", "stories")
+def series_stories(series_id):
+    # ?fields=id,story_title,full_story picks the story fields, like /api/series/page; plot and full_story have to be asked for
+    fields = request.args.get('fields')
+    fields = list(dict.fromkeys(fields.split(','))) if fields else STORY_LIST_DEFAULT_FIELDS
+    unknown_fields = [field for field in fields if field not in STORY_LIST_FIELDS]
+    if unknown_fields:
+        return error_response('UNKNOWN_FIELDS', 400, fields=unknown_fields)
+    if db.session.query(SeriesDB.id).filter(SeriesDB.id == series_id).first() is None:
+        return error_response('SERIES_NOT_FOUND', 404, series_id=series_id)
+    stories = (
+        db.session.query(*[getattr(StoryDB, field) for field in fields])
+        .filter(StoryDB.series_id == series_id)
+        .order_by(StoryDB.episode_number.asc())
+    )
+    return json_response([dict(zip(fields, row)) for row in stories])
+
+@api_v2.route('/stories/<int:story_id>', methods=['GET'])
+@cached_response("stories")
+def stories_view(story_id):
+    fields = ['id', 'series_id'] + STORY_LIST_FIELDS[1:]
+    story = db.session.query(*[getattr(StoryDB, field) for field in fields]).filter(StoryDB.id == story_id).first()
+    if story is None:
+        return error_response('STORY_NOT_FOUND', 404, story_id=story_id)
+    return json_response(dict(zip(fields, story)))
+
+@api_v2.route('/stories', methods=['POST'])
+def stories_save():
+    story, invalid = parse_body(StorySaveRequest)
+    if invalid:
+        return invalid
+    if db.session.query(SeriesDB.id).filter(SeriesDB.id == story.series_id).first() is None:
+        return error_response('SERIES_NOT_FOUND', 404, series_id=story.series_id)
+    if story.story_origin == "imported":
+        new_story_id, job = save_imported_story(story.series_id, story.character_ids, story.story_title, story.full_story)
+        return json_response({'story_id': new_story_id, 'job_id': job.id, 'message': 'STORY_ADDED', 'status': 'OK'})
+    if story.story_origin == "generated_from_plot":
+        new_story_id = save_story_to_series(story.series_id, story.character_ids, story.story_title, story.plot, story.location, story.full_story)
+    else:
+        new_story_id = save_story_to_series(story.series_id, story.character_ids, "", "", "", story.full_story)
+    return json_response({'story_id': new_story_id, 'message': 'STORY_ADDED', 'status': 'OK'})
+
+@api_v2.route('/stories/generate', methods=['POST'])
+def stories_generate():
+    story, invalid = parse_body(StoryGenerateRequest)
+    if invalid:
+        return invalid
+    character_AI_models, character_relationships = load_cast(story.character_ids)
+    try:
+        plot = generate_story(scenario=story.summary, custom_characters=character_AI_models, location=story.location,
+            previous_story=bible_context(story.series_id), continuity_type=story.continuity_type, relationships=character_relationships or None)
+        output = expand_plot_to_story(plot.plot, scenes=plot_scenes(plot))
+        logger.info("story generated length=%d", len(output))
+        return json_response({'story_title': plot.title, 'plot': plot.plot, 'story': output})
+    except StructuredOutputError as e:
+        logger.error("story generation failed error=StructuredOutputError message=%s", e)
+        return error_response('INVALID_MODEL_OUTPUT', 502, errors=e.errors)
+    except GenerationError as e:
+        return error_response('GENERATION_FAILED', 502, error=str(e))
+    except Exception as e:
+        logger.error("story generation failed error=%s message=%s", type(e).__name__, e)
+        return error_response('GENERATION_FAILED', 500, error=str(e))
+
+@api_v2.route('/stories/humanize', methods=['POST'])
+def stories_humanize():
+    story, invalid = parse_body(StoryHumanizeRequest)
+    if invalid:
+        return invalid
+    character_AI_models, character_relationships = load_cast(story.character_ids)
+    try:
+        output = story_humanizer_nonjson(story.original_story, character_AI_models, character_relationships)
+    except GenerationError as e:
+        return error_response('HUMANIZE_FAILED', 502, error=str(e))
+    return json_response({'output': output})
@@ -0,0 +1,330 @@
+from everglen_web import app as flask_app, logger, groq_api_key, byteNonsense, load_cast, save_story, GenerationError, story_messages, plot_scenes, scene_calls, rewrite_parts, characters_scan_json, scene_messages, humanizer_messages, title_messages, extract_characters_messages, STORY_SCENE_PARALLELISM, HUMANIZE_CHUNK_TOKENS, HUMANIZE_PARALLELISM
+from everglen_llm import scheduler, estimate_tokens, CallRetries, StreamUsage, completion_routes, falls_back, completion_cache_key, cached_completion, cache_completion, cacheable, record_coalesced, shares_across_processes, lock_file_path, lock, unlock, shared_result, share_result, DEFAULT_MAX_RETRIES, MAX_RATE_LIMIT_RETRIES, PRIORITY_INTERACTIVE
+from everglen_metrics import http_latency
+from everglen_bible import bible_context
+from everglen_jobs import start_workers, stop_workers
+from everglen_structured import structured_calls, StructuredOutputError
+from everglen_models import StoryPlot, ExtractedCharacters
+from everglen_chunking import split_story, CHUNK_SEPARATOR
+from a2wsgi import WSGIMiddleware
+from groq import AsyncGroq
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+import anyio
+import asyncio
+import contextlib
+import httpx
+import os
+import time
+'''
+ASGI serving mode.
+
+The story, humanize, scan and save routes run as coroutines: Groq is called with the SDK's async client
+over one pooled HTTP connection pool, and database work runs on a small thread pool, so a single process
+can keep hundreds of generations in flight without a thread for each. Every other route is served
+by the Flask app, mounted underneath.
+
+The calls go through the same scheduler, cache, model routing and coalescing rules as chat_completion
+in everglen_llm (calls in flight are coalesced per serving mode, not between the two).
+
+    uvicorn everglen_asgi:app --host 0.0.0.0 --port 8000
+'''
+# Connections kept open to Groq; also the most calls that can be in flight at once
+ASGI_GROQ_MAX_CONNECTIONS = int(os.getenv("ASGI_GROQ_MAX_CONNECTIONS", "500"))
+# Threads for database work, and for the Flask routes mounted underneath
+ASGI_DB_THREADS = int(os.getenv("ASGI_DB_THREADS", "16"))
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "16"))
+
+# Set up by lifespan() once the event loop is running
+async_client = None
+db_limiter = None
+lock_limiter = None
+
+'''
+Async counterpart of the chat_completion gateway: the decisions are made by the helpers of everglen_llm,
+this only waits on them without blocking a thread.
+'''
+async def scheduled_create_async(priority, max_retries, task=None, rate_limit_retries=MAX_RATE_LIMIT_RETRIES, **kwargs):
+    estimated_tokens = estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens"), task)
+    retries = CallRetries(task, kwargs.get("model"), max_retries, rate_limit_retries)
+    while True:
+        await scheduler.acquire_async(estimated_tokens, priority, kwargs.get("model"))
+        started = time.perf_counter()
+        try:
+            completion = await async_client.chat.completions.create(**kwargs)
+        except Exception as e:
+            wait = retries.failed(e, started)
+            if wait is None:
+                raise
+            await asyncio.sleep(wait)
+            continue
+        retries.succeeded(kwargs.get("stream"), estimated_tokens, completion, started)
+        if kwargs.get("stream"):
+            return settled_stream_async(completion, StreamUsage(task, kwargs.get("model"), kwargs.get("messages", []), estimated_tokens))
+        return completion
+
+async def settled_stream_async(stream, usage):
+    # settled_stream in everglen_llm
+    try:
+        async for chunk in stream:
+            usage.observe(chunk)
+            yield chunk
+    finally:
+        usage.settle()
+
+class AsyncSingleFlight:
+    '''
+    Coalesces identical calls made at the same time on the event loop.
+    The call runs as its own task, so a client that disconnects does not cancel it for the others waiting on it.
+    '''
+    def __init__(self):
+        self.flights = {}
+
+    async def run(self, key, function):
+        # Returns (result, True when the result came from another caller's call)
+        flight = self.flights.get(key)
+        coalesced = flight is not None
+        if flight is None:
+            flight = asyncio.ensure_future(function())
+            self.flights[key] = flight
+            flight.add_done_callback(lambda finished: self.finish(key, finished))
+        return await asyncio.shield(flight), coalesced
+
+    def finish(self, key, flight):
+        self.flights.pop(key, None)
+        # Marks the exception as retrieved when every caller has gone away
+        if not flight.cancelled():
+            flight.exception()
+
+async_single_flight = AsyncSingleFlight()
+
+async def on_thread(function, *args, limiter=None):
+    return await anyio.to_thread.run_sync(function, *args, limiter=limiter or db_limiter)
+
+async def shared_create_async(key, create):
+    # shared_create in everglen_llm, with the lock file waited for on a thread
+    if not shares_across_processes():
+        return await create()
+    started = time.time()
+    with open(lock_file_path(key), "a") as lock_file:
+        await on_thread(lock, lock_file, limiter=lock_limiter)
+        try:
+            shared = await on_thread(shared_result, key, started)
+            if shared is not None:
+                return shared
+            completion = await create()
+            await on_thread(share_result, key, completion, lock_file)
+            return completion
+        finally:
+            unlock(lock_file)
+
+async def model_completion_async(cache, max_retries, priority, task, rate_limit_retries, cache_if=None, **kwargs):
+    # model_completion in everglen_llm
+    if kwargs.get("stream"):
+        return await scheduled_create_async(priority, max_retries, task, rate_limit_retries, **kwargs)
+
+    key = completion_cache_key(**kwargs)
+    if cache:
+        cached = await on_thread(cached_completion, key, kwargs.get("model"), cache_if)
+        if cached is not None:
+            return cached
+
+    async def create():
+        completion = await shared_create_async(key, lambda: scheduled_create_async(priority, max_retries, task, rate_limit_retries, **kwargs))
+        if cache and cacheable(completion, cache_if):
+            await on_thread(cache_completion, key, completion)
+        return completion
+
+    completion, coalesced = await async_single_flight.run(key, create)
+    if coalesced:
+        record_coalesced(key, kwargs.get("model"))
+    return completion
+
+async def chat_completion_async(cache=True, max_retries=None, priority=PRIORITY_INTERACTIVE, task=None, cache_if=None, **kwargs):
+    if max_retries is None:
+        max_retries = DEFAULT_MAX_RETRIES
+    routes = completion_routes(task, kwargs)
+    for index, (model, rate_limit_retries) in enumerate(routes):
+        try:
+            return await model_completion_async(cache, max_retries, priority, task, rate_limit_retries, cache_if, model=model, **kwargs)
+        except Exception as e:
+            if not falls_back(task, routes, index, e):
+                raise
+
+async def completion_text(**kwargs):
+    completion = await chat_completion_async(top_p=1, stream=False, stop=None, **kwargs)
+    return completion.choices[0].message.content
+
+async def structured_completion_async(output_model, **kwargs):
+    # structured_completion in everglen_structured
+    calls = structured_calls(output_model, kwargs)
+    call = next(calls)
+    while True:
+        content = (await chat_completion_async(**call)).choices[0].message.content
+        try:
+            call = calls.send(content)
+        except StopIteration as done:
+            return done.value
+
+async def in_app_context(function, *args):
+    # Runs database work on a thread, inside a Flask app context so db.session works and is cleaned up after
+    def call():
+        with flask_app.app_context():
+            return function(*args)
+    return await anyio.to_thread.run_sync(call, limiter=db_limiter)
+
+'''
+Story helpers, the async versions of the ones in everglen_web.
+'''
+async def expand_plot_to_story_async(plot, scenes):
+    parallelism = asyncio.Semaphore(STORY_SCENE_PARALLELISM)
+
+    async def expand(day, summary, story_plot):
+        async with parallelism:
+            try:
+                return await completion_text(cache=False, task="scene", messages=scene_messages(day, summary, story_plot=story_plot))
+            except Exception as e:
+                logger.error("generate_detailed_scene failed error=%s message=%s", type(e).__name__, e)
+                raise GenerationError(f"scene {day}", e) from e
+
+    return "\n\n".join(await asyncio.gather(*(expand(*call) for call in scene_calls(plot, scenes))))
+
+async def rewrite_story_async(story, custom_characters, relationships):
+    chunks = split_story(story, HUMANIZE_CHUNK_TOKENS)
+    if len(chunks) == 1:
+        return await completion_text(cache=False, task="rewrite", messages=humanizer_messages(story, custom_characters, relationships))
+
+    parallelism = asyncio.Semaphore(HUMANIZE_PARALLELISM)
+    rewritten = list(chunks)
+
+    async def rewrite(index, part):
+        async with parallelism:
+            text = await completion_text(cache=False, task="rewrite", messages=humanizer_messages(chunks[index], custom_characters, relationships, part))
+        rewritten[index] = text.strip()
+
+    await asyncio.gather(*(rewrite(index, part) for index, part in rewrite_parts(chunks)))
+    logger.info("story rewritten in chunks chunks=%d", len(chunks))
+    return CHUNK_SEPARATOR.join(rewritten)
+
+'''
+Async routes. Same request and response formats as the Flask routes with the same paths.
+'''
+async def api_story_generate(request):
+    something = byteNonsense(await request.body())
+    location = something['location']
+    summary = something['summary']
+    series = something['series']
+    characters = something['characters']
+
+    def load():
+        character_AI_models, character_relationships = load_cast([characters[key]['id'] for key in characters])
+        return character_AI_models, character_relationships, bible_context(series['id'])
+
+    character_AI_models, character_relationships, previous_story = await in_app_context(load)
+    try:
+        plot = await structured_completion_async(
+            StoryPlot,
+            max_retries=5,
+            cache=False,
+            task="plot",
+            messages=story_messages(summary, character_AI_models, location=location, previous_story=previous_story,
+                continuity_type=something.get('continuity_type', 'usual'), relationships=character_relationships or None),
+            top_p=1,
+            stream=False,
+            stop=None,
+        )
+        output = await expand_plot_to_story_async(plot.plot, plot_scenes(plot))
+        logger.info("story generated length=%d", len(output))
+        return JSONResponse({"story_title": plot.title, "story": output})
+    except StructuredOutputError as e:
+        logger.error("story generation failed error=StructuredOutputError message=%s", e)
+        return JSONResponse({'errors': e.errors, 'message': 'INVALID_MODEL_OUTPUT', 'status': 'ERROR'}, status_code=502)
+    except GenerationError as e:
+        return JSONResponse({'error': str(e), 'message': 'GENERATION_FAILED', 'status': 'ERROR'}, status_code=502)
+    except Exception as e:
+        logger.error("story generation failed error=%s message=%s", type(e).__name__, e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+async def api_story_humanize(request):
+    something = byteNonsense(await request.body())
+    story_original = something['original_story']
+    characters = something['story_characters']
+    character_AI_models, character_relationships = await in_app_context(load_cast, [characters[key]['id'] for key in characters])
+
+    try:
+        improved_story = await rewrite_story_async(story_original, character_AI_models, character_relationships)
+        title = await completion_text(task="title", messages=title_messages(improved_story))
+    except Exception as e:
+        logger.error("story humanizer failed error=%s message=%s", type(e).__name__, e)
+        error = GenerationError("humanized story", e)
+        return JSONResponse({'error': str(error), 'message': 'HUMANIZE_FAILED', 'status': 'ERROR'}, status_code=502)
+    return JSONResponse({"output": {"improved_story": improved_story, "title": title}})
+
+async def api_characters_scan(request):
+    something = byteNonsense(await request.body())
+    try:
+        extracted = await structured_completion_async(
+            ExtractedCharacters,
+            task="extraction",
+            messages=extract_characters_messages(something['story']),
+            top_p=1,
+            stream=False,
+            stop=None,
+        )
+    except StructuredOutputError as e:
+        return JSONResponse({'errors': e.errors, 'message': 'INVALID_MODEL_OUTPUT', 'status': 'ERROR'}, status_code=502)
+    except Exception as e:
+        logger.error("character scan failed error=%s message=%s", type(e).__name__, e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+    return JSONResponse({"characters": characters_scan_json(extracted.characters)})
+
+async def api_story_save(request):
+    something = byteNonsense(await request.body())
+    return JSONResponse(await in_app_context(save_story, something))
+
+def timed_route(path, endpoint):
+    # Records the same request metrics as the Flask routes
+    async def timed_endpoint(request):
+        started = time.perf_counter()
+        response = await endpoint(request)
+        latency = time.perf_counter() - started
+        http_latency.observe(latency, route=path, method=request.method, status=str(response.status_code))
+        logger.info("request method=%s route=%s status=%s latency=%.3f mode=asgi", request.method, path, response.status_code, latency)
+        return response
+    return Route(path, timed_endpoint, methods=["POST"])
+
+@contextlib.asynccontextmanager
+async def lifespan(asgi_app):
+    global async_client, db_limiter, lock_limiter
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=ASGI_GROQ_MAX_CONNECTIONS, max_keepalive_connections=ASGI_GROQ_MAX_CONNECTIONS),
+        timeout=httpx.Timeout(60.0, connect=5.0)
+    )
+    # Retries are done by scheduled_create_async, like the sync client
+    async_client = AsyncGroq(api_key=groq_api_key, base_url=os.getenv("GROQ_BASE_URL"), http_client=http_client, max_retries=0)
+    db_limiter = anyio.CapacityLimiter(ASGI_DB_THREADS)
+    # Threads waiting on another process's call, see shared_create_async
+    lock_limiter = anyio.CapacityLimiter(ASGI_GROQ_MAX_CONNECTIONS)
+    logger.info("asgi mode started groq_max_connections=%d db_threads=%d", ASGI_GROQ_MAX_CONNECTIONS, ASGI_DB_THREADS)
+    await on_thread(start_workers)
+    try:
+        yield
+    finally:
+        await on_thread(stop_workers)
+        await http_client.aclose()
+
+app = Starlette(
+    routes=[
+        timed_route('/api/stories/generate', api_story_generate),
+        timed_route('/api/stories/humanize', api_story_humanize),
+        timed_route('/api/characters/scan', api_characters_scan),
+        timed_route('/api/stories/save', api_story_save),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS))
+    ],
+    lifespan=lifespan
+)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=os.getenv("ASGI_HOST", "127.0.0.1"), port=int(os.getenv("ASGI_PORT", "8000")))
@@ -0,0 +1,147 @@
+from everglen_web import db
+from everglen_models import StoryDB, SeriesBibleDB, BibleUpdate
+from everglen_llm import PRIORITY_BACKGROUND
+from everglen_structured import structured_completion
+from datetime import datetime
+import json
+import os
+import threading
+'''
+Rolling per-series "story bible" used as the continuation context of new episodes.
+
+The bible keeps a compressed summary of the series so far, where every character currently stands,
+and the storylines that are still open. Saving an episode folds only the episodes newer than the bible
+into it, so each update reads a few episodes and the old bible instead of the whole series,
+and the context given to generate_story stays the same size however long the series gets.
+'''
+# Episode text sent per update call; episodes past the budget are folded in by the next call
+BIBLE_BATCH_CHARS = int(os.getenv("SERIES_BIBLE_BATCH_CHARS", "8000"))
+# Longest part of one episode sent when it has no plot summary yet
+EPISODE_EXCERPT_CHARS = 6000
+MAX_SUMMARY_WORDS = 300
+MAX_CHARACTER_STATES = 20
+MAX_OPEN_THREADS = 10
+
+# One update at a time per series in this process; the bible's version column catches other processes.
+# everglen_analysis takes its own lock per series from here as well
+series_locks = {}
+series_locks_guard = threading.Lock()
+
+def series_lock(series_id, kind="bible"):
+    with series_locks_guard:
+        return series_locks.setdefault((kind, int(series_id)), threading.Lock())
+
+def episode_text(story) -> str:
+    # The plot summary is enough to carry forward; the full text only when it is missing
+    if story.plot:
+        return story.plot
+    return story.full_story[:EPISODE_EXCERPT_CHARS]
+
+def episode_batches(stories):
+    # Consecutive episodes grouped up to BIBLE_BATCH_CHARS, at least one per batch
+    batch = []
+    size = 0
+    for story in stories:
+        text = episode_text(story)
+        if batch and size + len(text) > BIBLE_BATCH_CHARS:
+            yield batch
+            batch = []
+            size = 0
+        batch.append((story, text))
+        size += len(text)
+    if batch:
+        yield batch
+
+def fold_episodes(bible: dict, episodes: list) -> dict:
+    output = structured_completion(
+        BibleUpdate,
+        task="continuity",
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "You are a story editor keeping the story bible of a series. You are given the current bible, "
+                    "followed by the episodes that happened after it, in chronological order. Update the bible so that it covers them too. "
+                    f"Keep the summary under {MAX_SUMMARY_WORDS} words by compressing older events. "
+                    f"Give the current state of at most {MAX_CHARACTER_STATES} characters in one sentence each, keeping only their latest state. "
+                    f"List at most {MAX_OPEN_THREADS} storylines that are still unresolved, and drop the ones that were resolved. "
+                    "Ensure that the output is in JSON format with the following schema:\n"
+                    "{\n"
+                    "  \"summary\": {\"type\": \"string\"},\n"
+                    "  \"character_states\": {\"type\": \"object\", \"additionalProperties\": {\"type\": \"string\"}},\n"
+                    "  \"open_threads\": {\"type\": \"array\", \"items\": {\"type\": \"string\"}}\n"
+                    "}\n"
+                )
+            },
+            {
+                "role": "user",
+                "content": f"Current bible: {json.dumps(bible)}\n\n"
+                    + "\n\n".join(f"Episode {story.episode_number} ({story.story_title}): {text}" for story, text in episodes)
+            }
+        ],
+        top_p=1,
+        stream=False,
+        stop=None,
+        priority=PRIORITY_BACKGROUND,
+    )
+    return {
+        "summary": output.summary,
+        "character_states": dict(list(output.character_states.items())[:MAX_CHARACTER_STATES]),
+        "open_threads": output.open_threads[:MAX_OPEN_THREADS]
+    }
+
+def update_series_bible(series_id):
+    '''
+    Folds every episode saved since the last update into the series bible and returns it.
+    Does not call Groq when the bible is already up to date.
+    '''
+    with series_lock(series_id):
+        bible = SeriesBibleDB.query.filter_by(series_id=series_id).first()
+        if bible is None:
+            bible = SeriesBibleDB(series_id=int(series_id), summary='', character_states='{}', open_threads='[]', last_episode_number=0)
+            db.session.add(bible)
+            # Committed straight away: a pending insert would keep the SQLite write lock through the Groq calls below
+            db.session.commit()
+        stories = StoryDB.query.filter(
+            StoryDB.series_id == series_id,
+            StoryDB.episode_number > bible.last_episode_number
+        ).order_by(StoryDB.episode_number.asc()).all()
+
+        episodes_added = 0
+        for episodes in episode_batches(stories):
+            current = {
+                "summary": bible.summary,
+                "character_states": json.loads(bible.character_states),
+                "open_threads": json.loads(bible.open_threads)
+            }
+            updated = fold_episodes(current, episodes)
+            bible.summary = updated["summary"]
+            bible.character_states = json.dumps(updated["character_states"])
+            bible.open_threads = json.dumps(updated["open_threads"])
+            bible.last_episode_number = episodes[-1][0].episode_number
+            bible.updated_at = datetime.utcnow()
+            # Committed per batch, so a failure part way keeps the episodes already folded in
+            db.session.commit()
+            episodes_added += len(episodes)
+
+        return {**bible.__json__(), "episodes_added": episodes_added}
+
+def get_series_bible(series_id):
+    bible = SeriesBibleDB.query.filter_by(series_id=series_id).first()
+    return bible.__json__() if bible is not None else None
+
+def bible_context(series_id) -> str:
+    # The bible as compact text for the previous_story of generate_story, empty when there is none yet
+    if not series_id:
+        return ""
+    bible = SeriesBibleDB.query.filter_by(series_id=series_id).first()
+    if bible is None or not bible.summary:
+        return ""
+    character_states = json.loads(bible.character_states)
+    open_threads = json.loads(bible.open_threads)
+    context = f"Story so far (up to episode {bible.last_episode_number}): {bible.summary}"
+    if character_states:
+        context += " Characters now: " + "; ".join(f"{name}: {state}" for name, state in character_states.items()) + "."
+    if open_threads:
+        context += " Open threads: " + "; ".join(open_threads) + "."
+    return context
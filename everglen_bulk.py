@@ -0,0 +1,212 @@
+from everglen_web import db
+from everglen_models import Character, CharacterDB, RelationshipDB
+from everglen_graph import relationship_graph
+from pydantic import ValidationError
+from sqlalchemy import insert
+from typing import Optional
+import json
+'''
+Bulk import and export of the cast and its relationship graph.
+
+The format is one JSON record per character or relationship, either as NDJSON (one record per line),
+as a JSON array, or as a JSON object with "characters" and "relationships" arrays.
+
+Character records are validated against the Character model and may carry a "ref" that relationships
+in the same import use to point at them:
+    {"ref": "maya", "name": "Maya", "age": 16, "gender": "female", "personality": "bold"}
+Relationship records use the same field names as /api/relationships/add. Their subject and object
+are either a ref from the same import or the id of a character that is already in the database:
+    {"relation_subject": "maya", "relation_object": 12, "relation": "best friends"}
+
+The export writes refs equal to the character ids, so an export can be imported as is into another database.
+'''
+# Rows per INSERT statement
+INSERT_BATCH_SIZE = 500
+# Rows fetched per round trip while exporting
+EXPORT_BATCH_SIZE = 500
+
+class BulkImportError(Exception):
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} invalid record(s)")
+        self.errors = errors
+
+def parse_records(body: str) -> list:
+    # Accepts a JSON array, a {"characters": [...], "relationships": [...]} object, or NDJSON
+    text = body.strip()
+    if not text:
+        return []
+    try:
+        document = json.loads(text)
+    except json.JSONDecodeError:
+        document = None
+    else:
+        if isinstance(document, list):
+            return document
+        if isinstance(document, dict) and ("characters" in document or "relationships" in document):
+            return list(document.get("characters") or []) + list(document.get("relationships") or [])
+        if isinstance(document, dict):
+            return [document]
+
+    records = []
+    errors = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            errors.append({"record": line_number, "error": f"Invalid JSON: {e.msg}"})
+    if errors:
+        raise BulkImportError(errors)
+    return records
+
+def is_relationship(record: dict) -> bool:
+    return record.get("type") == "relationship" or "relation" in record
+
+def character_row(character: Character) -> dict:
+    return {
+        "character_name": character.name,
+        "character_age": character.age,
+        "character_gender": character.gender,
+        "character_personality": character.personality,
+        "high_school_clique": character.high_school_clique,
+        "cultural_background": character.cultural_background,
+        # Stored as a JSON list, like the other list columns
+        "native_languages": json.dumps(character.native_languages) if character.native_languages is not None else None,
+        "current_job": character.current_job,
+        "outfit": character.outfit,
+        "additional_desc": character.additional_desc
+    }
+
+def stored_languages(text: Optional[str]):
+    # Rows written before native_languages was stored as JSON hold plain text, which is passed on as it is
+    if not text:
+        return None
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+def validate_records(records: list):
+    # Returns (character refs, character rows, relationship records); raises BulkImportError listing every invalid record
+    refs = []
+    character_rows = []
+    relationships = []
+    errors = []
+    seen_refs = set()
+    for index, record in enumerate(records, start=1):
+        if not isinstance(record, dict):
+            errors.append({"record": index, "error": "Expected a JSON object"})
+            continue
+        if is_relationship(record):
+            missing = [field for field in ("relation_subject", "relation_object", "relation") if record.get(field) in (None, "")]
+            if missing:
+                errors.append({"record": index, "error": "Missing " + ", ".join(missing)})
+            else:
+                relationships.append((index, record))
+            continue
+        ref = record.get("ref")
+        if ref is not None:
+            if str(ref) in seen_refs:
+                errors.append({"record": index, "error": f"Duplicate ref {ref}"})
+                continue
+            seen_refs.add(str(ref))
+        try:
+            character = Character.model_validate({key: value for key, value in record.items() if key not in ("ref", "type")})
+        except ValidationError as e:
+            errors.append({"record": index, "error": "; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors())})
+            continue
+        refs.append(str(ref) if ref is not None else None)
+        character_rows.append(character_row(character))
+    if errors:
+        raise BulkImportError(errors)
+    return refs, character_rows, relationships
+
+def batched(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def insert_rows(model, rows: list) -> list:
+    # Multi-row INSERTs of INSERT_BATCH_SIZE rows; returns the new ids in the order of rows. The caller commits
+    ids = []
+    for batch in batched(rows, INSERT_BATCH_SIZE):
+        result = db.session.execute(insert(model).returning(model.id, sort_by_parameter_order=True), batch)
+        ids.extend(row.id for row in result)
+    return ids
+
+def import_cast(body: str) -> dict:
+    '''
+    Validates every record first, then writes all characters and relationships in one transaction
+    using multi-row INSERTs. Nothing is written when any record is invalid.
+    '''
+    refs, character_rows, relationships = validate_records(parse_records(body))
+
+    # Relationships may point at characters that already exist; those are checked with one query
+    existing_ids = set()
+    wanted = {str(record[field]) for _, record in relationships for field in ("relation_subject", "relation_object")} - set(refs)
+    numeric_ids = [int(value) for value in wanted if value.isdigit()]
+    if numeric_ids:
+        existing_ids = {str(row.id) for row in db.session.query(CharacterDB.id).filter(CharacterDB.id.in_(numeric_ids)).all()}
+    errors = []
+    known_refs = set(refs)
+    for index, record in relationships:
+        for field in ("relation_subject", "relation_object"):
+            value = str(record[field])
+            if value not in known_refs and value not in existing_ids:
+                errors.append({"record": index, "error": f"{field} {value} is neither a ref in this import nor an existing character id"})
+    if errors:
+        raise BulkImportError(errors)
+
+    try:
+        new_ids = insert_rows(CharacterDB, character_rows)
+        ids_by_ref = {ref: character_id for ref, character_id in zip(refs, new_ids) if ref is not None}
+
+        def resolve(value):
+            return ids_by_ref[str(value)] if str(value) in ids_by_ref else int(value)
+
+        relationship_rows = [{
+            "char_subject_id": resolve(record["relation_subject"]),
+            "char_object_id": resolve(record["relation_object"]),
+            "relation": str(record["relation"])
+        } for _, record in relationships]
+        relationship_ids = insert_rows(RelationshipDB, relationship_rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    relationship_graph.add_many([(relation_id, row["char_subject_id"], row["char_object_id"], row["relation"], 1)
+        for relation_id, row in zip(relationship_ids, relationship_rows)])
+
+    return {
+        "characters_added": len(new_ids),
+        "relationships_added": len(relationship_rows),
+        "character_ids": ids_by_ref
+    }
+
+def export_cast():
+    # Yields the whole cast, then every relationship, as NDJSON lines, reading the tables in batches
+    for character in CharacterDB.query.order_by(CharacterDB.id.asc()).yield_per(EXPORT_BATCH_SIZE):
+        record = {
+            "type": "character",
+            "ref": character.id,
+            "name": character.character_name,
+            "age": character.character_age,
+            "gender": character.character_gender,
+            "personality": character.character_personality,
+            "high_school_clique": character.high_school_clique,
+            "cultural_background": character.cultural_background,
+            "native_languages": stored_languages(character.native_languages),
+            "current_job": character.current_job,
+            "outfit": character.outfit,
+            "additional_desc": character.additional_desc
+        }
+        yield json.dumps(record) + "\n"
+    for relationship in RelationshipDB.query.order_by(RelationshipDB.id.asc()).yield_per(EXPORT_BATCH_SIZE):
+        record = {
+            "type": "relationship",
+            "relation_subject": relationship.char_subject_id,
+            "relation_object": relationship.char_object_id,
+            "relation": relationship.relation
+        }
+        yield json.dumps(record) + "\n"
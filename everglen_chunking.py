@@ -0,0 +1,94 @@
+import re
+from typing import List
+'''
+Splits long stories into chunks that fit a token budget, for prompts that have to rewrite
+a story piece by piece because the whole text would not fit in one completion.
+
+Chunks end on scene breaks or paragraph breaks whenever possible; a single paragraph longer
+than the budget is split between sentences, and a single sentence longer than that between words.
+The scene breaks themselves (chapter headings, "* * *", "---", "~~~") come out as chunks of their own,
+to be passed through as they are (see is_scene_break). Joining the chunks with CHUNK_SEPARATOR gives
+back the story with its paragraphs, headings and break markers intact; only blank space is normalized.
+'''
+CHUNK_SEPARATOR = "\n\n"
+# Rough size of a token in English text, the same estimate the rate limiter uses
+CHARACTERS_PER_TOKEN = 4
+
+# The group captures the break line, so re.split keeps it between the scenes
+SCENE_BREAK = re.compile(r"\n\s*(\*\s*\*\s*\*|#{1,3}[^\n]*|-{3,}|~{3,})\s*\n")
+SCENE_BREAK_LINE = re.compile(r"\*\s*\*\s*\*|#{1,3}[^\n]*|-{3,}|~{3,}")
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_END = re.compile(r"(?<=[.!?\"'])\s+")
+
+def estimate_text_tokens(text: str) -> int:
+    return len(text) // CHARACTERS_PER_TOKEN + 1
+
+def is_scene_break(chunk: str) -> bool:
+    # Chunks that only hold a heading or a break marker, which are not sent to the model
+    return SCENE_BREAK_LINE.fullmatch(chunk.strip()) is not None
+
+def split_long_block(block: str, max_tokens: int) -> List[str]:
+    # Pieces of a paragraph that is over the budget on its own: whole sentences, or words as a last resort
+    pieces = []
+    for sentence in SENTENCE_END.split(block):
+        if estimate_text_tokens(sentence) <= max_tokens:
+            pieces.append(sentence)
+            continue
+        words = sentence.split(" ")
+        step = max(1, max_tokens * CHARACTERS_PER_TOKEN // 6)
+        pieces.extend(" ".join(words[start:start + step]) for start in range(0, len(words), step))
+    return pack(pieces, max_tokens, " ")
+
+def pack(blocks: List[str], max_tokens: int, separator: str) -> List[str]:
+    # Greedily puts consecutive blocks together while they stay within the budget
+    chunks = []
+    current = []
+    current_tokens = 0
+    for block in blocks:
+        block_tokens = estimate_text_tokens(block)
+        if current and current_tokens + block_tokens > max_tokens:
+            chunks.append(separator.join(current))
+            current = []
+            current_tokens = 0
+        current.append(block)
+        current_tokens += block_tokens
+    if current:
+        chunks.append(separator.join(current))
+    return chunks
+
+def split_story(story: str, max_tokens: int) -> List[str]:
+    '''
+    Splits a story into chunks of at most about max_tokens each, in order.
+    A story that already fits is returned as a single chunk, unchanged.
+    '''
+    if estimate_text_tokens(story) <= max_tokens:
+        return [story]
+
+    chunks = []
+    for position, scene in enumerate(SCENE_BREAK.split(story)):
+        if position % 2:
+            # Every other piece is a captured break line
+            chunks.append(scene.strip())
+            continue
+        paragraphs = []
+        for paragraph in PARAGRAPH_BREAK.split(scene.strip()):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            if estimate_text_tokens(paragraph) > max_tokens:
+                paragraphs.extend(split_long_block(paragraph, max_tokens))
+            else:
+                paragraphs.append(paragraph)
+        # Scenes are never merged, so every chunk boundary that can fall on a scene break does
+        chunks.extend(pack(paragraphs, max_tokens, CHUNK_SEPARATOR))
+    return chunks
+
+def chunk_context(chunks: List[str], index: int, max_characters: int):
+    # The end of the previous chunk and the start of the next one, cut at word boundaries
+    before = chunks[index - 1][-max_characters:] if index > 0 else ""
+    after = chunks[index + 1][:max_characters] if index + 1 < len(chunks) else ""
+    if before and len(chunks[index - 1]) > max_characters:
+        before = before.split(" ", 1)[-1]
+    if after and len(chunks[index + 1]) > max_characters:
+        after = after.rsplit(" ", 1)[0]
+    return before, after
@@ -0,0 +1,150 @@
+from everglen_web import db
+from everglen_models import RelationshipDB
+from sqlalchemy import text
+from collections import deque
+import threading
+'''
+Process-wide adjacency index of the relationships table.
+
+Built once at startup and kept up to date by the code that writes relationships
+(/api/relationships/add, /api/relationships/edit and the bulk import), so neighbor, n-hop
+and subgraph queries are answered from memory instead of scanning the relationships table.
+Every worker process has its own copy. Each query first reads the relationships counter of
+entity_versions, which triggers bump on every write from any process, and rebuilds the index
+when it moved since the index was last brought up to date; that read is the only query a query makes.
+A write made here is applied to the index in place, and moves the index to the counter it left behind,
+so it costs no rebuild. Writes from other processes (or racing ones) leave the counter further on,
+and the next query rebuilds.
+'''
+RELATIONSHIPS_VERSION = text("SELECT version FROM entity_versions WHERE entity = 'relationships'")
+
+class RelationshipGraph:
+    def __init__(self):
+        # relation id -> (subject character id, object character id, relation, row version)
+        self.edges = {}
+        # character id -> set of relation ids the character is part of
+        self.adjacency = {}
+        self.lock = threading.RLock()
+        # Only one thread rebuilds at a time, the others wait and then use its index
+        self.rebuild_lock = threading.Lock()
+        # entity_versions counter of the relationships table the index was built at
+        self.version = None
+
+    def rebuild(self, version=None):
+        # The counter is read before the rows, so a write racing the rebuild only causes another one
+        if version is None:
+            version = db.session.execute(RELATIONSHIPS_VERSION).scalar()
+        rows = db.session.query(RelationshipDB.id, RelationshipDB.char_subject_id, RelationshipDB.char_object_id, RelationshipDB.relation, RelationshipDB.version).all()
+        edges = {}
+        adjacency = {}
+        for relation_id, subject_id, object_id, relation, row_version in rows:
+            edges[relation_id] = (subject_id, object_id, relation, row_version)
+            adjacency.setdefault(subject_id, set()).add(relation_id)
+            adjacency.setdefault(object_id, set()).add(relation_id)
+        with self.lock:
+            self.edges = edges
+            self.adjacency = adjacency
+            self.version = version
+
+    def refresh(self):
+        # Rebuilds when the index was never built or relationships were written to since, by any process
+        version = db.session.execute(RELATIONSHIPS_VERSION).scalar()
+        if version == self.version:
+            return
+        with self.rebuild_lock:
+            if version != self.version:
+                self.rebuild(version)
+
+    def add(self, relation_id, subject_id, object_id, relation, version=1):
+        # Called after the relationship was committed, whether it is new or edited
+        self.add_many([(relation_id, subject_id, object_id, relation, version)])
+
+    update = add
+
+    def add_many(self, edges):
+        # Committed relationships, [(relation id, subject id, object id, relation, row version)].
+        # Each of them bumped the counter once; when it moved by more, someone else wrote as well
+        version = db.session.execute(RELATIONSHIPS_VERSION).scalar()
+        with self.rebuild_lock, self.lock:
+            for edge in edges:
+                self.put(*edge)
+            if self.version is not None and version == self.version + len(edges):
+                self.version = version
+
+    def put(self, relation_id, subject_id, object_id, relation, version):
+        # An edit can move a relationship to other characters, so it is re-added from scratch
+        subject_id, object_id = int(subject_id), int(object_id)
+        with self.lock:
+            self.remove(relation_id)
+            self.edges[relation_id] = (subject_id, object_id, relation, version)
+            self.adjacency.setdefault(subject_id, set()).add(relation_id)
+            self.adjacency.setdefault(object_id, set()).add(relation_id)
+
+    def remove(self, relation_id):
+        with self.lock:
+            edge = self.edges.pop(relation_id, None)
+            if edge is None:
+                return
+            for character_id in edge[:2]:
+                relation_ids = self.adjacency.get(character_id)
+                if relation_ids is not None:
+                    relation_ids.discard(relation_id)
+                    if not relation_ids:
+                        del self.adjacency[character_id]
+
+    def edge(self, relation_id):
+        subject_id, object_id, relation, version = self.edges[relation_id]
+        return {"relation_id": relation_id, "relation_subject": subject_id, "relation_object": object_id, "relation": relation, "version": version}
+
+    def neighbors(self, character_id):
+        # Relationships the character is part of, on either side, oldest first
+        self.refresh()
+        with self.lock:
+            return [self.edge(relation_id) for relation_id in sorted(self.adjacency.get(int(character_id), ()))]
+
+    def touching(self, character_ids):
+        # Relationships with at least one end in character_ids, each once, oldest first
+        self.refresh()
+        with self.lock:
+            relation_ids = set()
+            for character_id in character_ids:
+                relation_ids.update(self.adjacency.get(int(character_id), ()))
+            return [self.edge(relation_id) for relation_id in sorted(relation_ids)]
+
+    def within_hops(self, character_ids, hops):
+        # Every character at most `hops` relationships away from any of character_ids (including them)
+        self.refresh()
+        with self.lock:
+            seen = {int(character_id) for character_id in character_ids}
+            frontier = deque((character_id, 0) for character_id in seen)
+            while frontier:
+                character_id, distance = frontier.popleft()
+                if distance == hops:
+                    continue
+                for relation_id in self.adjacency.get(character_id, ()):
+                    subject_id, object_id = self.edges[relation_id][:2]
+                    other_id = object_id if subject_id == character_id else subject_id
+                    if other_id not in seen:
+                        seen.add(other_id)
+                        frontier.append((other_id, distance + 1))
+            return seen
+
+    def induced_subgraph(self, character_ids):
+        # Relationships with both ends in character_ids, oldest first
+        character_ids = {int(character_id) for character_id in character_ids}
+        self.refresh()
+        with self.lock:
+            relation_ids = set()
+            for character_id in character_ids:
+                for relation_id in self.adjacency.get(character_id, ()):
+                    subject_id, object_id = self.edges[relation_id][:2]
+                    if subject_id in character_ids and object_id in character_ids:
+                        relation_ids.add(relation_id)
+            return [self.edge(relation_id) for relation_id in sorted(relation_ids)]
+
+    def all_edges(self):
+        self.refresh()
+        with self.lock:
+            return [self.edge(relation_id) for relation_id in sorted(self.edges)]
+
+relationship_graph = RelationshipGraph()
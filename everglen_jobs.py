@@ -0,0 +1,280 @@
+from everglen_web import app, db
+from everglen_models import JobDB
+from datetime import datetime, timedelta
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import uuid
+'''
+Background job subsystem.
+Long-running Groq pipelines are submitted as jobs and run on a bounded thread pool
+instead of inside the request thread. Jobs live in the jobs table of the main database,
+so queued or interrupted jobs are picked up again when a worker restarts.
+
+The worker threads are started by the server (start_workers), not on import. When the process stops
+(stop_workers, also run at exit), workers stop claiming jobs, and the jobs running in this process go back
+to queued with the stages they finished kept. Only errors from the pipeline itself fail a job.
+'''
+JOB_WORKERS = int(os.getenv("EVERGLEN_JOB_WORKERS", "4"))
+# How long a running job may go without a heartbeat from its worker before another worker may take it over
+JOB_LEASE = timedelta(minutes=int(os.getenv("EVERGLEN_JOB_LEASE_MINUTES", "10")))
+# The sweeper also renews the leases of this process's running jobs, so it runs well within a lease
+JOB_SWEEP_SECONDS = min(60, JOB_LEASE.total_seconds() / 3)
+
+logger = logging.getLogger(__name__)
+
+# job_type -> (list of stage names, pipeline function)
+pipelines = {}
+
+# Ids of jobs waiting for one of this process's workers. The workers are daemon threads, so the interpreter
+# does not wait for a long pipeline at exit; stop_workers requeues what they were running instead
+job_queue = queue.Queue()
+workers = []
+workers_lock = threading.Lock()
+
+# Ids of jobs already waiting in job_queue
+scheduled = set()
+scheduled_lock = threading.Lock()
+
+# Ids of jobs running in this process, whose leases the sweeper keeps renewing however long a stage takes
+running = set()
+running_lock = threading.Lock()
+
+# Set by stop_workers
+shutting_down = threading.Event()
+
+class JobInterrupted(Exception):
+    # Raised between stages when the process is shutting down, the job is requeued
+    pass
+
+def job_pipeline(job_type, stages):
+    # Registers a pipeline function that takes (job_context, payload) and returns a JSON-serializable result
+    def decorator(function):
+        pipelines[job_type] = (stages, function)
+        return function
+    return decorator
+
+class JobContext:
+    def __init__(self, job):
+        self.job = job
+        self.stage_results = json.loads(job.stage_results)
+
+    def run_stage(self, stage, function, *args, **kwargs):
+        # Stages finished before a restart are not re-run, their stored output is used instead
+        if stage in self.stage_results:
+            return self.stage_results[stage]
+        if shutting_down.is_set():
+            raise JobInterrupted(stage)
+
+        self.update_progress(stage, "running")
+        output = function(*args, **kwargs)
+        self.stage_results[stage] = output
+        self.job.stage_results = json.dumps(self.stage_results)
+        self.update_progress(stage, "done")
+        return output
+
+    def update_progress(self, stage, status):
+        now = datetime.utcnow()
+        progress = json.loads(self.job.progress)
+        for entry in progress:
+            if entry["stage"] == stage:
+                entry["status"] = status
+                if status == "running":
+                    entry["started_at"] = now.isoformat()
+                else:
+                    entry["finished_at"] = now.isoformat()
+        self.job.progress = json.dumps(progress)
+        self.job.current_stage = stage
+        self.job.updated_at = now
+        self.job.lease_expires_at = now + JOB_LEASE
+        db.session.commit()
+
+def submit_job(job_type, payload, dedupe=False):
+    # With dedupe, a job identical to one that is still queued or running is not submitted twice
+    if dedupe:
+        pending = JobDB.query.filter(JobDB.job_type == job_type, JobDB.status.in_(['queued', 'running']), JobDB.payload == json.dumps(payload)).first()
+        if pending is not None:
+            return pending
+    stages, function = pipelines[job_type]
+    job = JobDB(
+        id = uuid.uuid4().hex,
+        job_type = job_type,
+        status = 'queued',
+        progress = json.dumps([{"stage": stage, "status": "pending", "started_at": None, "finished_at": None} for stage in stages]),
+        stage_results = '{}',
+        payload = json.dumps(payload)
+    )
+    db.session.add(job)
+    db.session.commit()
+    schedule_job(job.id)
+    return job
+
+def schedule_job(job_id):
+    if shutting_down.is_set():
+        # Left queued for the next worker
+        return
+    with scheduled_lock:
+        if job_id in scheduled:
+            return
+        scheduled.add(job_id)
+    job_queue.put(job_id)
+
+def work():
+    while True:
+        job_id = job_queue.get()
+        if job_id is None:
+            return
+        try:
+            run_job(job_id)
+        except Exception:
+            logger.exception("job worker failed job_id=%s", job_id)
+
+def start_workers():
+    '''
+    Starts this process's job workers and sweeper and picks up the jobs left over from a previous run.
+    Called when the app starts serving (its first request, or the lifespan in ASGI mode) rather than on import,
+    so tests and scripts can import the app without starting threads. Later calls do nothing.
+    '''
+    if workers:
+        return False
+    with workers_lock:
+        if workers or shutting_down.is_set():
+            return False
+        for number in range(JOB_WORKERS):
+            worker = threading.Thread(target=work, name=f"everglen-job-{number}", daemon=True)
+            worker.start()
+            workers.append(worker)
+    start_job_sweeper()
+    resume_pending_jobs()
+    return True
+
+def stop_workers():
+    '''
+    Stops claiming jobs and puts the jobs running in this process back in the queue for the next worker,
+    with the stages they finished kept. Run at exit; servers with a shutdown hook of their own call it there.
+    '''
+    if shutting_down.is_set():
+        return
+    shutting_down.set()
+    for _ in workers:
+        job_queue.put(None)
+    with running_lock:
+        job_ids = list(running)
+    if not job_ids:
+        return
+    with app.app_context():
+        for job in JobDB.query.filter(JobDB.id.in_(job_ids), JobDB.status == 'running').all():
+            logger.info("job interrupted by shutdown, requeued job_id=%s job_type=%s stage=%s", job.id, job.job_type, job.current_stage)
+            requeue_job(job)
+        db.session.commit()
+
+atexit.register(stop_workers)
+
+def claim_job(job_id):
+    # Only one worker may move a job from queued to running
+    now = datetime.utcnow()
+    claimed = JobDB.query.filter_by(id=job_id, status='queued').update({
+        "status": "running",
+        "updated_at": now,
+        "lease_expires_at": now + JOB_LEASE
+    })
+    db.session.commit()
+    return claimed == 1
+
+def requeue_job(job):
+    # Puts an interrupted job back in the queue; the stages it finished keep their results
+    progress = json.loads(job.progress)
+    for entry in progress:
+        if entry["status"] == "running":
+            entry["status"] = "pending"
+            entry["started_at"] = None
+    job.progress = json.dumps(progress)
+    job.status = 'queued'
+    job.current_stage = None
+    job.lease_expires_at = None
+
+def run_job(job_id):
+    with scheduled_lock:
+        scheduled.discard(job_id)
+    if shutting_down.is_set():
+        # Left queued for the next worker
+        return
+    with app.app_context():
+        if not claim_job(job_id):
+            return
+        with running_lock:
+            running.add(job_id)
+        try:
+            finish_job(job_id)
+        finally:
+            with running_lock:
+                running.discard(job_id)
+
+def finish_job(job_id):
+    # Runs a claimed job's pipeline and records how it ended
+    job = JobDB.query.filter_by(id=job_id).first()
+    job_type = job.job_type
+    stages, function = pipelines[job_type]
+    context = JobContext(job)
+    try:
+        result = function(context, json.loads(job.payload))
+        job.result = json.dumps(result)
+        job.status = 'done'
+        job.current_stage = None
+        logger.info("job done job_id=%s job_type=%s", job_id, job_type)
+    except Exception as e:
+        db.session.rollback()
+        job = JobDB.query.filter_by(id=job_id).first()
+        if isinstance(e, JobInterrupted) or shutting_down.is_set():
+            # Shutdown, not the pipeline: thread pools inside the pipeline refuse new work at exit as well
+            logger.info("job interrupted by shutdown, requeued job_id=%s job_type=%s stage=%s", job_id, job_type, job.current_stage)
+            requeue_job(job)
+        else:
+            logger.exception("job failed job_id=%s job_type=%s", job_id, job_type)
+            if job.current_stage:
+                JobContext(job).update_progress(job.current_stage, "failed")
+            job.status = 'failed'
+            job.error = str(e)
+    job.updated_at = datetime.utcnow()
+    job.lease_expires_at = None
+    db.session.commit()
+
+def renew_leases():
+    # Heartbeat for the jobs running in this process, so a stage longer than JOB_LEASE is not taken over and run twice
+    with running_lock:
+        job_ids = list(running)
+    if not job_ids:
+        return 0
+    with app.app_context():
+        renewed = JobDB.query.filter(JobDB.id.in_(job_ids), JobDB.status == 'running').update(
+            {"lease_expires_at": datetime.utcnow() + JOB_LEASE}, synchronize_session=False)
+        db.session.commit()
+        return renewed
+
+def resume_pending_jobs():
+    # Called at startup: requeue jobs whose worker died mid-run, then schedule everything still queued
+    with app.app_context():
+        JobDB.query.filter(JobDB.status == 'running', JobDB.lease_expires_at < datetime.utcnow()).update({"status": "queued"})
+        db.session.commit()
+        queued = JobDB.query.filter_by(status='queued').order_by(JobDB.created_at.asc()).all()
+        for job in queued:
+            schedule_job(job.id)
+        return len(queued)
+
+def start_job_sweeper():
+    # Periodically renews this process's leases and picks up jobs left behind by other workers,
+    # claim_job makes double scheduling harmless
+    def sweep():
+        while not shutting_down.wait(JOB_SWEEP_SECONDS):
+            try:
+                renew_leases()
+                resume_pending_jobs()
+            except Exception as e:
+                logger.exception("job sweeper failed")
+
+    sweeper = threading.Thread(target=sweep, name="everglen-job-sweeper", daemon=True)
+    sweeper.start()
+    return sweeper
@@ -0,0 +1,685 @@
+from everglen_web import app, client
+from everglen_metrics import llm_requests, llm_latency, llm_prompt_tokens, llm_completion_tokens, llm_retries, llm_errors, llm_fallbacks
+from everglen_routing import model_router, task_settings
+import asyncio
+import groq
+import logging
+from groq.types.chat import ChatCompletion
+from collections import OrderedDict
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locks on Windows; calls are still coalesced within each process
+    fcntl = None
+'''
+Gateway for every Groq chat completion made by the app.
+All call sites go through chat_completion() instead of calling client.chat.completions.create directly.
+
+The decisions of a call (cache keys and lookups, the order of models to try, what to retry and how long
+to back off) are made by the helpers below, which do no waiting of their own; the async gateway in
+everglen_asgi waits on them with await and shares everything else with this module.
+'''
+CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "256"))
+CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_MB", "64")) * 1024 * 1024
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(app.instance_path, "llm_cache.db"))
+# Budgets of the Groq key for each model, per process. Groq limits requests and tokens per minute separately
+# for every model; the defaults are the free plan's limits for most of the models in everglen_routing
+# (30 requests and 6,000 tokens a minute). Set the limits of your plan, per model where they differ, with
+# GROQ_REQUESTS_PER_MINUTE_<MODEL> / GROQ_TOKENS_PER_MINUTE_<MODEL>, e.g.
+# GROQ_TOKENS_PER_MINUTE_LLAMA_3_1_8B_INSTANT=20000. With several worker processes, divide them between the processes.
+GROQ_REQUESTS_PER_MINUTE = int(os.getenv("GROQ_REQUESTS_PER_MINUTE", "30"))
+GROQ_TOKENS_PER_MINUTE = int(os.getenv("GROQ_TOKENS_PER_MINUTE", "6000"))
+# Share of max_tokens reserved for a task's completions until some of them have been seen
+INITIAL_COMPLETION_SHARE = 0.5
+# Directory for the lock files that coalesce identical calls across worker processes; unset coalesces within each process only
+SINGLE_FLIGHT_LOCK_DIR = os.getenv("LLM_SINGLE_FLIGHT_LOCK_DIR")
+# How long a finished call's result stays available to the processes that were waiting for it
+SHARED_RESULT_SECONDS = 300
+# Lock files untouched for this long are removed
+LOCK_FILE_MAX_AGE_SECONDS = 3600
+# Retries for connection errors and 5xx responses; 429s are retried by the scheduler and do not count
+DEFAULT_MAX_RETRIES = 2
+# A key that keeps getting 429s (e.g. out of daily quota) fails after this many
+MAX_RATE_LIMIT_RETRIES = 10
+# 429s a model gets before the call moves on to the task's next model
+FALLBACK_RATE_LIMIT_RETRIES = 2
+# Error codes Groq sends for a model that is gone; the model is skipped for a long time instead of a short cooldown
+MODEL_GONE_CODES = ("model_decommissioned", "model_not_found")
+
+logger = logging.getLogger(__name__)
+
+# Lower numbers are sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+def completion_cache_key(**kwargs):
+    # Content-addressed: the model, the messages and every sampling parameter go into the hash
+    canonical = json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf8')).hexdigest()
+
+class CompletionCache:
+    '''
+    Two-tier cache of completion responses.
+    The first tier is an in-memory LRU of recent responses, the second is an SQLite file shared
+    by every worker process, with a TTL and a size cap (least recently used rows are evicted first).
+    '''
+    def __init__(self, path, memory_entries, ttl_seconds, max_bytes):
+        self.memory = OrderedDict()
+        self.memory_entries = memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+        # Results of recent calls, kept briefly for processes that waited on the same call (see shared_create)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS shared_results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, finished_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                expires_at, value = self.memory[key]
+                if expires_at > now:
+                    self.memory.move_to_end(key)
+                    return value
+                del self.memory[key]
+
+            row = self.connection.execute("SELECT value, created_at FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if created_at + self.ttl_seconds <= now:
+                self.connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.connection.commit()
+                return None
+            self.connection.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            self.remember(key, created_at + self.ttl_seconds, value)
+            return value
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.remember(key, now + self.ttl_seconds, value)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO completions (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now)
+            )
+            self.evict(now)
+            self.connection.commit()
+
+    def get_shared(self, key, since):
+        # Only a result finished after `since`, i.e. by a call that was in flight when the caller started waiting
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM shared_results WHERE key = ? AND finished_at >= ?", (key, since)).fetchone()
+            return row[0] if row is not None else None
+
+    def put_shared(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO shared_results (key, value, finished_at) VALUES (?, ?, ?)", (key, value, now))
+            self.connection.execute("DELETE FROM shared_results WHERE finished_at < ?", (now - SHARED_RESULT_SECONDS,))
+            self.connection.commit()
+
+    def remember(self, key, expires_at, value):
+        self.memory[key] = (expires_at, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def evict(self, now):
+        self.connection.execute("DELETE FROM completions WHERE created_at <= ?", (now - self.ttl_seconds,))
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop the least recently used rows until the file is back under the cap
+        for key, size in self.connection.execute("SELECT key, size FROM completions ORDER BY last_access ASC").fetchall():
+            self.connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+completion_cache = CompletionCache(CACHE_PATH, CACHE_MEMORY_ENTRIES, CACHE_TTL_SECONDS, CACHE_MAX_BYTES)
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    '''
+    Coalesces identical calls made at the same time by threads of this process.
+    The first caller of a key runs the call; callers that arrive while it is in flight wait for it
+    and get the same result, or the same exception. Nothing is kept once the call is done.
+    '''
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def run(self, key, function):
+        # Returns (result, True when the result came from another caller's call)
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = function()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result, False
+
+single_flight = SingleFlight()
+
+def shared_create(key, create):
+    '''
+    Coalesces identical calls across worker processes when SINGLE_FLIGHT_LOCK_DIR is set.
+    Each key has a lock file: the process holding it makes the call and stores the result,
+    and a process that was waiting for the lock takes that result instead of calling Groq again.
+    '''
+    if not shares_across_processes():
+        return create()
+    started = time.time()
+    with open(lock_file_path(key), "a") as lock_file:
+        lock(lock_file)
+        try:
+            shared = shared_result(key, started)
+            if shared is not None:
+                return shared
+            completion = create()
+            share_result(key, completion, lock_file)
+            return completion
+        finally:
+            unlock(lock_file)
+
+def shares_across_processes():
+    return bool(SINGLE_FLIGHT_LOCK_DIR) and fcntl is not None
+
+def lock_file_path(key):
+    os.makedirs(SINGLE_FLIGHT_LOCK_DIR, exist_ok=True)
+    return os.path.join(SINGLE_FLIGHT_LOCK_DIR, key + ".lock")
+
+def shared_result(key, started):
+    # The result of the same call made by another process while this one waited for the lock
+    shared = completion_cache.get_shared(key, started)
+    if shared is None:
+        return None
+    llm_requests.inc(model=json.loads(shared).get("model"), outcome="coalesced")
+    return ChatCompletion.model_validate_json(shared)
+
+def share_result(key, completion, lock_file):
+    completion_cache.put_shared(key, completion.model_dump_json())
+    os.utime(lock_file.fileno())
+
+def lock(lock_file):
+    # Blocks until no other process holds the lock
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+def unlock(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    remove_old_lock_files()
+
+lock_files_swept_at = 0.0
+
+def remove_old_lock_files():
+    # At most once a minute; a file removed while a process waits on it only costs one extra call
+    global lock_files_swept_at
+    now = time.time()
+    if now - lock_files_swept_at < 60:
+        return
+    lock_files_swept_at = now
+    for entry in os.scandir(SINGLE_FLIGHT_LOCK_DIR):
+        try:
+            if entry.name.endswith(".lock") and entry.stat().st_mtime < now - LOCK_FILE_MAX_AGE_SECONDS:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+def estimate_prompt_tokens(messages):
+    # About four characters per prompt token
+    prompt_characters = sum(len(str(message.get("content", ""))) for message in messages)
+    return prompt_characters // 4 + len(messages) * 4
+
+class CompletionEstimates:
+    '''
+    Completion tokens each task is expected to use, from a moving average of the completions seen so far.
+    A call reserves this rather than its whole max_tokens, which most completions never get near;
+    what it really used is settled with the scheduler when it finishes, streams included.
+    '''
+    def __init__(self):
+        self.averages = {}
+        self.lock = threading.Lock()
+
+    def expected(self, task, max_tokens):
+        if not max_tokens:
+            return 0
+        with self.lock:
+            average = self.averages.get(task)
+        return min(max_tokens, int(average if average is not None else max_tokens * INITIAL_COMPLETION_SHARE))
+
+    def observe(self, task, completion_tokens):
+        with self.lock:
+            average = self.averages.get(task)
+            self.averages[task] = completion_tokens if average is None else 0.8 * average + 0.2 * completion_tokens
+
+completion_estimates = CompletionEstimates()
+
+def estimate_tokens(messages, max_tokens, task=None):
+    # What a call is expected to cost against the tokens-per-minute budget: its prompt and its expected completion
+    return estimate_prompt_tokens(messages) + completion_estimates.expected(task, max_tokens)
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # Seconds until the bucket holds amount (never asks for more than the bucket can hold)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+def model_limits(model):
+    # (requests, tokens) per minute of one model, see GROQ_TOKENS_PER_MINUTE
+    suffix = re.sub("[^A-Z0-9]", "_", str(model).upper())
+    return (int(os.getenv("GROQ_REQUESTS_PER_MINUTE_" + suffix, GROQ_REQUESTS_PER_MINUTE)),
+            int(os.getenv("GROQ_TOKENS_PER_MINUTE_" + suffix, GROQ_TOKENS_PER_MINUTE)))
+
+class ModelBudget:
+    # The buckets of one model, and the calls waiting on them
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.waiting = []
+        self.paused_until = 0.0
+
+class RequestScheduler:
+    '''
+    Client-side scheduler for Groq calls.
+    Keeps a requests-per-minute and a tokens-per-minute bucket for every model, since Groq limits each model
+    on its own, and lets the calls to a model through one at a time, in priority order (then first come first
+    served), only when both of its buckets can pay for them. Calls to different models do not wait on each other.
+    A 429 from Groq pauses every call to that model until its retry-after has passed instead of each call
+    backing off on its own.
+    '''
+    def __init__(self, limits):
+        # model -> (requests per minute, tokens per minute)
+        self.limits = limits
+        self.budgets = {}
+        self.condition = threading.Condition()
+        self.tickets = itertools.count()
+        # ticket -> (event loop, asyncio.Event) of the coroutines waiting in acquire_async
+        self.async_waiters = {}
+
+    def budget(self, model):
+        # Called holding the condition
+        budget = self.budgets.get(model)
+        if budget is None:
+            budget = self.budgets[model] = ModelBudget(*self.limits(model))
+        return budget
+
+    def try_acquire(self, budget, ticket, estimated_tokens):
+        # Called holding the condition. Returns 0 when the call may go (and pays for it), otherwise the seconds
+        # to wait before trying again, or None when other calls are in front and it has to wait for them
+        now = time.monotonic()
+        budget.requests.refill(now)
+        budget.tokens.refill(now)
+        if budget.waiting[0] != ticket:
+            return None
+        wait = max(budget.paused_until - now, budget.requests.wait_time(1), budget.tokens.wait_time(estimated_tokens))
+        if wait > 0:
+            return wait
+        budget.requests.level -= 1
+        budget.tokens.level -= min(estimated_tokens, budget.tokens.capacity)
+        return 0
+
+    def leave(self, budget, ticket):
+        budget.waiting.remove(ticket)
+        heapq.heapify(budget.waiting)
+        self.notify(budget)
+
+    def notify(self, budget):
+        # Called holding the condition. Threads wait on the condition; of the coroutines only the one
+        # that is next in line for the model can go, so only that one is woken
+        self.condition.notify_all()
+        if budget.waiting and budget.waiting[0] in self.async_waiters:
+            loop, wakeup = self.async_waiters[budget.waiting[0]]
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def acquire(self, estimated_tokens, priority=PRIORITY_INTERACTIVE, model=None):
+        ticket = (priority, next(self.tickets))
+        with self.condition:
+            budget = self.budget(model)
+            heapq.heappush(budget.waiting, ticket)
+            try:
+                while True:
+                    wait = self.try_acquire(budget, ticket, estimated_tokens)
+                    if wait == 0:
+                        return
+                    self.condition.wait(wait)
+            finally:
+                self.leave(budget, ticket)
+
+    async def acquire_async(self, estimated_tokens, priority=PRIORITY_INTERACTIVE, model=None):
+        # Same queues and buckets as acquire, for coroutines: waits on an asyncio.Event instead of blocking a thread
+        ticket = (priority, next(self.tickets))
+        wakeup = asyncio.Event()
+        with self.condition:
+            budget = self.budget(model)
+            heapq.heappush(budget.waiting, ticket)
+            self.async_waiters[ticket] = (asyncio.get_running_loop(), wakeup)
+        try:
+            while True:
+                wakeup.clear()
+                with self.condition:
+                    wait = self.try_acquire(budget, ticket, estimated_tokens)
+                if wait == 0:
+                    return
+                try:
+                    await asyncio.wait_for(wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.condition:
+                del self.async_waiters[ticket]
+                self.leave(budget, ticket)
+
+    def settle(self, model, estimated_tokens, used_tokens):
+        # Gives back what was reserved but not used (or takes the difference when the estimate was too low)
+        with self.condition:
+            budget = self.budget(model)
+            tokens = budget.tokens
+            tokens.level = min(tokens.capacity, tokens.level + min(estimated_tokens, tokens.capacity) - used_tokens)
+            self.notify(budget)
+
+    def pause(self, model, seconds):
+        with self.condition:
+            budget = self.budget(model)
+            budget.paused_until = max(budget.paused_until, time.monotonic() + seconds)
+            self.notify(budget)
+
+scheduler = RequestScheduler(model_limits)
+
+def retry_after(error):
+    try:
+        return float(error.response.headers.get("retry-after", 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+def backoff_seconds(attempt):
+    # Exponential backoff with jitter for connection errors and 5xx responses
+    return min(8.0, 0.5 * 2 ** attempt) + random.random() / 4
+
+class CallRetries:
+    '''
+    Retry rules of one call to one model: 429s are retried after the pause Groq asks for (the scheduler holds
+    every call back meanwhile), connection errors and 5xx responses with exponential backoff, nothing else.
+    '''
+    def __init__(self, task, model, max_retries, rate_limit_retries):
+        self.task = task
+        self.model = model
+        self.max_retries = max_retries
+        self.rate_limit_retries = rate_limit_retries
+        self.attempt = 0
+        self.rate_limited = 0
+
+    def failed(self, error, started):
+        # Records a failed attempt; returns the seconds to wait before the next one, or None to give up
+        record_failure(self.model, error, started)
+        if isinstance(error, groq.RateLimitError) and self.rate_limited < self.rate_limit_retries:
+            self.rate_limited += 1
+            llm_retries.inc(model=self.model, reason="rate_limit")
+            scheduler.pause(self.model, retry_after(error))
+            return 0.0
+        if isinstance(error, (groq.APIConnectionError, groq.InternalServerError)) and self.attempt < self.max_retries:
+            self.attempt += 1
+            llm_retries.inc(model=self.model, reason=type(error).__name__)
+            return backoff_seconds(self.attempt)
+        llm_requests.inc(model=self.model, outcome="error")
+        record_give_up(self.task, self.model, error)
+        return None
+
+    def succeeded(self, stream, estimated_tokens, completion, started):
+        record_success(self.task, self.model, stream, estimated_tokens, completion, time.perf_counter() - started, self.attempt + self.rate_limited)
+
+class StreamUsage:
+    '''
+    Tokens used by a streamed completion, settled with the scheduler once the stream is done or dropped:
+    Groq's usage from the last chunk when it sends one, otherwise estimated from the text that came through.
+    '''
+    def __init__(self, task, model, messages, estimated_tokens):
+        self.task = task
+        self.model = model
+        self.prompt_tokens = estimate_prompt_tokens(messages)
+        self.estimated_tokens = estimated_tokens
+        self.characters = 0
+        self.usage = None
+        self.settled = False
+
+    def observe(self, chunk):
+        usage = chunk.usage or (chunk.x_groq.usage if chunk.x_groq is not None else None)
+        if usage is not None:
+            self.usage = usage
+        for choice in chunk.choices:
+            self.characters += len(choice.delta.content or "")
+
+    def settle(self):
+        if self.settled:
+            return
+        self.settled = True
+        if self.usage is not None:
+            prompt_tokens, completion_tokens = self.usage.prompt_tokens, self.usage.completion_tokens
+        else:
+            prompt_tokens, completion_tokens = self.prompt_tokens, self.characters // 4 + 1
+        scheduler.settle(self.model, self.estimated_tokens, prompt_tokens + completion_tokens)
+        completion_estimates.observe(self.task, completion_tokens)
+        llm_prompt_tokens.inc(prompt_tokens, model=self.model)
+        llm_completion_tokens.inc(completion_tokens, model=self.model)
+        logger.info("llm stream done model=%s prompt_tokens=%d completion_tokens=%d reported=%s",
+            self.model, prompt_tokens, completion_tokens, self.usage is not None)
+
+def settled_stream(stream, usage):
+    # Passes the chunks of a stream through, settling its tokens at the end
+    try:
+        for chunk in stream:
+            usage.observe(chunk)
+            yield chunk
+    finally:
+        usage.settle()
+
+def scheduled_create(priority, max_retries, task=None, rate_limit_retries=MAX_RATE_LIMIT_RETRIES, **kwargs):
+    # Sends one call through the scheduler, retrying it as CallRetries says
+    api = client.with_options(max_retries=0)
+    estimated_tokens = estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens"), task)
+    retries = CallRetries(task, kwargs.get("model"), max_retries, rate_limit_retries)
+    while True:
+        scheduler.acquire(estimated_tokens, priority, kwargs.get("model"))
+        started = time.perf_counter()
+        try:
+            completion = api.chat.completions.create(**kwargs)
+        except Exception as e:
+            wait = retries.failed(e, started)
+            if wait is None:
+                raise
+            time.sleep(wait)
+            continue
+        retries.succeeded(kwargs.get("stream"), estimated_tokens, completion, started)
+        if kwargs.get("stream"):
+            return settled_stream(completion, StreamUsage(task, kwargs.get("model"), kwargs.get("messages", []), estimated_tokens))
+        return completion
+
+def record_success(task, model, stream, estimated_tokens, completion, latency, retries):
+    llm_latency.observe(latency, model=model)
+    llm_requests.inc(model=model, outcome="ok")
+    if task is not None:
+        # Time to headers says little about a stream, so only whole completions are compared
+        model_router.record_success(task, model, None if stream else latency)
+    if not stream and completion.usage is not None:
+        scheduler.settle(model, estimated_tokens, completion.usage.total_tokens)
+        completion_estimates.observe(task, completion.usage.completion_tokens)
+        llm_prompt_tokens.inc(completion.usage.prompt_tokens, model=model)
+        llm_completion_tokens.inc(completion.usage.completion_tokens, model=model)
+        logger.info("llm call model=%s latency=%.3f prompt_tokens=%d completion_tokens=%d retries=%d",
+            model, latency, completion.usage.prompt_tokens, completion.usage.completion_tokens, retries)
+    else:
+        logger.info("llm stream model=%s latency_to_headers=%.3f retries=%d", model, latency, retries)
+
+def record_failure(model, error, started):
+    llm_latency.observe(time.perf_counter() - started, model=model)
+    llm_errors.inc(model=model, error=type(error).__name__)
+    logger.warning("llm call failed model=%s error=%s message=%s", model, type(error).__name__, error)
+
+def record_give_up(task, model, error):
+    # Once per call that failed for good, so the router counts calls rather than attempts
+    if task is None:
+        return
+    if isinstance(error, groq.NotFoundError) or model_error_code(error) in MODEL_GONE_CODES:
+        model_router.disable(model)
+        logger.warning("llm model unavailable, disabled model=%s code=%s", model, model_error_code(error))
+    elif isinstance(error, (groq.APIConnectionError, groq.InternalServerError, groq.RateLimitError)):
+        cooldown = model_router.record_failure(model)
+        if cooldown:
+            logger.warning("llm model out of rotation model=%s seconds=%.0f", model, cooldown)
+
+def model_error_code(error):
+    # Groq's error body is {"error": {"message": ..., "code": ...}}
+    body = getattr(error, "body", None)
+    body = body if isinstance(body, dict) else {}
+    details = body.get("error", body)
+    return details.get("code") if isinstance(details, dict) else None
+
+def chat_completion(cache=True, max_retries=None, priority=PRIORITY_INTERACTIVE, task=None, cache_if=None, **kwargs):
+    '''
+    Drop-in replacement for client.chat.completions.create.
+    Call sites pass a task (see everglen_routing) instead of a model: the task fills in the model,
+    max_tokens and temperature that are not given, and the call moves on to the task's next model
+    when one is failing or gone.
+    Analysis calls are answered from the cache when the exact same request was made before.
+    Creative calls with a high temperature should pass cache=False so every generation stays fresh.
+    Streaming calls are never cached, and with cache_if only answers whose content it accepts are
+    (structured outputs cache answers that validate, never the ones that need a repair).
+    Calls that do reach Groq go through the scheduler; background work should pass priority=PRIORITY_BACKGROUND
+    so it waits behind interactive generation.
+    '''
+    if max_retries is None:
+        max_retries = DEFAULT_MAX_RETRIES
+    routes = completion_routes(task, kwargs)
+    for index, (model, rate_limit_retries) in enumerate(routes):
+        try:
+            return model_completion(cache, max_retries, priority, task, rate_limit_retries, cache_if, model=model, **kwargs)
+        except Exception as e:
+            if not falls_back(task, routes, index, e):
+                raise
+
+# 400s also move on: a longer context or better JSON output from the next model may get through
+FALLBACK_ERRORS = (groq.NotFoundError, groq.BadRequestError, groq.APIConnectionError, groq.InternalServerError, groq.RateLimitError)
+
+def completion_routes(task, kwargs):
+    # (model, 429 retries) to try in order. Every model but the last gives up on 429s early, so the call moves on
+    if task is None:
+        return [(kwargs.pop("model", None), MAX_RATE_LIMIT_RETRIES)]
+    models = task_models(task, kwargs)
+    return [(model, MAX_RATE_LIMIT_RETRIES if index == len(models) - 1 else FALLBACK_RATE_LIMIT_RETRIES) for index, model in enumerate(models)]
+
+def falls_back(task, routes, index, error):
+    # Whether a call that failed on routes[index] moves on to the next model (and records that it does)
+    if index == len(routes) - 1 or not isinstance(error, FALLBACK_ERRORS):
+        return False
+    record_fallback(task, routes[index][0], routes[index + 1][0], error)
+    return True
+
+def task_models(task, kwargs):
+    # Fills in the task's max_tokens and temperature and returns the models to try, in order
+    settings = task_settings(task)
+    kwargs.setdefault("max_tokens", settings["max_tokens"])
+    kwargs.setdefault("temperature", settings["temperature"])
+    return [kwargs.pop("model")] if "model" in kwargs else model_router.route(task, settings["models"])
+
+def record_fallback(task, model, next_model, error):
+    reason = model_error_code(error) or type(error).__name__
+    llm_fallbacks.inc(task=task, model=model, reason=reason)
+    logger.warning("llm fallback task=%s model=%s next_model=%s reason=%s", task, model, next_model, reason)
+
+def model_completion(cache, max_retries, priority, task, rate_limit_retries, cache_if=None, **kwargs):
+    # One model: the cache first, then Groq through the scheduler, with identical calls in flight sent only once
+    if kwargs.get("stream"):
+        # A stream can only be read by one caller, so streams are never coalesced
+        return scheduled_create(priority, max_retries, task, rate_limit_retries, **kwargs)
+
+    key = completion_cache_key(**kwargs)
+    if cache:
+        cached = cached_completion(key, kwargs.get("model"), cache_if)
+        if cached is not None:
+            return cached
+
+    def create():
+        completion = shared_create(key, lambda: scheduled_create(priority, max_retries, task, rate_limit_retries, **kwargs))
+        if cache and cacheable(completion, cache_if):
+            cache_completion(key, completion)
+        return completion
+
+    completion, coalesced = single_flight.run(key, create)
+    if coalesced:
+        record_coalesced(key, kwargs.get("model"))
+    return completion
+
+def cacheable(completion, cache_if):
+    return cache_if is None or cache_if(completion.choices[0].message.content)
+
+def cached_completion(key, model, cache_if=None):
+    cached = completion_cache.get(key)
+    if cached is None:
+        return None
+    completion = ChatCompletion.model_validate_json(cached)
+    if not cacheable(completion, cache_if):
+        # Kept before cache_if was checked; the call is made again and a good answer replaces it
+        return None
+    llm_requests.inc(model=model, outcome="cache_hit")
+    logger.debug("llm cache hit model=%s key=%s", model, key)
+    return completion
+
+def cache_completion(key, completion):
+    completion_cache.put(key, completion.model_dump_json())
+
+def record_coalesced(key, model):
+    llm_requests.inc(model=model, outcome="coalesced")
+    logger.debug("llm call coalesced model=%s key=%s", model, key)
@@ -0,0 +1,106 @@
+import threading
+'''
+Minimal Prometheus metrics.
+Counters and histograms with labels, rendered in the Prometheus text exposition format by /metrics.
+Values are per process; scrape every worker process, or run a single one.
+'''
+# Seconds, from cached answers and SQL round trips up to long Groq completions
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# SQL queries per HTTP request
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+registry = []
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # label values -> [bucket counts, sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            series = self.values[key]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (bucket_counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    labels = format_labels(self.labels + ("le",), key + (format_value(bound),))
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = format_labels(self.labels, key)
+                lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+'''
+Metrics recorded by the app.
+'''
+llm_requests = Counter("everglen_llm_requests_total", "Chat completions by model and outcome (ok, error, cache_hit, coalesced).", ["model", "outcome"])
+llm_latency = Histogram("everglen_llm_request_seconds", "Latency of chat completion calls sent to Groq, per attempt.", ["model"])
+llm_prompt_tokens = Counter("everglen_llm_prompt_tokens_total", "Prompt tokens reported by completion.usage.", ["model"])
+llm_completion_tokens = Counter("everglen_llm_completion_tokens_total", "Completion tokens reported by completion.usage.", ["model"])
+llm_retries = Counter("everglen_llm_retries_total", "Retried chat completion calls by reason.", ["model", "reason"])
+llm_errors = Counter("everglen_llm_errors_total", "Failed chat completion attempts by error type.", ["model", "error"])
+llm_fallbacks = Counter("everglen_llm_fallbacks_total", "Calls moved on to the next model of their task, by the model that failed.", ["task", "model", "reason"])
+structured_outputs = Counter("everglen_structured_outputs_total", "JSON completions checked against their schema by task and outcome (valid, repaired, invalid).", ["task", "outcome"])
+http_latency = Histogram("everglen_http_request_seconds", "Latency of HTTP requests by route.", ["route", "method", "status"])
+http_sql_queries = Histogram("everglen_http_sql_queries", "SQL queries run per HTTP request.", ["route", "method"], buckets=COUNT_BUCKETS)
+response_cache_requests = Counter("everglen_response_cache_requests_total", "Requests to cached read routes by outcome (hit, miss, not_modified).", ["route", "outcome"])
+sql_queries = Counter("everglen_sql_queries_total", "SQL queries by route (background for work outside a request).", ["route"])
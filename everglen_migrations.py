@@ -0,0 +1,153 @@
+from sqlalchemy import event
+import logging
+import os
+'''
+Versioned schema migrations for the SQLite database.
+
+db.create_all() only creates missing tables; it never changes a table that already exists.
+Everything else (indexes, constraints, data fixes) goes in MIGRATIONS below. The version a database
+is at is kept in SQLite's PRAGMA user_version, and every migration above it is applied in order,
+each in its own transaction. Migrations must stay safe to run on a database that create_all() just made.
+To change the schema, append a new (version, description, function) entry; never edit an applied one.
+'''
+# Negative means KiB, so about 20 MB of page cache per connection
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-20000"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+logger = logging.getLogger(__name__)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers carry on while a story is being saved, and synchronous=NORMAL is safe with WAL
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+def configure_connections(engine):
+    # Must run before the engine opens its first connection
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", set_sqlite_pragmas)
+
+def index_foreign_keys(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_relationships_char_subject_id ON relationships (char_subject_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_relationships_char_object_id ON relationships (char_object_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_stories_series_id ON stories (series_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_story_characters_story_id ON story_characters (story_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_story_characters_char_id ON story_characters (char_id)")
+
+def unique_episode_numbers(cursor):
+    # Concurrent saves could give two stories the same episode number, so every series is renumbered
+    # in saving order before the constraint goes on (only series that actually have duplicates change)
+    duplicated = cursor.execute(
+        "SELECT DISTINCT series_id FROM stories GROUP BY series_id, episode_number HAVING COUNT(*) > 1"
+    ).fetchall()
+    for (series_id,) in duplicated:
+        story_ids = [row[0] for row in cursor.execute(
+            "SELECT id FROM stories WHERE series_id IS ? ORDER BY episode_number ASC, id ASC", (series_id,)
+        ).fetchall()]
+        for episode_number, story_id in enumerate(story_ids, start=1):
+            cursor.execute("UPDATE stories SET episode_number = ? WHERE id = ?", (episode_number, story_id))
+        logger.warning("renumbered episodes with duplicate numbers series_id=%s stories=%d", series_id, len(story_ids))
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_stories_series_episode ON stories (series_id, episode_number)")
+
+def index_jobs(cursor):
+    # resume_pending_jobs and the sweeper look jobs up by status
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status)")
+
+# External-content FTS5 tables: the text lives only in stories and characters, the index is kept in sync by triggers,
+# so every writer (routes, jobs, bulk import) is covered without any code of its own
+FTS_TABLES = {
+    "stories_fts": ("stories", ["story_title", "location", "plot", "full_story"]),
+    "characters_fts": ("characters", ["character_name", "character_personality", "high_school_clique", "cultural_background",
+                                      "current_job", "outfit", "additional_desc"]),
+}
+
+def full_text_search(cursor):
+    for fts_table, (table, columns) in FTS_TABLES.items():
+        column_list = ", ".join(columns)
+        new_values = ", ".join("new." + column for column in columns)
+        old_values = ", ".join("old." + column for column in columns)
+        cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5({column_list}, content='{table}', content_rowid='id', tokenize='porter unicode61')")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+                       f"INSERT INTO {fts_table} (rowid, {column_list}) VALUES (new.id, {new_values}); END")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+                       f"INSERT INTO {fts_table} ({fts_table}, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); END")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table} BEGIN "
+                       f"INSERT INTO {fts_table} ({fts_table}, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); "
+                       f"INSERT INTO {fts_table} (rowid, {column_list}) VALUES (new.id, {new_values}); END")
+        # Indexes the rows that were there before the table existed
+        cursor.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+
+def row_versions(cursor):
+    # Version counters for cached prompt fragments; create_all already added them to new databases
+    for table in ("characters", "relationships"):
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+        if "version" not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+# Tables whose writes bump the entity version read by everglen_response_cache
+VERSIONED_TABLES = ["characters", "relationships", "series", "stories"]
+
+def entity_versions(cursor):
+    # One counter per table, bumped by triggers like the full-text index, so every writer (routes, jobs, bulk import) is covered
+    cursor.execute("CREATE TABLE IF NOT EXISTS entity_versions (entity TEXT PRIMARY KEY, version INTEGER NOT NULL, updated_at INTEGER NOT NULL)")
+    for table in VERSIONED_TABLES:
+        cursor.execute("INSERT OR IGNORE INTO entity_versions (entity, version, updated_at) VALUES (?, 1, CAST(strftime('%s', 'now') AS INTEGER))", (table,))
+        for operation in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_version_{operation.lower()} AFTER {operation} ON {table} BEGIN "
+                           f"UPDATE entity_versions SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE entity = '{table}'; END")
+
+def accumulated_digests(cursor):
+    # Stored consolidated digests for the plot-hole analysis; create_all already added them to new databases
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(episode_analysis)").fetchall()]
+    if "accumulated_digest" not in columns:
+        cursor.execute("ALTER TABLE episode_analysis ADD COLUMN accumulated_digest TEXT")
+    if "accumulated_hash" not in columns:
+        cursor.execute("ALTER TABLE episode_analysis ADD COLUMN accumulated_hash VARCHAR(64)")
+
+MIGRATIONS = [
+    (1, "index foreign keys", index_foreign_keys),
+    (2, "unique episode numbers per series", unique_episode_numbers),
+    (3, "index jobs by status", index_jobs),
+    (4, "full-text search", full_text_search),
+    (5, "row versions of characters and relationships", row_versions),
+    (6, "entity versions for conditional GET", entity_versions),
+    (7, "accumulated digests of the plot-hole analysis", accumulated_digests),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def migrate(engine):
+    '''
+    Brings the database up to SCHEMA_VERSION. BEGIN IMMEDIATE takes the write lock before the version is read,
+    so when several worker processes start at once only the first one applies the migrations.
+    '''
+    connection = engine.raw_connection()
+    try:
+        dbapi_connection = connection.driver_connection
+        isolation_level = dbapi_connection.isolation_level
+        # Transactions are managed by hand below
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        try:
+            for version, description, function in MIGRATIONS:
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    current_version = cursor.execute("PRAGMA user_version").fetchone()[0]
+                    if current_version >= version:
+                        cursor.execute("ROLLBACK")
+                        continue
+                    function(cursor)
+                    cursor.execute(f"PRAGMA user_version = {int(version)}")
+                    cursor.execute("COMMIT")
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+                logger.info("migration applied version=%d description=%s", version, description)
+        finally:
+            cursor.close()
+            dbapi_connection.isolation_level = isolation_level
+    finally:
+        connection.close()
@@ -1,7 +1,9 @@
 from everglen_web import db
 from sqlalchemy import func, select
-from pydantic import BaseModel, Field
-from typing import List, Optional, Union
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import Dict, List, Optional, Union
+from datetime import datetime
+import json
 '''
 Classes used by the Groq AI
 '''
@@ -20,10 +22,14 @@ class Character(BaseModel):
     current_job: Optional[str] = Field(None, description="The current job if the character is an adult")
     outfit: Optional[str] = Field(None, description="The character's trademark attire or piece of clothing that they are rarely seen without")
     additional_desc: Optional[str] = Field(None, description="Additional description that does not fit in the other attributes")
+    # Serialized prompt text, filled in by everglen_prompts
+    _prompt_fragments: dict = PrivateAttr(default_factory=dict)
 
 class Relationship(BaseModel):
     characters: List[Character]
     relation: str
+    # Serialized prompt text, filled in by everglen_prompts
+    _prompt_fragments: dict = PrivateAttr(default_factory=dict)
     
     class Config:
         arbitrary_types_allowed = True
@@ -38,6 +44,35 @@ class Story(BaseModel):
 
     class Config:
         arbitrary_types_allowed = True
+
+
+'''
+Output schemas of the JSON completions, checked by everglen_structured
+'''
+class Scene(BaseModel):
+    title: Optional[str] = None
+    summary: str
+
+class StoryPlot(BaseModel):
+    # What generate_story returns
+    title: str
+    characters: List[str] = Field(default_factory=list)
+    plot: str
+    scenes: Optional[List[Scene]] = None
+
+class ExtractedCharacters(BaseModel):
+    characters: List[Character]
+
+class BibleUpdate(BaseModel):
+    summary: str
+    character_states: Dict[str, str] = Field(default_factory=dict)
+    open_threads: List[str] = Field(default_factory=list)
+
+class EpisodeFacts(BaseModel):
+    facts: List[str] = Field(default_factory=list)
+
+class EpisodePlotHoles(BaseModel):
+    plot_holes: List[str] = Field(default_factory=list)
         
 
 '''
@@ -69,9 +104,12 @@ class StoryDB(db.Model):
     location = db.Column(db.String(150), nullable=False,  unique=False)
     plot = db.Column(db.Text, nullable=False,  unique=False)
     full_story = db.Column(db.Text, nullable=False,  unique=False)
-    series_id = db.Column(db.Integer, db.ForeignKey(SeriesDB.id))
+    series_id = db.Column(db.Integer, db.ForeignKey(SeriesDB.id), index=True)
     series = db.relationship('SeriesDB', foreign_keys='StoryDB.series_id')
     
+    # Same names as in everglen_migrations, which adds these to databases made before them
+    __table_args__ = (db.Index('uq_stories_series_episode', 'series_id', 'episode_number', unique=True),)
+    
     def getAIModel(self):
         pass
     
@@ -89,6 +127,10 @@ class CharacterDB(db.Model):
     current_job = db.Column(db.String(150), nullable=True,  unique=False)
     outfit = db.Column(db.Text, nullable=True, unique=False)
     additional_desc = db.Column(db.Text, nullable=True, unique=False)
+    # Goes up on every update; cached prompt fragments are keyed by it
+    version = db.Column(db.Integer, nullable=False, unique=False, default=1, server_default='1')
+    
+    __mapper_args__ = {"version_id_col": version}
     
     def getAIModel(self):
         # Create the Character object
@@ -123,18 +165,20 @@ class RelationshipDB(db.Model):
     __tablename__ = 'relationships'
     
     id = db.Column(db.Integer, nullable=False, unique=True, primary_key=True)
-    char_subject_id = db.Column(db.Integer, db.ForeignKey(CharacterDB.id))
+    char_subject_id = db.Column(db.Integer, db.ForeignKey(CharacterDB.id), index=True)
     char_subject = db.relationship('CharacterDB', foreign_keys='RelationshipDB.char_subject_id')
-    char_object_id = db.Column(db.Integer, db.ForeignKey(CharacterDB.id))
+    char_object_id = db.Column(db.Integer, db.ForeignKey(CharacterDB.id), index=True)
     char_object = db.relationship('CharacterDB', foreign_keys='RelationshipDB.char_object_id')
     relation = db.Column(db.String(150), nullable=False,  unique=False)
+    # Goes up on every update; cached prompt fragments are keyed by it
+    version = db.Column(db.Integer, nullable=False, unique=False, default=1, server_default='1')
+    
+    __mapper_args__ = {"version_id_col": version}
     
     def getAIModel(self):
-        subjectCharacter = CharacterDB.query.filter_by(id=self.char_subject_id).first()
-        objectCharacter = CharacterDB.query.filter_by(id=self.char_object_id).first()
-        
+        # Uses the mapped relationships, so eager-loaded characters cost no extra queries
         relationshipAImodel = Relationship(
-            characters = [subjectCharacter.getAIModel(), objectCharacter.getAIModel()],
+            characters = [self.char_subject.getAIModel(), self.char_object.getAIModel()],
             relation = self.relation
         )
         
@@ -162,10 +206,95 @@ class StoryCharactersDB(db.Model):
     __tablename__ = 'story_characters'
     
     id = db.Column(db.Integer, nullable=False, unique=True, primary_key=True)
-    story_id = db.Column(db.Integer, db.ForeignKey(StoryDB.id))
+    story_id = db.Column(db.Integer, db.ForeignKey(StoryDB.id), index=True)
     story = db.relationship('StoryDB', foreign_keys='StoryCharactersDB.story_id')
-    char_id = db.Column(db.Integer, db.ForeignKey(CharacterDB.id))
+    char_id = db.Column(db.Integer, db.ForeignKey(CharacterDB.id), index=True)
     char = db.relationship('CharacterDB', foreign_keys='StoryCharactersDB.char_id')
     
     def getAIModel(self):
-        pass
\ No newline at end of file
+        pass
+        
+class JobDB(db.Model):
+    __tablename__ = 'jobs'
+    
+    id = db.Column(db.String(32), nullable=False, unique=True, primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False, unique=False)
+    status = db.Column(db.String(20), nullable=False, unique=False, default='queued', index=True)
+    current_stage = db.Column(db.String(50), nullable=True, unique=False)
+    # JSON list of {"stage", "status", "started_at", "finished_at"}, one entry per pipeline stage
+    progress = db.Column(db.Text, nullable=False, unique=False, default='[]')
+    # JSON dict of stage name -> stage output, so a resumed job can skip the stages it already finished
+    stage_results = db.Column(db.Text, nullable=False, unique=False, default='{}')
+    payload = db.Column(db.Text, nullable=False, unique=False)
+    result = db.Column(db.Text, nullable=True, unique=False)
+    error = db.Column(db.Text, nullable=True, unique=False)
+    created_at = db.Column(db.DateTime, nullable=False, unique=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, unique=False, default=datetime.utcnow)
+    lease_expires_at = db.Column(db.DateTime, nullable=True, unique=False)
+    
+    def __json__(self):
+        jsonJob = {
+            "job_id": self.id,
+            "job_type": self.job_type,
+            "status": self.status,
+            "current_stage": self.current_stage,
+            "progress": json.loads(self.progress),
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat()
+        }
+        
+        return jsonJob
+        
+        
+class EpisodeAnalysisDB(db.Model):
+    __tablename__ = 'episode_analysis'
+    
+    story_id = db.Column(db.Integer, db.ForeignKey(StoryDB.id), nullable=False, unique=True, primary_key=True)
+    story = db.relationship('StoryDB', foreign_keys='EpisodeAnalysisDB.story_id')
+    # Hash of the episode text the digest was made from
+    content_hash = db.Column(db.String(64), nullable=False, unique=False)
+    # JSON list of the facts the episode establishes
+    digest = db.Column(db.Text, nullable=False, unique=False)
+    # Hash of the accumulated digest of the earlier episodes the plot holes were checked against
+    context_hash = db.Column(db.String(64), nullable=True, unique=False)
+    # JSON list of the facts of this and every earlier episode, consolidated when it grew too long;
+    # the context the next episode is checked against
+    accumulated_digest = db.Column(db.Text, nullable=True, unique=False)
+    # Hash of what accumulated_digest was made from: the previous episode's accumulated digest and this digest
+    accumulated_hash = db.Column(db.String(64), nullable=True, unique=False)
+    # JSON list of plot holes found in this episode
+    plot_holes = db.Column(db.Text, nullable=True, unique=False)
+    analyzed_at = db.Column(db.DateTime, nullable=False, unique=False, default=datetime.utcnow)
+        
+        
+class SeriesBibleDB(db.Model):
+    __tablename__ = 'series_bible'
+    
+    series_id = db.Column(db.Integer, db.ForeignKey(SeriesDB.id), nullable=False, unique=True, primary_key=True)
+    series = db.relationship('SeriesDB', foreign_keys='SeriesBibleDB.series_id')
+    # Running summary of everything that happened in the series so far
+    summary = db.Column(db.Text, nullable=False, unique=False, default='')
+    # JSON dict of character name -> where that character currently stands
+    character_states = db.Column(db.Text, nullable=False, unique=False, default='{}')
+    # JSON list of storylines that are still unresolved
+    open_threads = db.Column(db.Text, nullable=False, unique=False, default='[]')
+    # Highest episode number folded into the bible
+    last_episode_number = db.Column(db.Integer, nullable=False, unique=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, unique=False, default=datetime.utcnow)
+    # Two workers updating the same bible cannot both commit
+    version = db.Column(db.Integer, nullable=False, unique=False, default=1)
+    
+    __mapper_args__ = {"version_id_col": version}
+    
+    def __json__(self):
+        jsonBible = {
+            "series_id": self.series_id,
+            "summary": self.summary,
+            "character_states": json.loads(self.character_states),
+            "open_threads": json.loads(self.open_threads),
+            "last_episode_number": self.last_episode_number,
+            "updated_at": self.updated_at.isoformat()
+        }
+        
+        return jsonBible
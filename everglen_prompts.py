@@ -0,0 +1,80 @@
+from everglen_models import Character, Relationship
+from collections import OrderedDict
+import json
+import os
+import threading
+from typing import List
+'''
+Cached prompt fragments for characters and relationships.
+
+The Character and Relationship models of each row are cached under the row's id and version
+(the version goes up on every ORM update, see __mapper_args__ in everglen_models), so an unchanged
+row always gives back the same model object. Each model remembers the strings it was serialized to,
+so assembling a prompt for a large cast is a join of strings that were already built.
+The edit routes also drop the cached entry straight away.
+'''
+PROMPT_FRAGMENT_CACHE_ENTRIES = int(os.getenv("PROMPT_FRAGMENT_CACHE_ENTRIES", "4096"))
+
+class PromptFragmentCache:
+    def __init__(self, max_entries):
+        # (kind, row id) -> (version key, model)
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    def get(self, kind, row_id, version_key, build):
+        with self.lock:
+            entry = self.entries.get((kind, row_id))
+            if entry is not None and entry[0] == version_key:
+                self.entries.move_to_end((kind, row_id))
+                return entry[1]
+        model = build()
+        with self.lock:
+            self.entries[(kind, row_id)] = (version_key, model)
+            self.entries.move_to_end((kind, row_id))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return model
+
+    def invalidate(self, kind, row_id):
+        with self.lock:
+            self.entries.pop((kind, int(row_id)), None)
+
+prompt_fragments = PromptFragmentCache(PROMPT_FRAGMENT_CACHE_ENTRIES)
+
+def character_model(character_db) -> Character:
+    return prompt_fragments.get("character", character_db.id, character_db.version, character_db.getAIModel)
+
+def relationship_model(relation_id, version, subject_db, object_db, relation: str) -> Relationship:
+    # The versions of both characters are part of the key, so editing either of them gives the relationship a new entry too
+    version_key = (version, subject_db.id, subject_db.version, object_db.id, object_db.version)
+    return prompt_fragments.get("relationship", relation_id, version_key,
+        lambda: Relationship(characters=[character_model(subject_db), character_model(object_db)], relation=relation))
+
+def fragment(model, name, build):
+    # Built once per model object; cached models are shared, so later prompts reuse the string
+    fragments = model._prompt_fragments
+    if name not in fragments:
+        fragments[name] = build(model)
+    return fragments[name]
+
+def character_text(char: Character) -> str:
+    # The description of a character used by generate_story
+    return fragment(char, "text", lambda char: f"{char.name} (gender: {char.gender}, age: {char.age}, personality: {char.personality}, high_school_clique: {char.high_school_clique}, cultural_background: {char.cultural_background}, native_languages: {char.native_languages}, current_job: {char.current_job}, outfit: {char.outfit}, additional_desc: {char.additional_desc})")
+
+def character_json(char: Character) -> str:
+    return fragment(char, "json", lambda char: json.dumps(char.dict()))
+
+def relationship_text(rel: Relationship) -> str:
+    return fragment(rel, "text", lambda rel: f"{rel.dict()}")
+
+def relationship_json(rel: Relationship) -> str:
+    return fragment(rel, "json", lambda rel: json.dumps(rel.dict()))
+
+def characters_prompt_json(characters: List) -> str:
+    # Same text as json.dumps([char.dict() for char in characters])
+    return "[" + ", ".join(character_json(char) for char in characters) + "]"
+
+def relationships_prompt_json(relationships: List) -> str:
+    # Same text as json.dumps({'relationships': [rel.dict() for rel in relationships]})
+    return '{"relationships": [' + ", ".join(relationship_json(rel) for rel in relationships) + "]}"
@@ -0,0 +1,115 @@
+from everglen_web import db
+from everglen_metrics import response_cache_requests
+from flask import Response, make_response, request
+from sqlalchemy import text
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+import hashlib
+import os
+import threading
+'''
+Conditional GET and server-side caching for the read routes.
+
+Every write to the characters, relationships, series and stories tables bumps that table's counter in
+entity_versions (triggers set up by everglen_migrations). A cached route names the tables it reads;
+its ETag is made from their counters, and its Last-Modified is the time of the latest of those writes.
+A request whose If-None-Match still matches gets a 304 without running the route, and a request
+without one gets the serialized body kept from the last time the route ran at the same versions.
+Either way, the only query is one read of entity_versions.
+
+The counters live in the database, so writes from job workers, bulk imports and other processes
+invalidate cached bodies as well.
+'''
+RESPONSE_CACHE_ENTRIES = int(os.getenv("RESPONSE_CACHE_ENTRIES", "256"))
+# Total size of the cached bodies; listings with full stories can be large
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+ENTITY_VERSIONS = text("SELECT entity, version, updated_at FROM entity_versions")
+
+class ResponseCache:
+    def __init__(self, max_entries, max_bytes):
+        # URL -> (etag, body, content type, last modified)
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, url, etag):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            if entry[0] != etag:
+                # Written to since; the body is rebuilt by this request
+                self.drop(url)
+                return None
+            self.entries.move_to_end(url)
+            return entry
+
+    def put(self, url, etag, body, content_type, last_modified):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if url in self.entries:
+                self.drop(url)
+            self.entries[url] = (etag, body, content_type, last_modified)
+            self.size += len(body)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+
+    def drop(self, url):
+        self.size -= len(self.entries.pop(url)[1])
+
+response_cache = ResponseCache(RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+
+def entity_validators(entities):
+    # (ETag, Last-Modified) of the current state of the given tables
+    versions = {row.entity: (row.version, row.updated_at) for row in db.session.execute(ENTITY_VERSIONS)}
+    state = [(entity,) + versions.get(entity, (0, 0)) for entity in entities]
+    # The write times go in too, so a recreated database does not reuse the ETags of the old one
+    etag = hashlib.sha1(repr(state).encode()).hexdigest()[:20]
+    last_modified = datetime.fromtimestamp(max(updated_at for _, _, updated_at in state), tz=timezone.utc)
+    return etag, last_modified
+
+def with_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Browsers may keep the body but have to check the ETag before every use
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def cached_response(*entities):
+    '''
+    Decorator for GET routes whose JSON depends only on the URL and the given tables,
+    e.g. @cached_response("characters", "relationships"). Only 200 responses are cached.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            route = request.url_rule.rule
+            etag, last_modified = entity_validators(entities)
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+            if not_modified:
+                response_cache_requests.inc(route=route, outcome="not_modified")
+                return with_validators(Response(status=304), etag, last_modified)
+
+            url = request.full_path
+            entry = response_cache.get(url, etag)
+            if entry is not None:
+                response_cache_requests.inc(route=route, outcome="hit")
+                return with_validators(Response(entry[1], content_type=entry[2]), etag, last_modified)
+
+            response_cache_requests.inc(route=route, outcome="miss")
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            # Versions read before the route ran, so a write racing it only makes the next request miss
+            response_cache.put(url, etag, response.get_data(), response.content_type, last_modified)
+            return with_validators(response, etag, last_modified)
+        return wrapper
+    return decorator
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+'''
+Model registry and router for chat completions, keyed by task.
+
+Every call site names its task instead of a model. The task gives the default max_tokens and
+temperature and an ordered list of models: the first one is preferred, the rest are fallbacks tried
+when it fails. The router reorders that list from what it has measured, so a model that keeps failing
+(overloaded, decommissioned) is taken out of rotation for a while and a model that has become much slower
+than the others for the task is only tried after them.
+
+The models of a task can be changed without a code change with LLM_MODELS_<TASK>, e.g.
+    LLM_MODELS_TITLE=llama-3.1-8b-instant,mixtral-8x7b-32768
+'''
+# Small, fast models for short extraction answers; the 8192-token models are tried after the 128k ones
+# so a long story fails over to a model with a bigger context instead of being cut off
+FAST_MODELS = ["llama-3.1-8b-instant", "mixtral-8x7b-32768", "llama3-8b-8192"]
+LARGE_MODELS = ["mixtral-8x7b-32768", "llama-3.1-70b-versatile", "llama3-70b-8192"]
+
+TASKS = {
+    # generate_story
+    "plot": {"models": LARGE_MODELS, "max_tokens": 1024, "temperature": 1},
+    # generate_detailed_scene
+    "scene": {"models": LARGE_MODELS, "max_tokens": 1024, "temperature": 0.7},
+    # the humanizer
+    "rewrite": {"models": LARGE_MODELS, "max_tokens": 1024, "temperature": 0.8},
+    "title": {"models": FAST_MODELS, "max_tokens": 64, "temperature": 0.8},
+    "location": {"models": FAST_MODELS, "max_tokens": 32, "temperature": 0.2},
+    # characters and plot summaries taken out of a story
+    "extraction": {"models": FAST_MODELS, "max_tokens": 1024, "temperature": 0.8},
+    # plot holes, episode digests and the series bible
+    "continuity": {"models": LARGE_MODELS, "max_tokens": 1024, "temperature": 0.2},
+    # fixes the fields of a JSON answer that did not match its schema, see everglen_structured
+    "repair": {"models": FAST_MODELS, "max_tokens": 512, "temperature": 0},
+}
+
+# Consecutive failures that take a model out of rotation, and for how long at first (doubled on every repeat)
+CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "3"))
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("LLM_CIRCUIT_COOLDOWN_SECONDS", "30"))
+CIRCUIT_MAX_COOLDOWN_SECONDS = 600.0
+# A model Groq reports as decommissioned or unknown is not tried again for this long
+MODEL_DISABLED_SECONDS = float(os.getenv("LLM_MODEL_DISABLED_SECONDS", "3600"))
+# Error rate over recent calls above which a model is taken out of rotation, once it has this many calls
+MAX_ERROR_RATE = float(os.getenv("LLM_MAX_ERROR_RATE", "0.5"))
+MIN_CALLS_FOR_ERROR_RATE = 10
+# A model this many times slower than the fastest one measured for a task goes after it
+SLOW_FACTOR = float(os.getenv("LLM_SLOW_FACTOR", "3"))
+# Latency measurements older than this are ignored, so a model demoted for being slow gets measured again
+LATENCY_TTL_SECONDS = 300.0
+# Weight of the newest call in the moving averages
+EWMA_ALPHA = 0.2
+
+def task_settings(task):
+    if task not in TASKS:
+        raise ValueError(f"Unknown completion task {task}")
+    settings = dict(TASKS[task])
+    override = os.getenv("LLM_MODELS_" + task.upper())
+    if override:
+        settings["models"] = [model.strip() for model in override.split(",") if model.strip()]
+    return settings
+
+class ModelHealth:
+    def __init__(self):
+        self.calls = 0
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.cooldown = CIRCUIT_COOLDOWN_SECONDS
+        self.unavailable_until = 0.0
+
+class ModelRouter:
+    def __init__(self):
+        # model -> ModelHealth; errors are per model because an overloaded model fails every task
+        self.health = {}
+        # (task, model) -> (moving average of seconds per call, when it was last measured)
+        self.latency = {}
+        self.lock = threading.Lock()
+
+    def model_health(self, model):
+        if model not in self.health:
+            self.health[model] = ModelHealth()
+        return self.health[model]
+
+    def route(self, task, models):
+        '''
+        Orders the models of a task for one call: available models in their configured order,
+        then available models that are much slower than the fastest, then models out of rotation,
+        soonest available first. Nothing is ever dropped, so a call still has somewhere to go when
+        every model is failing.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            available = []
+            resting = []
+            for model in models:
+                health = self.model_health(model)
+                if health.unavailable_until > now:
+                    resting.append(model)
+                else:
+                    available.append(model)
+            latencies = {}
+            for model in available:
+                measured = self.latency.get((task, model))
+                if measured is not None and now - measured[1] <= LATENCY_TTL_SECONDS:
+                    latencies[model] = measured[0]
+            fastest = min(latencies.values()) if latencies else None
+            fast = [model for model in available if fastest is None or latencies.get(model, fastest) <= fastest * SLOW_FACTOR]
+            slow = [model for model in available if model not in fast]
+            resting.sort(key=lambda model: self.health[model].unavailable_until)
+            return fast + slow + resting
+
+    def record_success(self, task, model, seconds=None):
+        with self.lock:
+            health = self.model_health(model)
+            health.calls += 1
+            health.error_rate *= 1 - EWMA_ALPHA
+            health.consecutive_failures = 0
+            health.cooldown = CIRCUIT_COOLDOWN_SECONDS
+            if seconds is not None:
+                measured = self.latency.get((task, model))
+                average = seconds if measured is None else measured[0] + EWMA_ALPHA * (seconds - measured[0])
+                self.latency[(task, model)] = (average, time.monotonic())
+
+    def record_failure(self, model):
+        # Returns the seconds the model is out of rotation for, 0 when it stays in
+        with self.lock:
+            health = self.model_health(model)
+            health.calls += 1
+            health.error_rate += EWMA_ALPHA * (1 - health.error_rate)
+            health.consecutive_failures += 1
+            failing = health.consecutive_failures >= CIRCUIT_FAILURES
+            erroring = health.calls >= MIN_CALLS_FOR_ERROR_RATE and health.error_rate > MAX_ERROR_RATE
+            if not (failing or erroring):
+                return 0
+            cooldown = health.cooldown
+            health.unavailable_until = time.monotonic() + cooldown
+            health.cooldown = min(cooldown * 2, CIRCUIT_MAX_COOLDOWN_SECONDS)
+            # The next failure after the cooldown opens the circuit again straight away
+            health.consecutive_failures = CIRCUIT_FAILURES - 1
+            return cooldown
+
+    def disable(self, model):
+        with self.lock:
+            self.model_health(model).unavailable_until = time.monotonic() + MODEL_DISABLED_SECONDS
+
+model_router = ModelRouter()
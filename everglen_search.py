@@ -0,0 +1,85 @@
+from everglen_web import db
+from sqlalchemy import text
+import html
+import re
+'''
+Full-text search over stories and characters, backed by the FTS5 tables that everglen_migrations creates.
+Results are ranked with bm25 (matches in titles and names weigh more than matches in the body text)
+and come with a short snippet around the best match.
+'''
+SEARCH_KINDS = ("stories", "characters")
+SNIPPET_TOKENS = 16
+# Marks the matched words in snippets; swapped for <mark> tags after the rest of the snippet is HTML-escaped
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+# bm25 weights, in the column order of FTS_TABLES in everglen_migrations
+STORY_WEIGHTS = "10.0, 3.0, 2.0, 1.0"
+CHARACTER_WEIGHTS = "10.0, 2.0, 2.0, 1.0, 1.0, 1.0, 1.0"
+
+STORY_SEARCH = text(f"""
+    SELECT stories.id, stories.series_id, stories.episode_number, stories.story_title, stories.location,
+           snippet(stories_fts, -1, '{MATCH_START}', '{MATCH_END}', '...', {SNIPPET_TOKENS}) AS snippet,
+           bm25(stories_fts, {STORY_WEIGHTS}) AS rank
+    FROM stories_fts JOIN stories ON stories.id = stories_fts.rowid
+    WHERE stories_fts MATCH :query
+    ORDER BY rank
+    LIMIT :limit OFFSET :offset
+""")
+CHARACTER_SEARCH = text(f"""
+    SELECT characters.id, characters.character_name, characters.character_age, characters.character_gender,
+           snippet(characters_fts, -1, '{MATCH_START}', '{MATCH_END}', '...', {SNIPPET_TOKENS}) AS snippet,
+           bm25(characters_fts, {CHARACTER_WEIGHTS}) AS rank
+    FROM characters_fts JOIN characters ON characters.id = characters_fts.rowid
+    WHERE characters_fts MATCH :query
+    ORDER BY rank
+    LIMIT :limit OFFSET :offset
+""")
+STORY_COUNT = text("SELECT COUNT(*) FROM stories_fts WHERE stories_fts MATCH :query")
+CHARACTER_COUNT = text("SELECT COUNT(*) FROM characters_fts WHERE characters_fts MATCH :query")
+
+def fts_query(query: str) -> str:
+    '''
+    Turns free text into an FTS5 query that cannot be a syntax error: every word is quoted and all of them
+    have to match, and the last word also matches as a prefix so results show up while the user is typing.
+    Returns an empty string when there is nothing to search for.
+    '''
+    words = re.findall(r"\w+", query)
+    if not words:
+        return ""
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def format_snippet(snippet: str) -> str:
+    return html.escape(snippet or "").replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
+
+def search(query: str, kind: str, limit: int, offset: int) -> dict:
+    match = fts_query(query)
+    if not match:
+        return {"results": [], "total": 0}
+    parameters = {"query": match, "limit": limit, "offset": offset}
+    if kind == "stories":
+        rows = db.session.execute(STORY_SEARCH, parameters).all()
+        total = db.session.execute(STORY_COUNT, parameters).scalar()
+        results = [{
+            "story_id": row.id,
+            "series_id": row.series_id,
+            "episode_number": row.episode_number,
+            "story_title": row.story_title,
+            "location": row.location,
+            "snippet": format_snippet(row.snippet),
+            "score": -row.rank
+        } for row in rows]
+    else:
+        rows = db.session.execute(CHARACTER_SEARCH, parameters).all()
+        total = db.session.execute(CHARACTER_COUNT, parameters).scalar()
+        results = [{
+            "character_id": row.id,
+            "character_name": row.character_name,
+            "character_age": row.character_age,
+            "character_gender": row.character_gender,
+            "snippet": format_snippet(row.snippet),
+            "score": -row.rank
+        } for row in rows]
+    return {"results": results, "total": total}
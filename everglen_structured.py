@@ -0,0 +1,208 @@
+from everglen_llm import chat_completion, PRIORITY_INTERACTIVE
+from everglen_metrics import structured_outputs
+from everglen_routing import task_settings
+from everglen_chunking import estimate_text_tokens
+from pydantic import ValidationError
+from functools import lru_cache
+import json
+import logging
+import os
+'''
+Structured outputs: JSON completions checked against a pydantic model.
+
+An answer that does not match its model is not generated again. Only the parts that failed are sent
+to a small model, with their validation errors, and the fixed parts are merged back into the answer:
+a repair costs a few hundred tokens where a new generation would cost the whole completion again.
+A part is a single list item ("characters.3") when the error is inside one, otherwise a top-level field.
+An answer that is not a JSON object at all is rewritten whole by the same small model.
+Only answers that validate as they come are cached; repairs never are, so a bad answer is not replayed.
+
+Callers get the validated model, or a StructuredOutputError listing what is still wrong after the repair.
+Errors from Groq itself are raised unchanged.
+'''
+# Repair calls made for one answer before giving up
+STRUCTURED_REPAIR_ATTEMPTS = int(os.getenv("STRUCTURED_REPAIR_ATTEMPTS", "1"))
+# Characters of the valid part of an answer sent along with a repair, as context
+REPAIR_CONTEXT_CHARS = 4000
+
+logger = logging.getLogger(__name__)
+
+class StructuredOutputError(Exception):
+    def __init__(self, task, errors, content):
+        super().__init__(f"{task} output does not match its schema: " + "; ".join(f"{error['field'] or 'output'}: {error['error']}" for error in errors))
+        self.task = task
+        # [{"field": "scenes.0.summary", "error": "Field required"}], field is empty for the answer as a whole
+        self.errors = errors
+        self.content = content
+
+def validation_errors(error: ValidationError) -> list:
+    return [{"field": ".".join(str(part) for part in detail['loc']), "error": detail['msg']} for detail in error.errors()]
+
+def check_document(output_model, document):
+    # (validated output, None), or (None, (document, errors)); document is None when the answer is not a JSON object
+    if not isinstance(document, dict):
+        return None, (None, [{"field": "", "error": "Expected a JSON object"}])
+    try:
+        return output_model.model_validate(document), None
+    except ValidationError as e:
+        return None, (document, validation_errors(e))
+
+def check_output(output_model, content):
+    try:
+        document = json.loads(content)
+    except (TypeError, json.JSONDecodeError) as e:
+        return None, (None, [{"field": "", "error": f"Invalid JSON: {e}"}])
+    return check_document(output_model, document)
+
+@lru_cache(maxsize=None)
+def output_schema(output_model) -> dict:
+    return output_model.model_json_schema()
+
+def repair_targets(document, errors):
+    # Repair paths, in order: "field.index" for an error inside a list item, else the top-level field
+    whole = set()
+    items = set()
+    for error in errors:
+        parts = error['field'].split('.')
+        value = document.get(parts[0])
+        if len(parts) > 1 and parts[1].isdigit() and isinstance(value, list):
+            items.add((parts[0], int(parts[1])))
+        else:
+            whole.add(parts[0])
+    # A field sent whole already covers its items
+    items = {(field, index) for field, index in items if field not in whole}
+    return sorted(whole) + [f"{field}.{index}" for field, index in sorted(items)]
+
+def target_value(document, target):
+    field, _, index = target.partition('.')
+    return document.get(field) if not index else document[field][int(index)]
+
+def target_schema(schema, target):
+    field, _, index = target.partition('.')
+    field_schema = schema["properties"].get(field, {})
+    if not index:
+        return field_schema
+    # The schema of one item of the list, Optional lists included
+    for option in [field_schema] + field_schema.get("anyOf", []):
+        if "items" in option:
+            return option["items"]
+    return {}
+
+def repair_request(output_model, content, problem, kwargs):
+    # (keyword arguments of the repair call, the paths it answers for); no paths means the whole answer is rewritten
+    document, errors = problem
+    schema = output_schema(output_model)
+    # The whole answer comes back when it is rewritten, so that is the most a repair may spend
+    full_max_tokens = kwargs.get("max_tokens") or task_settings(kwargs["task"])["max_tokens"]
+    fields = None if document is None or any(not error['field'] for error in errors) else repair_targets(document, errors)
+    if fields is None:
+        messages = [
+            {
+                "role": "system",
+                "content": "You fix JSON. Rewrite the text you are given as one JSON object that matches the following JSON schema, keeping all of its content:\n" + json.dumps(schema)
+            },
+            {
+                "role": "user",
+                "content": str(content)
+            }
+        ]
+        max_tokens = full_max_tokens
+    else:
+        current = {target: target_value(document, target) for target in fields}
+        field_schema = {"type": "object", "properties": {target: target_schema(schema, target) for target in fields}, "required": fields}
+        if "$defs" in schema:
+            field_schema["$defs"] = schema["$defs"]
+        repaired_fields = {target.split('.')[0] for target in fields}
+        context = json.dumps({key: value for key, value in document.items() if key not in repaired_fields})[:REPAIR_CONTEXT_CHARS]
+        messages = [
+            {
+                "role": "system",
+                "content": "You fix the parts of a JSON object that do not match its schema. Answer with a JSON object that holds only these parts, under the same keys, corrected, and matches the following JSON schema:\n" + json.dumps(field_schema)
+            },
+            {
+                "role": "user",
+                "content": f"Errors: {json.dumps(errors)}\nCurrent values: {json.dumps(current)}\nRest of the object, for context: {context}"
+            }
+        ]
+        # Sized from the values being fixed, with room for them to come back longer than they went out
+        max_tokens = min(full_max_tokens, max(task_settings("repair")["max_tokens"], 2 * estimate_text_tokens(json.dumps(current))))
+    repair_kwargs = {
+        "task": "repair",
+        # What a repair answers depends on the broken answer it was sent, which is never cached
+        "cache": False,
+        "messages": messages,
+        "priority": kwargs.get("priority", PRIORITY_INTERACTIVE),
+        "top_p": 1,
+        "stream": False,
+        "response_format": {"type": "json_object"},
+        "max_tokens": max_tokens,
+        "stop": None,
+    }
+    return repair_kwargs, fields
+
+def apply_repair(output_model, problem, fields, content):
+    # Same as check_output, for the answer with the repaired parts merged in
+    if fields is None:
+        return check_output(output_model, content)
+    try:
+        patch = json.loads(content)
+    except (TypeError, json.JSONDecodeError):
+        patch = None
+    if not isinstance(patch, dict):
+        patch = {}
+    # Lists are copied before their items are replaced, the original answer stays as it was
+    document = {key: list(value) if isinstance(value, list) else value for key, value in problem[0].items()}
+    for target in fields:
+        if target not in patch:
+            continue
+        field, _, index = target.partition('.')
+        if index:
+            document[field][int(index)] = patch[target]
+        else:
+            document[field] = patch[target]
+    return check_document(output_model, document)
+
+def checked_output(task, output, problem, repairs, content):
+    if output is not None:
+        structured_outputs.inc(task=task, outcome="repaired" if repairs else "valid")
+        return output
+    structured_outputs.inc(task=task, outcome="invalid")
+    error = StructuredOutputError(task, problem[1], content)
+    logger.warning("structured output invalid task=%s repairs=%d message=%s", task, repairs, error)
+    raise error
+
+def structured_calls(output_model, kwargs):
+    '''
+    The calls of one structured completion, as a generator shared by the sync and async gateways:
+    it yields the keyword arguments of each chat completion to make, is sent back the content
+    of its answer, and returns the validated output (or raises StructuredOutputError).
+    '''
+    kwargs["response_format"] = {"type": "json_object"}
+    # An answer is only cached once it validates, so a bad one is asked for again rather than replayed
+    kwargs["cache_if"] = lambda content: check_output(output_model, content)[0] is not None
+    content = yield kwargs
+    output, problem = check_output(output_model, content)
+    repairs = 0
+    while output is None and repairs < STRUCTURED_REPAIR_ATTEMPTS:
+        repair_kwargs, fields = repair_request(output_model, content, problem, kwargs)
+        repaired = yield repair_kwargs
+        output, problem = apply_repair(output_model, problem, fields, repaired)
+        repairs += 1
+        if fields is None:
+            content = repaired
+        logger.info("structured output repaired task=%s fields=%s valid=%s", kwargs["task"], ",".join(fields or ["*"]), output is not None)
+    return checked_output(kwargs["task"], output, problem, repairs, content)
+
+def structured_completion(output_model, **kwargs):
+    '''
+    chat_completion for JSON answers: takes the same arguments (task included) and returns the answer
+    validated as output_model, repairing the parts that do not match it.
+    '''
+    calls = structured_calls(output_model, kwargs)
+    call = next(calls)
+    while True:
+        content = chat_completion(**call).choices[0].message.content
+        try:
+            call = calls.send(content)
+        except StopIteration as done:
+            return done.value
@@ -1,44 +1,123 @@
 import os
+import logging
+import time
 from dotenv import load_dotenv
-import groq
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy_utils import database_exists
-from sqlalchemy import func, exc
+from sqlalchemy import func, exc, or_, event
+from sqlalchemy.orm import joinedload
 from groq import Groq
 import json
 import urllib.parse
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 load_dotenv()
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s level=%(levelname)s logger=%(name)s %(message)s"
+)
+logger = logging.getLogger("everglen_web")
 app = Flask(__name__)
 groq_api_key = os.getenv("GROQ_API_KEY")
+# Set to 0 to stop saves from queueing a plot-hole analysis of the series
+PLOT_HOLE_ANALYSIS_ON_SAVE = os.getenv("PLOT_HOLE_ANALYSIS_ON_SAVE", "1") == "1"
+# Set to 0 to stop saves from queueing an update of the series bible
+SERIES_BIBLE_ON_SAVE = os.getenv("SERIES_BIBLE_ON_SAVE", "1") == "1"
+# Scenes the plot is split into; every scene is expanded by its own call. With 1 the stream route sends the story
+# token by token, with more it sends each scene whole as it finishes, which is faster overall but later to first text
+STORY_SCENES = int(os.getenv("STORY_SCENES", "1"))
+# Scene expansions running at the same time for one story
+STORY_SCENE_PARALLELISM = int(os.getenv("STORY_SCENE_PARALLELISM", "4"))
+# Stories longer than this many tokens are humanized in chunks, so each rewrite fits in its 1024-token completion
+HUMANIZE_CHUNK_TOKENS = int(os.getenv("HUMANIZE_CHUNK_TOKENS", "600"))
+# Chunk rewrites running at the same time for one story
+HUMANIZE_PARALLELISM = int(os.getenv("HUMANIZE_PARALLELISM", "4"))
+# Characters of the neighbouring chunks shown to each chunk rewrite for continuity
+HUMANIZE_OVERLAP_CHARACTERS = 400
 db = SQLAlchemy()
-db_name = "StackOverflow.db"
+db_name = os.getenv("EVERGLEN_DB_NAME", "StackOverflow.db")
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///'+db_name
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 
 from everglen_models import *
+from everglen_metrics import render_metrics, http_latency, http_sql_queries, sql_queries
+from everglen_jobs import job_pipeline, submit_job, start_workers
 
 client = Groq(
-    api_key=groq_api_key
+    api_key=groq_api_key,
+    # Unset means the real Groq API; bench/fake_groq.py serves a local stand-in
+    base_url=os.getenv("GROQ_BASE_URL")
 )
 
-if database_exists('sqlite:///instance/'+db_name):
-    print(db_name + " already exists.")
+from everglen_llm import chat_completion
+from everglen_structured import structured_completion, StructuredOutputError
+from everglen_analysis import analyze_series, get_series_plot_holes
+from everglen_bible import update_series_bible, get_series_bible, bible_context
+from everglen_bulk import import_cast, export_cast, BulkImportError
+from everglen_migrations import configure_connections, migrate, SCHEMA_VERSION
+from everglen_search import search, SEARCH_KINDS
+from everglen_graph import relationship_graph
+from everglen_chunking import split_story, chunk_context, is_scene_break, CHUNK_SEPARATOR
+from everglen_response_cache import cached_response
+from everglen_prompts import prompt_fragments, character_model, relationship_model, character_text, relationship_text, characters_prompt_json, relationships_prompt_json
+
+# Flask-SQLAlchemy puts relative SQLite paths in the instance folder
+if database_exists('sqlite:///' + os.path.join(app.instance_path, db_name)):
+    logger.info("database exists db_name=%s", db_name)
 else:
-    print(db_name + " does not exist, will create " + db_name)
-    # this is needed in order for database session calls (e.g. db.session.commit)
-    with app.app_context():
-        try:
-            db.create_all()
-        except exc.SQLAlchemyError as sqlalchemyerror:
-        	print("got the following SQLAlchemyError: " + str(sqlalchemyerror))
-        except Exception as exception:
-        	print("got the following Exception: " + str(exception))
-        finally:
-        	print("db.create_all() was successfull - no exceptions were raised")
+    logger.info("database does not exist, creating db_name=%s", db_name)
+# this is needed in order for database session calls (e.g. db.session.commit)
+# create_all only creates missing tables, everglen_migrations brings existing ones up to the current schema
+with app.app_context():
+    configure_connections(db.engine)
+    try:
+        db.create_all()
+        migrate(db.engine)
+        relationship_graph.rebuild()
+    except exc.SQLAlchemyError as sqlalchemyerror:
+    	logger.error("db.create_all() failed error=SQLAlchemyError message=%s", sqlalchemyerror)
+    except Exception as exception:
+    	logger.error("db.create_all() failed error=%s message=%s", type(exception).__name__, exception)
+    else:
+    	logger.info("db.create_all() was successful schema_version=%d", SCHEMA_VERSION)
             
+'''
+Instrumentation.
+Per-route latency and SQL query counts for every request, exposed with the Groq call metrics on /metrics.
+'''
+def count_sql_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and request.url_rule is not None:
+        g.sql_queries = g.get('sql_queries', 0) + 1
+        sql_queries.inc(route=request.url_rule.rule)
+    else:
+        sql_queries.inc(route="background")
+
+with app.app_context():
+    event.listen(db.engine, "before_cursor_execute", count_sql_query)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses are timed up to the first byte, the rest is sent after this runs
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    latency = time.perf_counter() - g.get('request_started', time.perf_counter())
+    http_latency.observe(latency, route=route, method=request.method, status=str(response.status_code))
+    http_sql_queries.observe(g.get('sql_queries', 0), route=route, method=request.method)
+    logger.info("request method=%s route=%s status=%s latency=%.3f sql_queries=%d",
+        request.method, route, response.status_code, latency, g.get('sql_queries', 0))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 '''
 Homepage.
 Self explanatory.
@@ -77,6 +156,7 @@ def byteNonsense(bytesNonsense):
 APIs for the characters.
 '''
 @app.route('/api/characters/list', methods=['GET'])
+@cached_response("characters")
 def api_characters_list():
     characters = CharacterDB.query.order_by(CharacterDB.character_name.asc()).all()
     character_list = []
@@ -88,14 +168,20 @@ def api_characters_list():
 def api_characters_scan():
     something = byteNonsense(request.data)
     story = something['story']
-    characters = extract_characters(story)
-    print(characters)
-    return jsonify({"characters": characters})
+    try:
+        characters = extract_characters(story)
+    except StructuredOutputError as e:
+        return jsonify({'errors': e.errors, 'message': 'INVALID_MODEL_OUTPUT', 'status': 'ERROR'}), 502
+    except Exception as e:
+        logger.error("character scan failed error=%s message=%s", type(e).__name__, e)
+        return jsonify({"error": str(e)}), 500
+    logger.debug("characters scanned count=%d", len(characters))
+    return jsonify({"characters": characters_scan_json(characters)})
     
 @app.route('/api/characters/add', methods=['POST'])
 def api_characters_add():
     something = byteNonsense(request.data)
-    print(something)
+    logger.debug("adding character fields=%s", sorted(something))
     newCharacter = CharacterDB(
         character_name = something['name'],
         character_age = something['age'],
@@ -108,7 +194,7 @@ def api_characters_add():
     )
     db.session.add(newCharacter)
     db.session.commit()
-    print(newCharacter.id)
+    logger.info("character added character_id=%s", newCharacter.id)
     return jsonify({'character_id': newCharacter.id, 'message': 'CHARACTER_ADDED' , 'status': 'OK'})
     
 # Intended to be unused, to trick Javascript side
@@ -117,6 +203,7 @@ def api_character_url_trick():
     pass
     
 @app.route('/api/characters/view/<character_id>', methods=['GET'])
+@cached_response("characters", "relationships")
 def api_characters_view(character_id):
     row = CharacterDB.query.filter_by(id=character_id).first()
     char_rel = getCharacterRelationships(row, "database")
@@ -124,7 +211,6 @@ def api_characters_view(character_id):
         "character": {'id': row.id, 'character_name': row.character_name, 'character_age': row.character_age, 'character_gender': row.character_gender, 'character_personality': row.character_personality, 'high_school_clique': row.high_school_clique, 'cultural_background': row.cultural_background, 'current_job': row.current_job, 'additional_desc': row.additional_desc},
         "relationships": char_rel
     }
-    print(full_character_details)
     return jsonify(full_character_details)
     
 @app.route('/api/characters/edit', methods=['POST'])
@@ -141,8 +227,56 @@ def api_characters_edit():
     character.current_job = something['current_job']
     character.additional_desc = something['additional_desc']
     db.session.commit()
+    prompt_fragments.invalidate("character", character.id)
     return jsonify({'character_id': character_id, 'message': 'PROFILE_UPDATED' , 'status': 'OK'})
 
+# Takes NDJSON, a JSON array, or {"characters": [...], "relationships": [...]}; see everglen_bulk.py for the record format
+@app.route('/api/characters/import', methods=['POST'])
+def api_characters_import():
+    try:
+        imported = import_cast(request.get_data(as_text=True))
+    except BulkImportError as e:
+        return jsonify({'errors': e.errors, 'message': 'INVALID_RECORDS', 'status': 'ERROR'}), 400
+    logger.info("cast imported characters=%d relationships=%d", imported['characters_added'], imported['relationships_added'])
+    return jsonify({**imported, 'message': 'CAST_IMPORTED', 'status': 'OK'})
+
+@app.route('/api/characters/export', methods=['GET'])
+def api_characters_export():
+    response = Response(stream_with_context(export_cast()), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = 'attachment; filename=everglen_cast.ndjson'
+    return response
+
+# Deeper than this, the n-hop neighbourhood is usually the whole cast anyway
+GRAPH_MAX_HOPS = 5
+
+@app.route('/api/characters/graph', methods=['GET'])
+@cached_response("characters", "relationships")
+def api_characters_graph():
+    # ?ids=1,2&hops=2 returns everyone within two relationships of characters 1 and 2 and the relationships between them.
+    # hops=0 gives the relationships among the given characters only; without ids the whole graph is returned.
+    ids = request.args.get('ids')
+    hops = max(0, min(request.args.get('hops', 1, type=int), GRAPH_MAX_HOPS))
+    if ids:
+        try:
+            character_ids = [int(character_id) for character_id in ids.split(',') if character_id.strip()]
+        except ValueError:
+            return jsonify({'ids': ids, 'message': 'INVALID_CHARACTER_IDS', 'status': 'ERROR'}), 400
+        node_ids = relationship_graph.within_hops(character_ids, hops)
+        edges = relationship_graph.induced_subgraph(node_ids)
+    else:
+        edges = relationship_graph.all_edges()
+        node_ids = {character_id for edge in edges for character_id in (edge['relation_subject'], edge['relation_object'])}
+    nodes = (
+        db.session.query(CharacterDB.id, CharacterDB.character_name)
+        .filter(CharacterDB.id.in_(list(node_ids)))
+        .order_by(CharacterDB.id.asc())
+        .all()
+    ) if node_ids else []
+    return jsonify({
+        'nodes': [{'id': node.id, 'character_name': node.character_name} for node in nodes],
+        'edges': [relationship_json(edge) for edge in edges]
+    })
+
 '''
 APIs for handling character connections,
 also known as Relationships in the database and in Groq.
@@ -150,7 +284,6 @@ also known as Relationships in the database and in Groq.
 @app.route('/api/relationships/add', methods=['POST'])
 def api_relationships_add():
     something = byteNonsense(request.data)
-    print(something)
     newConnection = RelationshipDB(
         char_subject_id = something['relation_subject'],
         char_object_id = something['relation_object'],
@@ -158,17 +291,19 @@ def api_relationships_add():
     )
     db.session.add(newConnection)
     db.session.commit()
+    relationship_graph.add(newConnection.id, newConnection.char_subject_id, newConnection.char_object_id, newConnection.relation, newConnection.version)
     return jsonify({'character_id': newConnection.id, 'message': 'CONNECTION_ADDED' , 'status': 'OK'})
     
 @app.route('/api/relationships/edit', methods=['POST'])
 def api_relationships_edit():
     something = byteNonsense(request.data)
-    print(something)
     relationship_to_edit = RelationshipDB.query.filter_by(id=something['relation_id']).first()
     relationship_to_edit.char_subject_id = something['relation_subject']
     relationship_to_edit.char_object_id = something['relation_object']
     relationship_to_edit.relation = something['relation']
     db.session.commit()
+    relationship_graph.update(relationship_to_edit.id, relationship_to_edit.char_subject_id, relationship_to_edit.char_object_id, relationship_to_edit.relation, relationship_to_edit.version)
+    prompt_fragments.invalidate("relationship", relationship_to_edit.id)
     return jsonify({'character_id': relationship_to_edit.id, 'message': 'CONNECTION_UPDATED' , 'status': 'OK'})
     
 '''
@@ -176,205 +311,530 @@ APIs for the list of stories and the series they belong to.
 ''' 
 @app.route('/api/series/add', methods=['POST'])
 def api_series_add():
-    print(request.data)
     something = byteNonsense(request.data)
-    print(something)
     newseries = SeriesDB(series_name = something['series_name'], series_desc = something['series_desc'])
     db.session.add(newseries)
     db.session.commit()
-    print(newseries.id)
+    logger.info("series added series_id=%s", newseries.id)
     return jsonify({'series_id': newseries.id, 'message': 'SERIES_ADDED' , 'status': 'OK'})
     
 @app.route('/api/series/list', methods=['GET'])
+@cached_response("series")
 def api_series_list():
-    series = SeriesDB.query.all()
-    series_list = []
-    for row in series:
-        stories = StoryDB.query.filter_by(series_id=row.id).all()
-        series_list.append({
-            'id': row.id, 
-            'series_name': row.series_name, 
-            'series_desc': row.series_desc,
-            'stories': [
-                {
-                    'id': story.id,
-                    'story_title': story.story_title,
-                    'episode_number': story.episode_number,
-                    'location': story.location,
-                    'plot': story.plot,
-                    'full_story': story.full_story
-                }
-                for story in stories
-            ]
-        })
-    return jsonify(series_list)
+    # Every series, but only what a picker needs; the sidebar pages through /api/series/page for the stories
+    series = db.session.query(SeriesDB.id, SeriesDB.series_name).order_by(SeriesDB.id.asc()).all()
+    return jsonify([{'id': row.id, 'series_name': row.series_name} for row in series])
+
+# Story fields the paginated listing may return; plot and full_story have to be asked for explicitly
+STORY_LIST_FIELDS = ['id', 'story_title', 'episode_number', 'location', 'plot', 'full_story']
+STORY_LIST_DEFAULT_FIELDS = ['id', 'story_title', 'episode_number', 'location']
+SERIES_PAGE_DEFAULT_LIMIT = 20
+SERIES_PAGE_MAX_LIMIT = 100
+
+@app.route('/api/series/page', methods=['GET'])
+@cached_response("series", "stories")
+def api_series_page():
+    # Cursor-paginated series listing: ?cursor=<id of the last series on the previous page>&limit=20&fields=id,story_title
+    cursor = request.args.get('cursor', type=int)
+    limit = min(request.args.get('limit', SERIES_PAGE_DEFAULT_LIMIT, type=int), SERIES_PAGE_MAX_LIMIT)
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else STORY_LIST_DEFAULT_FIELDS
+    unknown_fields = [field for field in fields if field not in STORY_LIST_FIELDS]
+    if unknown_fields:
+        return jsonify({'message': 'UNKNOWN_FIELDS', 'fields': unknown_fields, 'status': 'ERROR'}), 400
+    # series_id is always needed to group the stories
+    columns = [getattr(StoryDB, field) for field in dict.fromkeys(['series_id'] + fields)]
+
+    series_query = SeriesDB.query.order_by(SeriesDB.id.asc())
+    if cursor is not None:
+        series_query = series_query.filter(SeriesDB.id > cursor)
+    # One extra row tells us whether there is another page
+    series = series_query.limit(limit + 1).all()
+    has_more = len(series) > limit
+    series = series[:limit]
+
+    stories_by_series = {row.id: [] for row in series}
+    if series:
+        stories = (
+            db.session.query(*columns)
+            .filter(StoryDB.series_id.in_(list(stories_by_series)))
+            .order_by(StoryDB.series_id.asc(), StoryDB.episode_number.asc())
+            .all()
+        )
+        for story in stories:
+            stories_by_series[story.series_id].append({field: getattr(story, field) for field in fields})
+
+    return jsonify({
+        'series': [
+            {
+                'id': row.id,
+                'series_name': row.series_name,
+                'series_desc': row.series_desc,
+                'stories': stories_by_series[row.id]
+            }
+            for row in series
+        ],
+        'next_cursor': series[-1].id if has_more else None
+    })
+
+# Intended to be unused, to trick Javascript side
+@app.route('/api/stories', methods=['GET'])
+def api_story_url_trick():
+    pass
+
+@app.route('/api/stories/view/<story_id>', methods=['GET'])
+@cached_response("stories")
+def api_stories_view(story_id):
+    story = StoryDB.query.filter_by(id=story_id).first()
+    if story is None:
+        return jsonify({'story_id': story_id, 'message': 'STORY_NOT_FOUND', 'status': 'ERROR'}), 404
+    return jsonify({
+        'id': story.id,
+        'series_id': story.series_id,
+        'story_title': story.story_title,
+        'episode_number': story.episode_number,
+        'location': story.location,
+        'plot': story.plot,
+        'full_story': story.full_story
+    })
+    
+'''
+Full-text search over stories and characters.
+?q=<words>&type=stories|characters&limit=20&offset=0, results are ranked best first.
+'''
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    query = request.args.get('q', '')
+    kind = request.args.get('type', 'stories')
+    if kind not in SEARCH_KINDS:
+        return jsonify({'message': 'UNKNOWN_SEARCH_TYPE', 'types': list(SEARCH_KINDS), 'status': 'ERROR'}), 400
+    limit = max(1, min(request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int), SEARCH_MAX_LIMIT))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    found = search(query, kind, limit, offset)
+    next_offset = offset + limit if offset + limit < found['total'] else None
+    return jsonify({'query': query, 'type': kind, 'results': found['results'], 'total': found['total'], 'next_offset': next_offset})
+    
+'''
+Plot-hole analysis of a series.
+GET returns the stored per-episode results, POST queues a job that brings them up to date.
+'''
+@app.route('/api/series/<series_id>/plotholes', methods=['GET'])
+def api_series_plotholes(series_id):
+    series = SeriesDB.query.filter_by(id=series_id).first()
+    if series is None:
+        return jsonify({'series_id': series_id, 'message': 'SERIES_NOT_FOUND', 'status': 'ERROR'}), 404
+    return jsonify(get_series_plot_holes(series.id))
+
+@app.route('/api/series/<series_id>/plotholes', methods=['POST'])
+def api_series_plotholes_analyze(series_id):
+    series = SeriesDB.query.filter_by(id=series_id).first()
+    if series is None:
+        return jsonify({'series_id': series_id, 'message': 'SERIES_NOT_FOUND', 'status': 'ERROR'}), 404
+    job = submit_job("analyze_series", {"series_id": series.id}, dedupe=True)
+    return job_accepted(job)
+
+'''
+Story bible of a series, the running summary new episodes are generated as continuations of.
+GET returns the stored bible, POST queues a job that folds in the episodes saved since the last update.
+'''
+@app.route('/api/series/<series_id>/bible', methods=['GET'])
+def api_series_bible(series_id):
+    series = SeriesDB.query.filter_by(id=series_id).first()
+    if series is None:
+        return jsonify({'series_id': series_id, 'message': 'SERIES_NOT_FOUND', 'status': 'ERROR'}), 404
+    bible = get_series_bible(series.id)
+    if bible is None:
+        return jsonify({'series_id': series.id, 'message': 'BIBLE_NOT_FOUND', 'status': 'ERROR'}), 404
+    return jsonify(bible)
+
+@app.route('/api/series/<series_id>/bible', methods=['POST'])
+def api_series_bible_update(series_id):
+    series = SeriesDB.query.filter_by(id=series_id).first()
+    if series is None:
+        return jsonify({'series_id': series_id, 'message': 'SERIES_NOT_FOUND', 'status': 'ERROR'}), 404
+    job = submit_job("update_series_bible", {"series_id": series.id}, dedupe=True)
+    return job_accepted(job)
     
 @app.route('/api/stories/generate', methods=['POST'])
 def api_story_generate():
     something = byteNonsense(request.data)
-    print(something)
     location = something['location']
     summary = something['summary']
     series = something['series']
     series_title = SeriesDB.query.filter_by(id=series['id']).first()
     characters = something['characters']
-    character_AI_models = []
-    character_relationships = []
-    print(series_title.series_name)
-    for key in characters:
-        character = characters[key]
-        character_db_model = CharacterDB.query.filter_by(id=character['id']).first()
-        character_AI_models.append(character_db_model.getAIModel())
-        char_rel = getCharacterRelationships(character_db_model)
-        character_relationships = character_relationships + char_rel
+    character_AI_models, character_relationships = load_cast([characters[key]['id'] for key in characters])
+    # New episodes continue from the series bible rather than the full text of earlier episodes
+    previous_story = bible_context(series['id'])
+    continuity_type = something.get('continuity_type', 'usual')
 
     
     try:
         if character_relationships:
-            generated_story = generate_story(scenario=summary, custom_characters=character_AI_models, location=location, relationships=character_relationships)
+            generated_story = generate_story(scenario=summary, custom_characters=character_AI_models, location=location, previous_story=previous_story, continuity_type=continuity_type, relationships=character_relationships)
         else:
-            generated_story = generate_story(scenario=summary, custom_characters=character_AI_models, location=location)
+            generated_story = generate_story(scenario=summary, custom_characters=character_AI_models, location=location, previous_story=previous_story, continuity_type=continuity_type)
 
-        story_title = json.loads(generated_story)['title']
-        output = expand_plot_to_story(json.loads(generated_story)['plot'])
-        print(output)
+        story_title = generated_story.title
+        output = expand_plot_to_story(generated_story.plot, scenes=plot_scenes(generated_story))
+        logger.info("story generated length=%d", len(output))
         return jsonify({"story_title": story_title, "story": output})
+    except StructuredOutputError as e:
+        logger.error("story generation failed error=StructuredOutputError message=%s", e)
+        return jsonify({'errors': e.errors, 'message': 'INVALID_MODEL_OUTPUT', 'status': 'ERROR'}), 502
+    except GenerationError as e:
+        return jsonify({'error': str(e), 'message': 'GENERATION_FAILED', 'status': 'ERROR'}), 502
     except Exception as e:
-        print(str(e))
+        logger.error("story generation failed error=%s message=%s", type(e).__name__, e)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/stories/humanize', methods=['POST'])
 def api_story_humanize():
     something = byteNonsense(request.data)
-    #print(something)
     story_original = something['original_story']
     characters = something['story_characters']
-    character_AI_models = []
-    character_relationships = []
-    for key in characters:
-        character = characters[key]
-        character_db_model = CharacterDB.query.filter_by(id=character['id']).first()
-        character_AI_models.append(character_db_model.getAIModel())
-        char_rel = getCharacterRelationships(character_db_model)
-        character_relationships = character_relationships + char_rel
-    
-    output = story_humanizer_nonjson(story_original, character_AI_models, character_relationships)
-    print(output)
+    character_AI_models, character_relationships = load_cast([characters[key]['id'] for key in characters])
+    
+    try:
+        output = story_humanizer_nonjson(story_original, character_AI_models, character_relationships)
+    except GenerationError as e:
+        return jsonify({'error': str(e), 'message': 'HUMANIZE_FAILED', 'status': 'ERROR'}), 502
     return jsonify({"output": output}), 200
     
+# Attempts at saving a story when concurrent saves to the same series take its episode number
+SAVE_STORY_ATTEMPTS = 10
+
+def save_story_to_series(series_id, character_ids, story_title, plot, location, full_story, analyze = True):
+    for attempt in range(SAVE_STORY_ATTEMPTS):
+        # (series_id, episode_number) is unique, so a save that loses the race rolls back and takes the next number
+        last_episode = db.session.query(func.max(StoryDB.episode_number)).filter(StoryDB.series_id == series_id).scalar()
+        new_episode_number = (last_episode or 0) + 1
+        
+        newStory = StoryDB(
+            story_title = story_title,
+            episode_number = new_episode_number,
+            location = location,
+            plot = plot,
+            full_story = full_story,
+            series_id = series_id
+        )
+        db.session.add(newStory)
+        try:
+            # The story and its cast go in with a single commit; flush only assigns the story id
+            db.session.flush()
+            new_story_id = newStory.id
+            db.session.add_all([StoryCharactersDB(story_id = new_story_id, char_id = character_id) for character_id in character_ids])
+            db.session.commit()
+        except exc.IntegrityError:
+            db.session.rollback()
+            if attempt == SAVE_STORY_ATTEMPTS - 1:
+                raise
+            logger.warning("episode number taken, retrying series_id=%s episode_number=%s", series_id, new_episode_number)
+            continue
+        break
+    logger.info("story saved story_id=%s series_id=%s episode_number=%s", new_story_id, series_id, new_episode_number)
+    
+    if analyze and PLOT_HOLE_ANALYSIS_ON_SAVE:
+        # Only the new episode gets analyzed, the earlier ones are already up to date
+        submit_job("analyze_series", {"series_id": int(series_id)}, dedupe=True)
+    if analyze and SERIES_BIBLE_ON_SAVE:
+        # Only the new episode gets folded into the bible
+        submit_job("update_series_bible", {"series_id": int(series_id)}, dedupe=True)
+    
+    return new_story_id
+
+# Placeholders for imported stories until the enrich_story job fills in the real metadata
+PENDING_TITLE = "Untitled episode"
+PENDING_PLOT = ""
+PENDING_LOCATION = "Unknown"
+
+def save_imported_story(series_id, character_ids, story_title, full_story):
+    # Saves the story straight away and leaves the title, plot and location to a background job
+    new_story_id = save_story_to_series(series_id, character_ids, story_title or PENDING_TITLE, PENDING_PLOT, PENDING_LOCATION, full_story, analyze = False)
+    job = submit_job("enrich_story", {
+        "story_id": new_story_id,
+        "generate_title": not story_title,
+        "character_ids": character_ids
+    })
+    return new_story_id, job
+    
+'''
+Streaming variants of the generate and humanize APIs.
+These send the scene tokens as Server-Sent Events while Groq is still producing them,
+followed by a final "done" event that carries the title and the rest of the metadata.
+'''
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def sse_response(events):
+    response = Response(stream_with_context(events), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stops nginx and similar reverse proxies from buffering the whole stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/stories/generate/stream', methods=['POST'])
+def api_story_generate_stream():
+    something = byteNonsense(request.data)
+    location = something['location']
+    summary = something['summary']
+    characters = something['characters']
+    character_AI_models, character_relationships = load_cast([characters[key]['id'] for key in characters])
+    previous_story = bible_context(something.get('series', {}).get('id'))
+    continuity_type = something.get('continuity_type', 'usual')
+
+    def events():
+        # Sent straight away so the browser gets its first byte before the plot call returns
+        yield sse_event("status", {"stage": "plot"})
+        try:
+            plot = generate_story(scenario=summary, custom_characters=character_AI_models, location=location, previous_story=previous_story, continuity_type=continuity_type, relationships=character_relationships or None)
+            scenes = plot_scenes(plot)
+            yield sse_event("plot", {"story_title": plot.title, "plot": plot.plot, "scenes": [title for title, _ in scenes]})
+            if len(scenes) > 1:
+                # Scenes are written side by side, and each one is sent whole as soon as it is done
+                yield sse_event("status", {"stage": "scenes", "count": len(scenes)})
+                detailed_scenes = [None] * len(scenes)
+                for index, detailed_scene in expand_scenes(scenes, story_plot=plot.plot):
+                    detailed_scenes[index] = detailed_scene
+                    yield sse_event("scene", {"index": index, "title": scenes[index][0], "text": detailed_scene})
+                scene = "\n\n".join(detailed_scenes)
+            else:
+                yield sse_event("status", {"stage": "scene"})
+                scene = ""
+                for token in generate_detailed_scene_stream("1", scenes[0][1]):
+                    scene += token
+                    yield sse_event("token", {"text": token})
+            yield sse_event("done", {
+                "story_title": plot.title,
+                "story": scene,
+                "plot": plot.plot,
+                "location": location,
+                "characters": [char.name for char in character_AI_models]
+            })
+        except Exception as e:
+            logger.error("streamed story generation failed error=%s message=%s", type(e).__name__, e)
+            yield sse_event("error", {"error": str(e)})
+
+    return sse_response(events())
+
+@app.route('/api/stories/humanize/stream', methods=['POST'])
+def api_story_humanize_stream():
+    something = byteNonsense(request.data)
+    story_original = something['original_story']
+    characters = something.get('story_characters', {})
+    character_AI_models, character_relationships = load_cast([characters[key]['id'] for key in characters])
+
+    def events():
+        yield sse_event("status", {"stage": "rewrite"})
+        try:
+            improved_story = ""
+            for token in story_humanizer_stream(story_original, character_AI_models, character_relationships):
+                improved_story += token
+                yield sse_event("token", {"text": token})
+            yield sse_event("status", {"stage": "title"})
+            title = generate_title(improved_story)
+            yield sse_event("done", {"output": {"improved_story": improved_story, "title": title}})
+        except Exception as e:
+            logger.error("streamed humanize failed error=%s message=%s", type(e).__name__, e)
+            yield sse_event("error", {"error": str(e)})
+
+    return sse_response(events())
+
 
 @app.route('/api/stories/save', methods=['POST'])
 def api_story_save():
-    story_title = ""
-    plot = ""
-    location = ""
-
     something = byteNonsense(request.data)
-    print(something['story_origin'])
-    series = SeriesDB.query.filter_by(id=something['series']['id']).first()
+    return jsonify(save_story(something))
+
+def save_story(something):
+    # Shared with the ASGI version of the route, see everglen_asgi
+    logger.debug("saving story story_origin=%s", something['story_origin'])
     characters = something['characters']
+    character_ids = [characters[key]['id'] for key in characters]
     
     full_story = something['full_story']
-    num_episodes = StoryDB.query.filter_by(series_id=something['series']['id']).count()
-    new_episode_number = num_episodes + 1
     
+    if something['story_origin'] == "imported":
+        # Title, plot and location come later from the enrich_story job, whose id is returned for polling
+        new_story_id, job = save_imported_story(something['series']['id'], character_ids, something.get('story_title', ""), full_story)
+        return {'story_id': new_story_id, 'job_id': job.id, 'message': 'STORY_ADDED', 'status': 'OK'}
+    
+    story_title = ""
+    plot = ""
+    location = ""
     if something['story_origin'] == "generated_from_plot":
         story_title = something['story_title']
         plot = something['plot']
         location = something['location']
-    if something['story_origin'] == "imported":
-        character_AI_models = []
-        character_relationships = []
-        for key in characters:
-            character = characters[key]
-            character_db_model = CharacterDB.query.filter_by(id=character['id']).first()
-            character_AI_models.append(character_db_model.getAIModel())
-            char_rel = getCharacterRelationships(character_db_model)
-            character_relationships = character_relationships + char_rel
-        
-        output = story_humanizer_nonjson(full_story, character_AI_models, character_relationships)
-        sumloc = summary_and_location_generator(full_story, character_AI_models, character_relationships)
-        print(sumloc)
-        if something['story_title'] or something['story_title'] != "":
-            story_title = something['story_title']
-        else:
-            story_title = output['title']
-        plot = sumloc['summary']
-        location = sumloc['location']
-    
-    newStory = StoryDB(
-        story_title = story_title,
-        episode_number = new_episode_number,
-        location = location,
-        plot = plot,
-        full_story = full_story,
-        series_id = something['series']['id']
-    )
-    db.session.add(newStory)
-    db.session.commit()
-    print(newStory.id)
-    new_story_id = newStory.id
-    
-    for key in characters:
-        character = characters[key]
-        story_character = StoryCharactersDB(
-            story_id = new_story_id,
-            char_id = character['id']
-        )
-        db.session.add(story_character)
-        db.session.commit()
     
-    return jsonify({'story_id': new_story_id, 'message': 'STORY_ADDED', 'status': 'OK'})
+    new_story_id = save_story_to_series(something['series']['id'], character_ids, story_title, plot, location, full_story)
+    
+    return {'story_id': new_story_id, 'message': 'STORY_ADDED', 'status': 'OK'}
     
     
 '''
-Dummy pages.
+Job versions of the generate, humanize and save APIs.
+These return a job id straight away and run the Groq calls on the job worker pool.
+Poll /api/jobs/<job_id> for per-stage progress and /api/jobs/<job_id>/result for the output.
 '''
-@app.route('/tests/plothole')
-def test_plothole():
-    # NOTE FROM THE DEVELOPER
-    # Do not run this test if the Groq API key used is the free tier.
-    # This will result in a rate limit error.
-    
-    # Get all stories in the series with id=1
-    max_diary = StoryDB.query.filter_by(series_id=1).all()
+def job_accepted(job):
+    return jsonify({'job_id': job.id, 'message': 'JOB_QUEUED', 'status': 'OK'}), 202
+
+@app.route('/api/jobs/stories/generate', methods=['POST'])
+def api_job_story_generate():
+    something = byteNonsense(request.data)
+    characters = something['characters']
+    job = submit_job("generate", {
+        "location": something['location'],
+        "summary": something['summary'],
+        "series_id": something['series']['id'],
+        "continuity_type": something.get('continuity_type', 'usual'),
+        "character_ids": [characters[key]['id'] for key in characters]
+    })
+    return job_accepted(job)
+
+@app.route('/api/jobs/stories/humanize', methods=['POST'])
+def api_job_story_humanize():
+    something = byteNonsense(request.data)
+    characters = something.get('story_characters', {})
+    job = submit_job("humanize", {
+        "original_story": something['original_story'],
+        "character_ids": [characters[key]['id'] for key in characters]
+    })
+    return job_accepted(job)
 
-    # Initialize empty lists to store stories, characters, character AI models, and character relationships
-    stories = []
-    characters = []
-    character_AI_models = []
-    character_relationships = []
+@app.route('/api/jobs/stories/save', methods=['POST'])
+def api_job_story_save():
+    something = byteNonsense(request.data)
+    characters = something.get('characters', {})
+    job = submit_job("save_imported", {
+        "series_id": something['series']['id'],
+        "story_title": something.get('story_title', ""),
+        "full_story": something['full_story'],
+        "character_ids": [characters[key]['id'] for key in characters]
+    })
+    return job_accepted(job)
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    job = JobDB.query.filter_by(id=job_id).first()
+    if job is None:
+        return jsonify({'job_id': job_id, 'message': 'JOB_NOT_FOUND', 'status': 'ERROR'}), 404
+    return jsonify(job.__json__())
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def api_job_result(job_id):
+    job = JobDB.query.filter_by(id=job_id).first()
+    if job is None:
+        return jsonify({'job_id': job_id, 'message': 'JOB_NOT_FOUND', 'status': 'ERROR'}), 404
+    if job.status == 'failed':
+        return jsonify({'job_id': job_id, 'status': job.status, 'error': job.error}), 500
+    if job.status != 'done':
+        return jsonify({'job_id': job_id, 'status': job.status, 'current_stage': job.current_stage}), 202
+    return jsonify({'job_id': job_id, 'status': job.status, 'result': json.loads(job.result)})
+
+@job_pipeline("generate", ["plot", "scene"])
+def generate_story_job(job, payload):
+    character_AI_models, character_relationships = load_cast(payload['character_ids'])
 
-    # Loop through each story in the series
-    for story in max_diary:
-        # Add the full story to the stories list
-        stories.append(story.full_story)
+    def plot_stage():
+        generated_story = generate_story(scenario=payload['summary'], custom_characters=character_AI_models, location=payload['location'],
+            previous_story=bible_context(payload['series_id']), continuity_type=payload.get('continuity_type', 'usual'), relationships=character_relationships or None)
+        # Stage results are stored as JSON
+        return generated_story.model_dump()
 
-        # Get all characters in the story
-        story_char_db = StoryCharactersDB.query.filter_by(story_id=story.id).all()
+    def scene_stage(generated_story):
+        generated_story = StoryPlot.model_validate(generated_story)
+        return expand_plot_to_story(generated_story.plot, scenes=plot_scenes(generated_story))
 
-        # Loop through each character in the story
-        for character_id in story_char_db:
-            # Check if the character is already in the characters list
-            if character_id.char_id not in characters:
-                # If the character is not in the characters list, add it
-                characters.append(character_id.char_id)
+    generated_story = job.run_stage("plot", plot_stage)
+    output = job.run_stage("scene", scene_stage, generated_story)
+    return {"story_title": generated_story['title'], "story": output}
 
-                # Get the character from the CharacterDB model
-                character = CharacterDB.query.filter_by(id=character_id.char_id).first()
+@job_pipeline("humanize", ["rewrite", "title"])
+def humanize_story_job(job, payload):
+    character_AI_models, character_relationships = load_cast(payload['character_ids'])
+    improved_story = job.run_stage("rewrite", rewrite_story, payload['original_story'], character_AI_models, character_relationships)
+    title = job.run_stage("title", generate_title, improved_story)
+    return {"output": {"improved_story": improved_story, "title": title}}
 
-                # Add the character's AI model to the character_AI_models list
-                character_AI_models.append(character.getAIModel())
+@job_pipeline("save_imported", ["save"])
+def save_imported_story_job(job, payload):
+    def save():
+        new_story_id, enrich_job = save_imported_story(payload['series_id'], payload['character_ids'], payload['story_title'], payload['full_story'])
+        return {'story_id': new_story_id, 'job_id': enrich_job.id}
 
-                # Get the character's relationships and add them to the character_relationships list
-                char_rel = getCharacterRelationships(character)
-                character_relationships = character_relationships + char_rel
+    saved = job.run_stage("save", save)
+    return {**saved, 'message': 'STORY_ADDED', 'status': 'OK'}
 
-    # Call the plot_hole_detector function with the stories list as an argument
-    plot_holes = plot_hole_detector(stories)
+@job_pipeline("enrich_story", ["metadata", "update"])
+def enrich_story_job(job, payload):
+    story = StoryDB.query.filter_by(id=payload['story_id']).first()
+    if story is None:
+        raise Exception(f"Story {payload['story_id']} no longer exists")
+    full_story = story.full_story
+    character_AI_models, character_relationships = load_cast(payload['character_ids'])
+
+    def checked(function, *args):
+        # An empty answer fails the stage like an error does
+        output = function(*args)
+        if output is None:
+            raise GenerationError(function.__name__, "no output")
+        return output
+
+    def metadata():
+        title, sumloc = run_concurrently(
+            lambda: checked(generate_title, full_story) if payload['generate_title'] else None,
+            lambda: checked(summary_and_location_generator, full_story, character_AI_models, character_relationships)
+        )
+        return {"title": title, "summary": sumloc['summary'], "location": sumloc['location']}
 
-    # Print the plot holes to the console
-    print(plot_holes)
+    output = job.run_stage("metadata", metadata)
+
+    def update():
+        story = StoryDB.query.filter_by(id=payload['story_id']).first()
+        if output['title']:
+            story.story_title = output['title']
+        story.plot = output['summary']
+        story.location = output['location']
+        db.session.commit()
+        logger.info("story enriched story_id=%s", story.id)
+        if PLOT_HOLE_ANALYSIS_ON_SAVE:
+            submit_job("analyze_series", {"series_id": story.series_id}, dedupe=True)
+        if SERIES_BIBLE_ON_SAVE:
+            # Folded in after the plot summary is written, so the bible reads the summary rather than the full text
+            submit_job("update_series_bible", {"series_id": story.series_id}, dedupe=True)
+        return story.id
+
+    job.run_stage("update", update)
+    return {'story_id': payload['story_id'], 'story_title': output['title'], 'plot': output['summary'], 'location': output['location']}
+    
+@job_pipeline("analyze_series", ["analyze"])
+def analyze_series_job(job, payload):
+    return job.run_stage("analyze", analyze_series, payload['series_id'])
+
+@job_pipeline("update_series_bible", ["update"])
+def update_series_bible_job(job, payload):
+    return job.run_stage("update", update_series_bible, payload['series_id'])
+    
+'''
+Dummy pages.
+'''
+@app.route('/tests/plothole')
+def test_plothole():
+    # NOTE FROM THE DEVELOPER
+    # Do not run this test if the Groq API key used is the free tier.
+    # This will result in a rate limit error.
+    # Only episodes that changed since the last run are sent to Groq, see everglen_analysis.
+    series_id = request.args.get('series_id', 1, type=int)
+
+    plot_holes = analyze_series(series_id)
+
+    # Log the plot holes to the console
+    logger.info("plot holes series_id=%s\n%s", series_id, json.dumps(plot_holes, indent=4))
 
     # Return a message to indicate that the output is printed to the console
     return "Check command line for output"
@@ -383,32 +843,67 @@ def test_plothole():
 '''
 Core story-generating code
 '''
+def run_concurrently(*functions):
+    # Starts every function at once, each on its own thread, and returns their results in the same order.
+    # Meant for independent Groq calls within one stage; the calls spend nearly all their time waiting on the network.
+    with ThreadPoolExecutor(max_workers=len(functions)) as executor:
+        futures = [executor.submit(function) for function in functions]
+        return [future.result() for future in futures]
+
 def getCharacterRelationships(character_db, mode = "groq"):
     # This accepts the CharacterDB object, not the one used by Groq
-    relationships = []
-
-    # Query for all relationships where the given character is the subject
-    leftside_relationships = RelationshipDB.query.filter_by(char_subject_id=character_db.id).all()
-
-    # Query for all relationships where the given character is the object
-    rightside_relationships = RelationshipDB.query.filter_by(char_object_id=character_db.id).all()
+    # Relationships where the character is the subject or the object, from the in-memory graph
+    relationships = relationship_graph.neighbors(character_db.id)
 
-    # Combine the leftside and rightside relationships into a single list
-    relationships = leftside_relationships + rightside_relationships
-
-    # Convert the RelationshipDB objects into Relationship objects if mode is set to groq (default mode)
+    # Convert them into Relationship objects if mode is set to groq (default mode)
     if mode == "groq":
-        relationships = [rel.getAIModel() for rel in relationships]
+        characters_by_id = load_characters({character_id for rel in relationships for character_id in (rel['relation_subject'], rel['relation_object'])})
+        relationships = [
+            relationship_model(rel['relation_id'], rel['version'], characters_by_id[rel['relation_subject']], characters_by_id[rel['relation_object']], rel['relation'])
+            for rel in relationships
+        ]
         return relationships
     else:
-        relationships = [rel.__json__() for rel in relationships]
-        return relationships
+        return [relationship_json(rel) for rel in relationships]
+
+def relationship_json(edge):
+    # A graph edge as the v1 routes return it; the row version is only for the prompt caches
+    return {key: value for key, value in edge.items() if key != 'version'}
     
+def load_characters(character_ids):
+    # character id -> CharacterDB row, in one query
+    if not character_ids:
+        return {}
+    return {character.id: character for character in CharacterDB.query.filter(CharacterDB.id.in_(list(character_ids))).all()}
 
-def generate_story(scenario: str, custom_characters: Optional[List[Character]] = None, series_title: Optional[str] = None, story_title: Optional[str] = None, location: Optional[str] = None, previous_story: Optional[str] = None, continuity_type: Optional[str] = "usual", language: Optional[str] = "English", relationships: Optional[List[Relationship]] = None) -> str:
+def load_cast(character_ids):
+    # Loads the selected characters and every relationship involving them as the models used by Groq.
+    # The relationships come from the in-memory graph, so this is a single query for the characters
+    # (the cast plus whoever they are related to), no matter how big the cast is.
+    # A relationship between two cast members is only returned once.
+    character_ids = [int(character_id) for character_id in character_ids]
+    if not character_ids:
+        return [], []
+
+    relationships = relationship_graph.touching(character_ids)
+    related_ids = {character_id for rel in relationships for character_id in (rel['relation_subject'], rel['relation_object'])}
+    characters_by_id = load_characters(set(character_ids) | related_ids)
+
+    # Unchanged rows come back as the same cached models, with their prompt text already built
+    cast = [character_model(characters_by_id[character_id]) for character_id in dict.fromkeys(character_ids) if character_id in characters_by_id]
+    cast_relationships = [
+        relationship_model(rel['relation_id'], rel['version'], characters_by_id[rel['relation_subject']], characters_by_id[rel['relation_object']], rel['relation'])
+        for rel in relationships
+        if rel['relation_subject'] in characters_by_id and rel['relation_object'] in characters_by_id
+    ]
+    return cast, cast_relationships
+
+def story_messages(scenario: str, custom_characters: Optional[List[Character]] = None, series_title: Optional[str] = None, story_title: Optional[str] = None, location: Optional[str] = None, previous_story: Optional[str] = None, continuity_type: Optional[str] = "usual", language: Optional[str] = "English", relationships: Optional[List[Relationship]] = None, scene_count: Optional[int] = None) -> List[dict]:
+    if scene_count is None:
+        scene_count = STORY_SCENES
     character_data = ""
     if custom_characters:
-        character_data = ", ".join([f"{char.name} (gender: {char.gender}, age: {char.age}, personality: {char.personality}, high_school_clique: {char.high_school_clique}, cultural_background: {char.cultural_background}, native_languages: {char.native_languages}, current_job: {char.current_job}, outfit: {char.outfit}, additional_desc: {char.additional_desc})" for char in custom_characters])
+        character_data = ", ".join([character_text(char) for char in custom_characters])
         # character_data = ", ".join([f"{char.dict()}" for char in custom_characters])
 
     # Prepare optional parameters
@@ -422,87 +917,122 @@ def generate_story(scenario: str, custom_characters: Optional[List[Character]] =
     if previous_story:
         optional_params += f" 'previous_story': '{previous_story}',"
     if relationships:
-        relationship_data = ", ".join([f"{rel.dict()}" for rel in relationships])
+        relationship_data = ", ".join([relationship_text(rel) for rel in relationships])
         optional_params += f" 'relationships': [{relationship_data}],"
 
-    try:
-        completion = client.with_options(max_retries=5).chat.completions.create(
-            model="mixtral-8x7b-32768",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        f"You are a story generator. Generate a story about high school cliques in {language}. "
-                        "The story should have a title, characters, and a brief plot. "
-                        "Ensure that the story is in JSON format with the following schema:\n"
-                        "{\n"
-                        "  \"title\": {\"type\": \"string\"},\n"
-                        "  \"characters\": {\"type\": \"array\", \"items\": {\"type\": \"string\"}},\n"
-                        "  \"plot\": {\"type\": \"string\"}\n"
-                        "}\n"
-                        f"If a previous story is provided, ensure that the new story is a continuation of it using the {continuity_type} approach. "
-                        f"Ensure that the output is in {language}."
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": f"Generate a story involving the following scenario: {scenario}. "
-                        f"{', and use the following custom characters: [' + character_data + ']' if custom_characters else ''}"
-                        f"{', and apply the following additional information to the story: {' + optional_params + '}' if optional_params else ''}"
-                }
-            ],
-            temperature=1,
-            max_tokens=1024,
-            top_p=1,
-            stream=False,
-            response_format={"type": "json_object"},
-            stop=None,
-        )
-        print(completion.choices[0].message.content)
-        story = json.loads(completion.choices[0].message.content)
-        
-        story_json = json.dumps(story, indent=4)  # Pretty-print the JSON
-        return story_json
-    except groq.BadRequestError as bre:
-        print("Error in generate_story:")
-        print(bre.message)
-        return {"error": "Groq - Bad Request", "contents": bre.message}
-    except groq.InternalServerError as ire:
-        print("Error in generate_story:")
-        print(ire.message)
-        return {"error": "Groq - Internal Server Error", "contents": ire.message}
-    except Exception as ge:
-        print("Error in generate_story:")
-        print(ge)
-        print(type(ge).__name__)
-        return ge
+    scene_schema = (
+        ",\n"
+        "  \"scenes\": {\"type\": \"array\", \"items\": {\"type\": \"object\", \"properties\": {\"title\": {\"type\": \"string\"}, \"summary\": {\"type\": \"string\"}}}}"
+    )
 
-def expand_plot_to_story(plot: str, language: Optional[str] = "English") -> str:
-    full_story = ""
-    #for day, summary in plot.items():
-    #    detailed_scene = generate_detailed_scene(day, summary)
-    #    full_story += detailed_scene + "\n\n"
-    
-    return generate_detailed_scene("1", plot)
+    return [
+        {
+            "role": "system",
+            "content": (
+                f"You are a story generator. Generate a story about high school cliques in {language}. "
+                "The story should have a title, characters, and a brief plot. "
+                "Ensure that the story is in JSON format with the following schema:\n"
+                "{\n"
+                "  \"title\": {\"type\": \"string\"},\n"
+                "  \"characters\": {\"type\": \"array\", \"items\": {\"type\": \"string\"}},\n"
+                "  \"plot\": {\"type\": \"string\"}"
+                f"{scene_schema if scene_count > 1 else ''}\n"
+                "}\n"
+                f"{f'Split the plot into {scene_count} scenes in chronological order, each with a short title and a summary of what happens in it. ' if scene_count > 1 else ''}"
+                f"If a previous story is provided, ensure that the new story is a continuation of it using the {continuity_type} approach. "
+                f"Ensure that the output is in {language}."
+            )
+        },
+        {
+            "role": "user",
+            "content": f"Generate a story involving the following scenario: {scenario}. "
+                f"{', and use the following custom characters: [' + character_data + ']' if custom_characters else ''}"
+                f"{', and apply the following additional information to the story: {' + optional_params + '}' if optional_params else ''}"
+        }
+    ]
+
+def generate_story(scenario: str, custom_characters: Optional[List[Character]] = None, series_title: Optional[str] = None, story_title: Optional[str] = None, location: Optional[str] = None, previous_story: Optional[str] = None, continuity_type: Optional[str] = "usual", language: Optional[str] = "English", relationships: Optional[List[Relationship]] = None, scene_count: Optional[int] = None) -> StoryPlot:
+    # Raises StructuredOutputError when the plot still does not match StoryPlot after a repair, and Groq's own errors as they are
+    return structured_completion(
+        StoryPlot,
+        max_retries=5,
+        cache=False,
+        task="plot",
+        messages=story_messages(scenario, custom_characters, series_title, story_title, location, previous_story, continuity_type, language, relationships, scene_count),
+        top_p=1,
+        stream=False,
+        stop=None,
+    )
+
+def plot_scenes(generated_story: StoryPlot) -> List[tuple]:
+    # (title, summary) of every scene of a plot made by generate_story, falling back to the whole plot as one scene
+    scenes = [
+        (scene.title or f"Scene {number}", scene.summary)
+        for number, scene in enumerate(generated_story.scenes or [], start=1)
+        if scene.summary
+    ]
+    return scenes or [("1", generated_story.plot)]
 
-def generate_detailed_scene(day: str, summary: str, language: Optional[str] = "English") -> str:
+class GenerationError(Exception):
+    # A Groq call a story depends on failed after its retries and fallbacks; the routes answer 502
+    def __init__(self, stage, error):
+        super().__init__(f"{stage} could not be generated: {error}")
+        # e.g. "scene 2"
+        self.stage = stage
+        self.error = error
+
+def expand_scenes(scenes: List[tuple], language: Optional[str] = "English", story_plot: Optional[str] = None) -> Iterator[tuple]:
+    # Expands every scene at the same time (at most STORY_SCENE_PARALLELISM at once)
+    # and yields (index, scene text) as each one finishes, which is not necessarily in order
+    with ThreadPoolExecutor(max_workers=max(1, min(STORY_SCENE_PARALLELISM, len(scenes)))) as executor:
+        futures = {
+            executor.submit(generate_detailed_scene, title, summary, language, story_plot): index
+            for index, (title, summary) in enumerate(scenes)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def scene_calls(plot: str, scenes: Optional[List[tuple]] = None) -> List[tuple]:
+    # (day, summary, story plot) of every scene to expand, in story order.
+    # A single scene (or no scene list) keeps the old behaviour of one call for the whole plot
+    if not scenes or len(scenes) == 1:
+        return [("1", scenes[0][1] if scenes else plot, None)]
+    return [(title, summary, plot) for title, summary in scenes]
+
+def expand_plot_to_story(plot: str, language: Optional[str] = "English", scenes: Optional[List[tuple]] = None) -> str:
+    calls = scene_calls(plot, scenes)
+    if len(calls) == 1:
+        day, summary, _ = calls[0]
+        return generate_detailed_scene(day, summary, language)
+
+    # Long episodes take about as long as their slowest scene, and each scene gets its own output budget
+    full_story = [None] * len(scenes)
+    for index, detailed_scene in expand_scenes(scenes, language, plot):
+        full_story[index] = detailed_scene
+    return "\n\n".join(full_story)
+
+def scene_messages(day: str, summary: str, language: Optional[str] = "English", story_plot: Optional[str] = None) -> List[dict]:
+    # With several scenes, the plot of the whole story keeps the separately written scenes consistent
+    story_context = f"Story Plot: {story_plot}\n" if story_plot else ""
+    return [
+        {
+            "role": "system",
+            "content": (
+                f"You are a story generator. Expand this following plot summary written in {language} into a detailed scene in {language}, in a witty, engaging, and emotionally resonant tone that is suitable for a high school setting. Here are some examples of the type of story I'm looking for: 'Nick and Charlie' by Alice Oseman, 'The Perks of Being a Wallflower' by Stephen Chbosky, and 'Paper Towns' by John Green."
+            )
+        },
+        {
+            "role": "user",
+            "content": f"{story_context}Day: {day}\nPlot Summary: {summary}\n\nDetailed Scene:"
+        }
+    ]
+
+def generate_detailed_scene(day: str, summary: str, language: Optional[str] = "English", story_plot: Optional[str] = None) -> str:
     try:
-        completion = client.chat.completions.create(
-            model="mixtral-8x7b-32768",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        f"You are a story generator. Expand this following plot summary written in {language} into a detailed scene in {language}, in a witty, engaging, and emotionally resonant tone that is suitable for a high school setting. Here are some examples of the type of story I'm looking for: 'Nick and Charlie' by Alice Oseman, 'The Perks of Being a Wallflower' by Stephen Chbosky, and 'Paper Towns' by John Green."
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": f"Day: {day}\nPlot Summary: {summary}\n\nDetailed Scene:"
-                }
-            ],
-            temperature=0.7,
-            max_tokens=1024,
+        completion = chat_completion(
+            cache=False,
+            task="scene",
+            messages=scene_messages(day, summary, language, story_plot),
             top_p=1,
             stream=False,
             stop=None,
@@ -510,213 +1040,267 @@ def generate_detailed_scene(day: str, summary: str, language: Optional[str] = "E
         detailed_scene = completion.choices[0].message.content
         return detailed_scene
     except Exception as ge:
-        print("Error in generate_detailed_scene:")
-        print(str(ge))
-        return jsonify({"error": ge})
+        logger.error("generate_detailed_scene failed error=%s message=%s", type(ge).__name__, ge)
+        raise GenerationError(f"scene {day}", ge) from ge
+
+def generate_detailed_scene_stream(day: str, summary: str, language: Optional[str] = "English") -> Iterator[str]:
+    # Same as generate_detailed_scene, but yields the scene text as Groq sends it
+    stream = chat_completion(
+        task="scene",
+        messages=scene_messages(day, summary, language),
+        top_p=1,
+        stream=True,
+        stop=None,
+    )
+    for chunk in stream:
+        token = chunk.choices[0].delta.content
+        if token:
+            yield token
 
     
-def extract_characters(story: str) -> str:
-    try:
-        completion = client.chat.completions.create(
-            model="mixtral-8x7b-32768",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a story analyzer. Get the names of the characters, their high school cliques, a brief and concise summary of their personalities, their ages, their genders, and their current jobs based on their actions and dialogs in the story. "
-                        "Ensure that the output is in JSON format with the following schema:\n"
-                        "{\n"
-                        "  \"characters\": {\"type\": \"array\", \"items\": {\"type\": \"object\", \"properties\": {\"name\": {\"type\": \"string\"}, \"high_school_clique\": {\"type\": \"string\"}, \"personality\": {\"type\": \"string\"}, \"age\": {\"type\": \"integer\"}, \"gender\": {\"type\": \"string\"}, \"current_job\": {\"type\": \"string\"}, \"additional_desc\": {\"type\": \"string\"}}}}\n"
-                        "}\n"
-                        "Ensure that the ages of the characters are appropriate based on their roles and backgrounds. The 'gender' field should indicate the character's gender, taking into account their names and the context of the story. The 'current_job' field should indicate the character's current job, taking into account their relationships and backgrounds. The 'additional_desc' field should provide additional information about the character, such as their species or profession."
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": f"Story: {story}"
-                }
-            ],
-            temperature=0.8,
-            max_tokens=1024,
-            top_p=1,
-            stream=False,
-            response_format={"type": "json_object"},
-            stop=None,
-        )
-        characters = json.loads(completion.choices[0].message.content)
-        characters_json = json.dumps(characters, indent=4)  # Pretty-print the JSON
-        return characters_json
-    except json.JSONDecodeError as e:
-        return f"Failed to parse JSON: {e}"
-    except Exception as ge:
-        return f"Bad Request: {ge}"
+def extract_characters_messages(story: str) -> List[dict]:
+    return [
+        {
+            "role": "system",
+            "content": (
+                "You are a story analyzer. Get the names of the characters, their high school cliques, a brief and concise summary of their personalities, their ages, their genders, and their current jobs based on their actions and dialogs in the story. "
+                "Ensure that the output is in JSON format with the following schema:\n"
+                "{\n"
+                "  \"characters\": {\"type\": \"array\", \"items\": {\"type\": \"object\", \"properties\": {\"name\": {\"type\": \"string\"}, \"high_school_clique\": {\"type\": \"string\"}, \"personality\": {\"type\": \"string\"}, \"age\": {\"type\": \"integer\"}, \"gender\": {\"type\": \"string\"}, \"current_job\": {\"type\": \"string\"}, \"additional_desc\": {\"type\": \"string\"}}}}\n"
+                "}\n"
+                "Ensure that the ages of the characters are appropriate based on their roles and backgrounds. The 'gender' field should indicate the character's gender, taking into account their names and the context of the story. The 'current_job' field should indicate the character's current job, taking into account their relationships and backgrounds. The 'additional_desc' field should provide additional information about the character, such as their species or profession."
+            )
+        },
+        {
+            "role": "user",
+            "content": f"Story: {story}"
+        }
+    ]
 
-def story_humanizer_nonjson(story: str, custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None) -> dict[str, str]:
+def extract_characters(story: str) -> List[Character]:
+    # Raises StructuredOutputError when the answer still does not match ExtractedCharacters after a repair
+    return structured_completion(
+        ExtractedCharacters,
+        task="extraction",
+        messages=extract_characters_messages(story),
+        top_p=1,
+        stream=False,
+        stop=None,
+    ).characters
+
+def characters_scan_json(characters: List[Character]) -> str:
+    # The UI parses the scan result from this string
+    return json.dumps({"characters": [character.model_dump(exclude_none=True) for character in characters]}, indent=4)
+
+def humanizer_messages(story: str, custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None, part: Optional[tuple] = None) -> List[dict]:
     # Construct character data
-    character_data = []
-    if custom_characters:
-        character_data = [char.dict() for char in custom_characters]
+    # Joined from cached fragments, see everglen_prompts
+    character_data = characters_prompt_json(custom_characters) if custom_characters else ""
+    optional_params = relationships_prompt_json(relationships) if relationships else ""
 
-    optional_params = {}
-    if relationships:
-        optional_params['relationships'] = [rel.dict() for rel in relationships]
-        
-    try:
-        completion1 = client.chat.completions.create(
-            model="mixtral-8x7b-32768",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a story improver. Rewrite this story in a witty, engaging, and emotionally resonant tone that is suitable for a high school setting. Here are some examples of the type of story I'm looking for: 'Nick and Charlie' by Alice Oseman, 'The Perks of Being a Wallflower' by Stephen Chbosky, and 'Paper Towns' by John Green."
-
-                },
-                {
-                    "role": "user",
-                    "content": f"Rewrite the following story: {story}. "
-                        f"{', and use the following custom characters when they are mentioned by name within the story: ' + json.dumps(character_data) if custom_characters else ''}"
-                        f"{', and incorporate the relationships between the mentioned characters when writing the story : ' + json.dumps(optional_params) if optional_params else ''}"
-                        f"{', Do not append the custom characters and relationships at the end of the story as these are only to be used while rewriting the story.' if custom_characters or optional_params else '' }"
-                }
-            ],
-            temperature=0.8,
-            max_tokens=1024,
-            top_p=1,
-            stream=False,
-            stop=None,
-        )
-        
-        improved_story = completion1.choices[0].message.content
-        
-        completion2 = client.chat.completions.create(
-            model="mixtral-8x7b-32768",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a title generator. Generate a catchy and relevant title for the following story. Please provide only one title option. Do not make the title too long."
-                },
-                {
-                    "role": "user",
-                    "content": f"Generate a title for the story: {improved_story}."
-                }
-            ],
-            temperature=0.8,
-            max_tokens=1024,
-            top_p=1,
-            stream=False,
-            stop=None,
+    # part is (number, count, text before, text after) when story is one chunk of a longer story
+    part_instructions = ""
+    if part:
+        number, count, before, after = part
+        part_instructions = (
+            f", This is part {number} of {count} of a longer story, so rewrite only this part and do not add an introduction or an ending to it"
+            f"{'. For continuity, the part before it ends with: ' + json.dumps(before) if before else ''}"
+            f"{'. The part after it starts with: ' + json.dumps(after) if after else ''}"
+            f"{'. Do not rewrite or repeat these excerpts' if before or after else ''}"
         )
-        
-        title = completion2.choices[0].message.content
-        output = {"improved_story": improved_story, "title": title}
-        
-        return output
-    except Exception as e:
-        print("Error in story_humanizer_nonjson:")
-        
-def summary_and_location_generator(story: str, custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None) -> dict[str, str]:
-    # Construct character data
-    character_data = []
-    if custom_characters:
-        character_data = [char.dict() for char in custom_characters]
 
-    optional_params = {}
-    if relationships:
-        optional_params['relationships'] = [rel.dict() for rel in relationships]
+    return [
+        {
+            "role": "system",
+            "content": "You are a story improver. Rewrite this story in a witty, engaging, and emotionally resonant tone that is suitable for a high school setting. Here are some examples of the type of story I'm looking for: 'Nick and Charlie' by Alice Oseman, 'The Perks of Being a Wallflower' by Stephen Chbosky, and 'Paper Towns' by John Green."
+
+        },
+        {
+            "role": "user",
+            "content": f"Rewrite the following story: {story}. "
+                f"{', and use the following custom characters when they are mentioned by name within the story: ' + character_data if custom_characters else ''}"
+                f"{', and incorporate the relationships between the mentioned characters when writing the story : ' + optional_params if optional_params else ''}"
+                f"{', Do not append the custom characters and relationships at the end of the story as these are only to be used while rewriting the story.' if custom_characters or optional_params else '' }"
+                f"{part_instructions}"
+        }
+    ]
+
+def title_messages(story: str) -> List[dict]:
+    return [
+        {
+            "role": "system",
+            "content": "You are a title generator. Generate a catchy and relevant title for the following story. Please provide only one title option. Do not make the title too long."
+        },
+        {
+            "role": "user",
+            "content": f"Generate a title for the story: {story}."
+        }
+    ]
+
+def generate_title(story: str) -> str:
+    completion = chat_completion(
+        task="title",
+        messages=title_messages(story),
+        top_p=1,
+        stream=False,
+        stop=None,
+    )
+    
+    return completion.choices[0].message.content
+
+def rewrite_chunk(story: str, custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None, part: Optional[tuple] = None) -> str:
+    completion = chat_completion(
+        cache=False,
+        task="rewrite",
+        messages=humanizer_messages(story, custom_characters, relationships, part),
+        top_p=1,
+        stream=False,
+        stop=None,
+    )
     
+    return completion.choices[0].message.content
+
+def rewrite_parts(chunks: List[str]) -> Iterator[tuple]:
+    # (index, part for humanizer_messages) of every chunk that is rewritten; scene breaks are kept as they are
+    for index, chunk in enumerate(chunks):
+        if not is_scene_break(chunk):
+            before, after = chunk_context(chunks, index, HUMANIZE_OVERLAP_CHARACTERS)
+            yield index, (index + 1, len(chunks), before, after)
+
+def rewrite_chunks(chunks: List[str], custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None) -> Iterator[tuple]:
+    # Rewrites every chunk at the same time (at most HUMANIZE_PARALLELISM at once) and yields (index, text) as each finishes
+    with ThreadPoolExecutor(max_workers=max(1, min(HUMANIZE_PARALLELISM, len(chunks)))) as executor:
+        futures = {
+            executor.submit(rewrite_chunk, chunks[index], custom_characters, relationships, part): index
+            for index, part in rewrite_parts(chunks)
+        }
+        # Headings and break markers are kept as they are
+        for index, chunk in enumerate(chunks):
+            if is_scene_break(chunk):
+                yield index, chunk
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def rewrite_story(story: str, custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None) -> str:
+    # Long stories are rewritten chunk by chunk, all at once, and put back together in order,
+    # so they come back whole instead of being cut off at the completion limit
+    chunks = split_story(story, HUMANIZE_CHUNK_TOKENS)
+    if len(chunks) == 1:
+        return rewrite_chunk(story, custom_characters, relationships)
+
+    rewritten = [None] * len(chunks)
+    for index, text in rewrite_chunks(chunks, custom_characters, relationships):
+        rewritten[index] = text.strip()
+    logger.info("story rewritten in chunks chunks=%d", len(chunks))
+    return CHUNK_SEPARATOR.join(rewritten)
+
+def story_humanizer_nonjson(story: str, custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None) -> dict[str, str]:
+    # Raises GenerationError when the rewrite or the title fails
     try:
-        completion1 = client.chat.completions.create(
-            model="mixtral-8x7b-32768",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a story descriptor. Summarize a plot of the entire story in one paragraph."
-
-                },
-                {
-                    "role": "user",
-                    "content": f"Summarize the following story: {story}. "
-                        f"{', and use the following custom characters when they are mentioned by name within the story: ' + json.dumps(character_data) if custom_characters else ''}"
-                        f"{', and apply the following optional parameters: ' + json.dumps(optional_params) if optional_params else ''}"
-                }
-            ],
-            temperature=0.8,
-            max_tokens=1024,
-            top_p=1,
-            stream=False,
-            stop=None,
-        )
-        
-        shortened_plot = completion1.choices[0].message.content
-        
-        completion2 = client.chat.completions.create(
-            model="mixtral-8x7b-32768",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a story analyzer. Extract the location of the story. If the location is given in the story as Everglen, assume it is Everglen, NY."
-                },
-                {
-                    "role": "user",
-                    "content": f"Get the location of the following story: {story}. Only provide the location in the form city and/or state, for example, Everglen, NY, and do not add other details."
-                }
-            ],
-            temperature=0.8,
-            max_tokens=1024,
-            top_p=1,
-            stream=False,
-            stop=None,
-        )
-        
-        story_location = completion2.choices[0].message.content
-        output = {"summary": shortened_plot, "location": story_location}
-        
-        return output
+        improved_story = rewrite_story(story, custom_characters, relationships)
+        title = generate_title(improved_story)
     except Exception as e:
-        print("Error in story_humanizer_nonjson:")
-        print(str(e))
+        logger.error("story_humanizer_nonjson failed error=%s message=%s", type(e).__name__, e)
+        raise GenerationError("humanized story", e) from e
+    return {"improved_story": improved_story, "title": title}
+
+def story_humanizer_stream(story: str, custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None) -> Iterator[str]:
+    # Streaming counterpart of the rewrite step in story_humanizer_nonjson
+    chunks = split_story(story, HUMANIZE_CHUNK_TOKENS)
+    if len(chunks) > 1:
+        # Chunks are rewritten side by side and sent in story order, each as soon as it and the ones before it are done
+        rewritten = {}
+        next_index = 0
+        for index, text in rewrite_chunks(chunks, custom_characters, relationships):
+            rewritten[index] = text.strip()
+            while next_index in rewritten:
+                yield (CHUNK_SEPARATOR if next_index else "") + rewritten.pop(next_index)
+                next_index += 1
+        return
+
+    stream = chat_completion(
+        task="rewrite",
+        messages=humanizer_messages(story, custom_characters, relationships),
+        top_p=1,
+        stream=True,
+        stop=None,
+    )
+    for chunk in stream:
+        token = chunk.choices[0].delta.content
+        if token:
+            yield token
         
-def plot_hole_detector(stories: List[str], custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None) -> str:
+def summarize_story(story: str, custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None) -> str:
     # Construct character data
-    character_data = []
-    if custom_characters:
-        character_data = [char.dict() for char in custom_characters]
+    # Joined from cached fragments, see everglen_prompts
+    character_data = characters_prompt_json(custom_characters) if custom_characters else ""
+    optional_params = relationships_prompt_json(relationships) if relationships else ""
+    
+    completion = chat_completion(
+        task="extraction",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a story descriptor. Summarize a plot of the entire story in one paragraph."
 
-    optional_params = {}
-    if relationships:
-        optional_params['relationships'] = [rel.dict() for rel in relationships]
-        
+            },
+            {
+                "role": "user",
+                "content": f"Summarize the following story: {story}. "
+                    f"{', and use the following custom characters when they are mentioned by name within the story: ' + character_data if custom_characters else ''}"
+                    f"{', and apply the following optional parameters: ' + optional_params if optional_params else ''}"
+            }
+        ],
+        top_p=1,
+        stream=False,
+        stop=None,
+    )
+    
+    return completion.choices[0].message.content
+
+def extract_location(story: str) -> str:
+    completion = chat_completion(
+        task="location",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a story analyzer. Extract the location of the story. If the location is given in the story as Everglen, assume it is Everglen, NY."
+            },
+            {
+                "role": "user",
+                "content": f"Get the location of the following story: {story}. Only provide the location in the form city and/or state, for example, Everglen, NY, and do not add other details."
+            }
+        ],
+        top_p=1,
+        stream=False,
+        stop=None,
+    )
+    
+    return completion.choices[0].message.content
+
+def summary_and_location_generator(story: str, custom_characters: Optional[List[Character]] = None, relationships: Optional[List[Relationship]] = None) -> dict[str, str]:
+    # Raises GenerationError when either call fails
     try:
-        completion = client.chat.completions.create(
-            model="mixtral-8x7b-32768",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a story analyzer. The stories are arranged in chronological order from the first story to the latest. Find any plot holes in the series of stories, also checking if a later story is inconsistent with any previous ones."
-                        "Ensure that the output is in JSON format with the following schema:\n"
-                        "{\n"
-                        "  \"plot_holes\": {\"type\": \"array\", \"items\": {\"type\": \"string\"}}\n"
-                        "}\n"
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": f"Analyze these stories: {stories}, and list all plot holes."
-                        f"{', and use the following custom characters when they are mentioned by name within each plot hole: ' + json.dumps(character_data) if custom_characters else ''}"
-                        f"{', and apply the following optional parameters: ' + json.dumps(optional_params) if optional_params else ''}"
-                }
-            ],
-            temperature=0.8,
-            max_tokens=1024,
-            top_p=1,
-            stream=False,
-            response_format={"type": "json_object"},
-            stop=None,
+        # The summary and the location do not depend on each other, so both calls go out at once
+        shortened_plot, story_location = run_concurrently(
+            lambda: summarize_story(story, custom_characters, relationships),
+            lambda: extract_location(story)
         )
-        
-        plot_holes = json.loads(completion.choices[0].message.content)
-        plot_holes_json = json.dumps(plot_holes, indent=4)  # Pretty-print the JSON
-        return plot_holes_json
     except Exception as e:
-        print("Error in story_humanizer_nonjson:")
-        print(str(e))
+        logger.error("summary_and_location_generator failed error=%s message=%s", type(e).__name__, e)
+        raise GenerationError("summary and location", e) from e
+    return {"summary": shortened_plot, "location": story_location}
+        
+'''
+JSON API v2, see everglen_api_v2.py.
+Imported last because its routes use the helpers above.
+'''
+from everglen_api_v2 import api_v2
+app.register_blueprint(api_v2)
+
+'''
+Background jobs are picked up once the app serves its first request, not when it is imported.
+'''
+@app.before_request
+def start_job_workers():
+    start_workers()
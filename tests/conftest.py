@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# The modules live at the top of the repository, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# everglen_web opens its database and the LLM cache when it is imported: both go to a folder of their own,
+# and no call reaches Groq (the tests that need answers serve them from bench/fake_groq.py)
+TEST_DIRECTORY = tempfile.mkdtemp(prefix="everglen-tests-")
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ["EVERGLEN_DB_NAME"] = os.path.join(TEST_DIRECTORY, "everglen.db")
+os.environ["LLM_CACHE_PATH"] = os.path.join(TEST_DIRECTORY, "llm_cache.db")
+os.environ["GROQ_BASE_URL"] = "http://127.0.0.1:9"
@@ -0,0 +1,39 @@
+import everglen_web
+import everglen_analysis
+from everglen_models import SeriesDB, StoryDB
+from collections import Counter
+import threading
+import time
+
+def test_analyses_of_one_series_do_not_overlap(monkeypatch):
+    digests = Counter()
+    def digest_episode(story):
+        digests[story] += 1
+        time.sleep(0.2)
+        return [f"fact from {story}"]
+    monkeypatch.setattr(everglen_analysis, "digest_episode", digest_episode)
+    monkeypatch.setattr(everglen_analysis, "check_episode", lambda story, previous_facts: [])
+
+    with everglen_web.app.app_context():
+        series = SeriesDB(series_name="Overlap", series_desc="two analyses at once")
+        everglen_web.db.session.add(series)
+        everglen_web.db.session.commit()
+        for number in (1, 2):
+            everglen_web.db.session.add(StoryDB(story_title=f"Part {number}", episode_number=number, location="the lake",
+                plot="plot", full_story=f"overlap episode {number}", series_id=series.id))
+        everglen_web.db.session.commit()
+        series_id = series.id
+
+    results = []
+    def analyze():
+        with everglen_web.app.app_context():
+            results.append(everglen_analysis.analyze_series(series_id))
+    threads = [threading.Thread(target=analyze) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The second analysis waits for the first and finds nothing left to digest
+    assert digests == {"overlap episode 1": 1, "overlap episode 2": 1}
+    assert sorted(result["episodes_analyzed"] for result in results) == [0, 2]
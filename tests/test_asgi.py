@@ -0,0 +1,68 @@
+import everglen_web  # noqa: F401 (everglen_asgi imports the Flask app)
+import everglen_asgi
+from everglen_asgi import AsyncSingleFlight
+from groq.types.chat import ChatCompletion
+from starlette.testclient import TestClient
+from types import SimpleNamespace
+import asyncio
+import groq
+import httpx
+import json
+import pytest
+
+def answer(content):
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "test-model",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+    })
+
+@pytest.fixture
+def asgi_client(monkeypatch):
+    # The job workers are shared with the rest of the tests, so the lifespan only records that it started and stopped them
+    lifecycle = []
+    monkeypatch.setattr(everglen_asgi, "start_workers", lambda: lifecycle.append("start"))
+    monkeypatch.setattr(everglen_asgi, "stop_workers", lambda: lifecycle.append("stop"))
+    calls = []
+    async def create(**kwargs):
+        calls.append(kwargs)
+        if "response_format" in kwargs:
+            return answer(json.dumps({"title": "Storm", "plot": "A storm hits the harbor."}))
+        return answer("The wind rose over the harbor.")
+    with TestClient(everglen_asgi.app) as client:
+        monkeypatch.setattr(everglen_asgi, "async_client", SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+        yield SimpleNamespace(client=client, calls=calls, lifecycle=lifecycle)
+    assert lifecycle == ["start", "stop"]
+
+def test_story_is_generated_with_the_async_client(asgi_client):
+    response = asgi_client.client.post('/api/stories/generate', content='location=Harbor&summary=A storm&series[id]=1&characters[0][id]=1')
+    assert response.status_code == 200
+    assert response.json() == {"story_title": "Storm", "story": "The wind rose over the harbor."}
+    assert [("response_format" in call, call["temperature"]) for call in asgi_client.calls] == [(True, 1), (False, 0.7)]
+
+def test_other_routes_are_served_by_flask(asgi_client):
+    response = asgi_client.client.get('/api/characters/list')
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
+    assert asgi_client.calls == []
+
+def test_failed_humanize_is_a_bad_gateway(asgi_client, monkeypatch):
+    async def create(**kwargs):
+        raise groq.AuthenticationError("Invalid API key", response=httpx.Response(401, request=httpx.Request("POST", "http://groq")), body=None)
+    monkeypatch.setattr(everglen_asgi.async_client.chat.completions, "create", create)
+    response = asgi_client.client.post('/api/stories/humanize', content='original_story=The tide came in.&story_characters[0][id]=1')
+    assert response.status_code == 502
+    assert response.json()['message'] == 'HUMANIZE_FAILED'
+
+def test_coroutines_in_flight_share_one_call():
+    flights = AsyncSingleFlight()
+    calls = []
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+    async def main():
+        return await asyncio.gather(*(flights.run("key", call) for _ in range(5)))
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert results == [("result", False)] + [("result", True)] * 4
+    assert flights.flights == {}
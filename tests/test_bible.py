@@ -0,0 +1,68 @@
+import everglen_web
+import everglen_bible
+from everglen_bible import update_series_bible, bible_context
+from everglen_models import SeriesDB, StoryDB
+import os
+import pytest
+import sqlite3
+
+def new_series(*plots):
+    series = SeriesDB(series_name="Bible", series_desc="a series with a bible")
+    everglen_web.db.session.add(series)
+    everglen_web.db.session.commit()
+    for plot in plots:
+        add_episode(series.id, plot)
+    return series.id
+
+def add_episode(series_id, plot):
+    number = StoryDB.query.filter_by(series_id=series_id).count() + 1
+    everglen_web.db.session.add(StoryDB(series_id=series_id, episode_number=number, story_title=f"Episode {number}",
+        location="Everglen", plot=plot, full_story=plot))
+    everglen_web.db.session.commit()
+
+def fake_fold(calls, fail_after=None):
+    def fold_episodes(bible, episodes):
+        # Another writer must get the SQLite write lock while Groq is being called
+        with sqlite3.connect(os.environ["EVERGLEN_DB_NAME"], timeout=0) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.rollback()
+        if fail_after is not None and len(calls) == fail_after:
+            raise RuntimeError("Groq is down")
+        calls.append([text for _, text in episodes])
+        return {
+            "summary": " ".join(filter(None, [bible["summary"]] + calls[-1])),
+            "character_states": {"Maya": f"after {episodes[-1][0].story_title}"},
+            "open_threads": []
+        }
+    return fold_episodes
+
+def test_only_new_episodes_are_folded_in(monkeypatch):
+    calls = []
+    monkeypatch.setattr(everglen_bible, "fold_episodes", fake_fold(calls))
+    with everglen_web.app.app_context():
+        series_id = new_series("Maya joins the band.", "The band plays a gig.")
+        assert update_series_bible(series_id)["episodes_added"] == 2
+        assert update_series_bible(series_id)["episodes_added"] == 0
+        add_episode(series_id, "The band splits up.")
+        bible = update_series_bible(series_id)
+        context = bible_context(series_id)
+    assert calls == [["Maya joins the band.", "The band plays a gig."], ["The band splits up."]]
+    assert bible["last_episode_number"] == 3
+    assert context == "Story so far (up to episode 3): Maya joins the band. The band plays a gig. The band splits up. Characters now: Maya: after Episode 3."
+
+def test_failed_update_keeps_the_batches_already_folded_in(monkeypatch):
+    calls = []
+    monkeypatch.setattr(everglen_bible, "fold_episodes", fake_fold(calls, fail_after=1))
+    monkeypatch.setattr(everglen_bible, "BIBLE_BATCH_CHARS", 10)
+    with everglen_web.app.app_context():
+        series_id = new_series("First day of term.", "The lockers are flooded.")
+        with pytest.raises(RuntimeError):
+            update_series_bible(series_id)
+        everglen_web.db.session.rollback()
+        assert everglen_bible.get_series_bible(series_id)["last_episode_number"] == 1
+    assert calls == [["First day of term."]]
+
+def test_no_bible_no_context():
+    with everglen_web.app.app_context():
+        assert bible_context(new_series()) == ""
+        assert bible_context(None) == ""
@@ -0,0 +1,67 @@
+import everglen_web
+from everglen_models import CharacterDB
+import json
+
+def export(client):
+    return [json.loads(line) for line in client.get('/api/characters/export').get_data(as_text=True).splitlines()]
+
+def test_export_passes_on_plain_text_languages():
+    client = everglen_web.app.test_client()
+    with everglen_web.app.app_context():
+        rows = [
+            CharacterDB(character_name="Old Row", character_age=30, character_gender="f", character_personality="warm", native_languages="English, Tagalog"),
+            CharacterDB(character_name="New Row", character_age=31, character_gender="m", character_personality="dry", native_languages='["Dutch"]')
+        ]
+        everglen_web.db.session.add_all(rows)
+        everglen_web.db.session.commit()
+        refs = [row.id for row in rows]
+    records = {record['ref']: record for record in export(client) if record['type'] == "character"}
+    assert records[refs[0]]['native_languages'] == "English, Tagalog"
+    assert records[refs[1]]['native_languages'] == ["Dutch"]
+
+def character_count():
+    with everglen_web.app.app_context():
+        return everglen_web.db.session.query(CharacterDB).count()
+
+def test_invalid_records_are_all_reported_and_nothing_is_written():
+    client = everglen_web.app.test_client()
+    before = character_count()
+    records = '{"ref": "n", "name": "Nia", "age": 16, "gender": "f", "personality": "keen"}\n' \
+        '{"ref": "o", "name": "Oz", "age": "old", "gender": "m", "personality": "odd"}\n' \
+        'not json\n'
+    response = client.post('/api/characters/import', data=records)
+    assert response.status_code == 400
+    assert [error['record'] for error in response.get_json()['errors']] == [3]
+
+    records = '[{"ref": "n", "name": "Nia", "age": 16, "gender": "f", "personality": "keen"},' \
+        '{"ref": "o", "name": "Oz", "age": "old", "gender": "m", "personality": "odd"},' \
+        '{"relation_subject": "n", "relation_object": "nobody", "relation": "friends"}]'
+    response = client.post('/api/characters/import', data=records)
+    assert response.status_code == 400
+    assert [error['record'] for error in response.get_json()['errors']] == [2]
+    records = '{"characters": [{"ref": "n", "name": "Nia", "age": 16, "gender": "f", "personality": "keen"}],' \
+        '"relationships": [{"relation_subject": "n", "relation_object": "nobody", "relation": "friends"}]}'
+    response = client.post('/api/characters/import', data=records)
+    assert response.status_code == 400
+    assert [error['record'] for error in response.get_json()['errors']] == [2]
+    assert character_count() == before
+
+def test_export_can_be_imported_again():
+    client = everglen_web.app.test_client()
+    imported = client.post('/api/characters/import', data='{"characters": ['
+        '{"ref": "p", "name": "Pia", "age": 16, "gender": "f", "personality": "sly", "native_languages": ["Italian"]},'
+        '{"ref": "q", "name": "Quin", "age": 17, "gender": "m", "personality": "shy"}],'
+        '"relationships": [{"relation_subject": "p", "relation_object": "q", "relation": "twins"}]}').get_json()
+    ids = set(imported['character_ids'].values())
+    assert imported['relationships_added'] == 1
+
+    records = [record for record in export(client)
+        if record.get('ref') in ids or record.get('relation_subject') in ids]
+    reimported = client.post('/api/characters/import', data="\n".join(json.dumps(record) for record in records)).get_json()
+    copies = reimported['character_ids']
+    assert set(copies) == {str(character_id) for character_id in ids}
+    copy_of_pia = copies[str(imported['character_ids']['p'])]
+    relationships = client.get(f'/api/characters/view/{copy_of_pia}').get_json()['relationships']
+    assert [(rel['relation_object'], rel['relation']) for rel in relationships] == [(copies[str(imported['character_ids']['q'])], "twins")]
+    exported = {record['ref']: record for record in export(client) if record['type'] == "character"}
+    assert exported[copy_of_pia]['native_languages'] == ["Italian"]
@@ -0,0 +1,38 @@
+import everglen_web
+from everglen_graph import relationship_graph
+from sqlalchemy import event
+
+def add_character(client, name):
+    client.post('/api/characters/add', data=f'name={name}&age=16&gender=f&personality=shy&high_school_clique=n&current_job=none&additional_desc=none&cultural_background=none')
+    return [row['id'] for row in client.get('/api/characters/list').get_json() if row['character_name'] == name][0]
+
+def count_queries(function):
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    engine = everglen_web.db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        result = function()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return result, [statement for statement in statements if statement.lstrip().upper().startswith("SELECT")]
+
+def test_cast_is_loaded_with_the_same_queries_whatever_its_size():
+    client = everglen_web.app.test_client()
+    ids = [add_character(client, f"Castmate {number}") for number in range(6)]
+    for subject, object in zip(ids, ids[1:]):
+        client.post('/api/relationships/add', data=f'relation_subject={subject}&relation_object={object}&relation=classmates')
+
+    with everglen_web.app.app_context():
+        relationship_graph.refresh()
+        (small_cast, small_relationships), small_queries = count_queries(lambda: everglen_web.load_cast(ids[:2]))
+        (cast, relationships), queries = count_queries(lambda: everglen_web.load_cast(ids))
+
+    assert len(queries) == len(small_queries) <= 2
+    assert [character.name for character in cast] == [f"Castmate {number}" for number in range(6)]
+    # Each relationship once, even when both ends are in the cast
+    assert len(relationships) == 5
+    # The first two are related to each other and the second to the third, who comes along for the prompt
+    assert len(small_cast) == 2
+    assert len(small_relationships) == 2
@@ -0,0 +1,48 @@
+import everglen_web
+from everglen_models import CharacterDB, RelationshipDB
+
+def test_cast_is_added_in_order():
+    client = everglen_web.app.test_client()
+    cast = [{"name": f"Extra {number}", "age": 20 + number, "gender": "female", "personality": "quiet"} for number in range(3)]
+    response = client.post('/api/v2/characters', json=cast)
+    assert response.status_code == 200
+    character_ids = response.get_json()['character_ids']
+    with everglen_web.app.app_context():
+        names = [everglen_web.db.session.get(CharacterDB, character_id).character_name for character_id in character_ids]
+    assert names == ["Extra 0", "Extra 1", "Extra 2"]
+    assert client.post('/api/v2/characters', json=[]).get_json()['character_ids'] == []
+
+def test_import_links_relationships_to_new_characters():
+    records = '{"ref": "a", "name": "Ana", "age": 16, "gender": "female", "personality": "bold"}\n' \
+        '{"ref": "b", "name": "Ben", "age": 17, "gender": "male", "personality": "calm"}\n' \
+        '{"relation_subject": "a", "relation_object": "b", "relation": "rivals"}\n'
+    response = everglen_web.app.test_client().post('/api/characters/import', data=records)
+    imported = response.get_json()
+    assert response.status_code == 200, imported
+    with everglen_web.app.app_context():
+        relationship = everglen_web.db.session.query(RelationshipDB).order_by(RelationshipDB.id.desc()).first()
+    assert (relationship.char_subject_id, relationship.char_object_id) == (imported['character_ids']['a'], imported['character_ids']['b'])
+
+def test_v1_relationships_have_no_row_version():
+    client = everglen_web.app.test_client()
+    client.post('/api/characters/add', data='name=Cy&age=16&gender=m&personality=shy&high_school_clique=n&current_job=none&additional_desc=none&cultural_background=none')
+    client.post('/api/characters/add', data='name=Di&age=17&gender=f&personality=loud&high_school_clique=j&current_job=none&additional_desc=none&cultural_background=none')
+    with everglen_web.app.app_context():
+        subject_id, object_id = [row.id for row in everglen_web.db.session.query(CharacterDB.id).order_by(CharacterDB.id.desc()).limit(2)][::-1]
+    client.post('/api/relationships/add', data=f'relation_subject={subject_id}&relation_object={object_id}&relation=cousins')
+    relationships = client.get(f'/api/characters/view/{subject_id}').get_json()['relationships']
+    assert [set(rel) for rel in relationships] == [{'relation_id', 'relation_subject', 'relation_object', 'relation'}]
+    edges = client.get(f'/api/characters/graph?ids={subject_id}').get_json()['edges']
+    assert all('version' not in edge for edge in edges)
+
+def test_v2_passes_on_plain_text_languages():
+    client = everglen_web.app.test_client()
+    with everglen_web.app.app_context():
+        row = CharacterDB(character_name="Ed", character_age=40, character_gender="m", character_personality="gruff", native_languages="Welsh and English")
+        everglen_web.db.session.add(row)
+        everglen_web.db.session.commit()
+        character_id = row.id
+    response = client.get(f'/api/v2/characters/{character_id}')
+    assert response.status_code == 200
+    assert response.get_json()['character']['native_languages'] == "Welsh and English"
+    assert client.get('/api/v2/characters').status_code == 200
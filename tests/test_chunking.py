@@ -0,0 +1,32 @@
+from everglen_chunking import split_story, is_scene_break, CHUNK_SEPARATOR
+
+STORY = (
+    "Mara left the village before dawn.\n\n"
+    "The road was empty for miles.\n\n"
+    "## Chapter Two\n\n"
+    "By noon she reached the river.\n\n"
+    "* * *\n\n"
+    "The ferryman would not take her coins.\n\n"
+    "---\n\n"
+    "She crossed at the ford instead.\n\n"
+    "~~~\n\n"
+    "Night fell on the far bank."
+)
+
+def test_split_join_round_trip_keeps_headings_and_markers():
+    chunks = split_story(STORY, 10)
+    assert len(chunks) > 1
+    assert CHUNK_SEPARATOR.join(chunks) == STORY
+
+def test_scene_breaks_are_chunks_of_their_own():
+    chunks = split_story(STORY, 10)
+    breaks = [chunk for chunk in chunks if is_scene_break(chunk)]
+    assert breaks == ["## Chapter Two", "* * *", "---", "~~~"]
+    assert not any(is_scene_break(chunk) for chunk in chunks if chunk not in breaks)
+
+def test_blank_space_around_breaks_is_normalized():
+    story = STORY.replace("\n\n## Chapter Two\n\n", "\n \n## Chapter Two  \n\n\n")
+    assert CHUNK_SEPARATOR.join(split_story(story, 10)) == STORY
+
+def test_story_within_budget_is_one_chunk():
+    assert split_story(STORY, 10000) == [STORY]
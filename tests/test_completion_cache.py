@@ -0,0 +1,49 @@
+import everglen_web  # noqa: F401 (everglen_llm is imported through everglen_web)
+from everglen_llm import CompletionCache, completion_cache_key
+import everglen_llm
+import os
+
+def new_cache(tmp_path, memory_entries=16, ttl_seconds=60, max_bytes=1024):
+    return CompletionCache(os.path.join(tmp_path, "cache.db"), memory_entries, ttl_seconds, max_bytes)
+
+def test_key_covers_the_whole_request_in_any_order():
+    messages = [{"role": "user", "content": "Hi"}]
+    assert completion_cache_key(model="m", messages=messages, temperature=0) == completion_cache_key(temperature=0, messages=messages, model="m")
+    assert completion_cache_key(model="m", messages=messages, temperature=0) != completion_cache_key(model="m", messages=messages, temperature=1)
+    assert completion_cache_key(model="m", messages=messages) != completion_cache_key(model="n", messages=messages)
+
+def test_entries_dropped_from_memory_come_back_from_the_file(tmp_path):
+    cache = new_cache(tmp_path, memory_entries=1)
+    cache.put("a", "first")
+    cache.put("b", "second")
+    assert list(cache.memory) == ["b"]
+    assert cache.get("a") == "first"
+    assert list(cache.memory) == ["a"]
+    # Another worker process opens the same file
+    assert new_cache(tmp_path).get("b") == "second"
+
+def test_entries_expire(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(everglen_llm.time, "time", lambda: now[0])
+    cache = new_cache(tmp_path, ttl_seconds=60)
+    cache.put("a", "first")
+    now[0] += 59
+    assert cache.get("a") == "first"
+    now[0] += 2
+    assert cache.get("a") is None
+    assert new_cache(tmp_path).get("a") is None
+
+def test_size_cap_evicts_the_least_recently_used(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(everglen_llm.time, "time", lambda: now[0])
+    cache = new_cache(tmp_path, memory_entries=0, max_bytes=25)
+    for key in ("a", "b"):
+        now[0] += 1
+        cache.put(key, key * 10)
+    now[0] += 1
+    cache.get("a")
+    now[0] += 1
+    cache.put("c", "c" * 10)
+    assert cache.get("b") is None
+    assert cache.get("a") == "a" * 10
+    assert cache.get("c") == "c" * 10
@@ -0,0 +1,45 @@
+import everglen_web
+from everglen_graph import relationship_graph
+import os
+import sqlite3
+
+def count_rebuilds(monkeypatch):
+    rebuilds = []
+    rebuild = relationship_graph.rebuild
+    monkeypatch.setattr(relationship_graph, "rebuild", lambda version=None: rebuilds.append(version) or rebuild(version))
+    return rebuilds
+
+def add_character(client, name):
+    client.post('/api/characters/add', data=f'name={name}&age=16&gender=f&personality=shy&high_school_clique=n&current_job=none&additional_desc=none&cultural_background=none')
+    return [row['id'] for row in client.get('/api/characters/list').get_json() if row['character_name'] == name][0]
+
+def test_writes_from_this_process_do_not_rebuild(monkeypatch):
+    client = everglen_web.app.test_client()
+    first, second, third = (add_character(client, name) for name in ("Ada", "Bea", "Cal"))
+    with everglen_web.app.app_context():
+        relationship_graph.refresh()
+    rebuilds = count_rebuilds(monkeypatch)
+
+    client.post('/api/relationships/add', data=f'relation_subject={first}&relation_object={second}&relation=sisters')
+    client.post('/api/relationships/add', data=f'relation_subject={second}&relation_object={third}&relation=rivals')
+    relation_id = client.get(f'/api/characters/view/{first}').get_json()['relationships'][0]['relation_id']
+    client.post('/api/relationships/edit', data=f'relation_id={relation_id}&relation_subject={first}&relation_object={third}&relation=cousins')
+    client.post('/api/characters/import', data='{"ref": "d", "name": "Dov", "age": 16, "gender": "m", "personality": "calm"}\n'
+        f'{{"relation_subject": "d", "relation_object": {first}, "relation": "neighbours"}}\n')
+    with everglen_web.app.app_context():
+        assert {edge['relation'] for edge in relationship_graph.neighbors(first)} == {"cousins", "neighbours"}
+        assert {edge['relation'] for edge in relationship_graph.neighbors(second)} == {"rivals"}
+    assert rebuilds == []
+
+def test_write_from_another_process_rebuilds_once(monkeypatch):
+    client = everglen_web.app.test_client()
+    first, second = (add_character(client, name) for name in ("Eli", "Fay"))
+    with everglen_web.app.app_context():
+        relationship_graph.refresh()
+    rebuilds = count_rebuilds(monkeypatch)
+    with sqlite3.connect(os.environ["EVERGLEN_DB_NAME"]) as connection:
+        connection.execute("INSERT INTO relationships (char_subject_id, char_object_id, relation) VALUES (?, ?, 'pen pals')", (first, second))
+    with everglen_web.app.app_context():
+        assert [edge['relation'] for edge in relationship_graph.neighbors(first)] == ["pen pals"]
+        relationship_graph.neighbors(second)
+    assert len(rebuilds) == 1
@@ -0,0 +1,105 @@
+import everglen_web
+from everglen_models import JobDB
+from everglen_jobs import job_pipeline, submit_job, start_workers, resume_pending_jobs, requeue_job, JOB_LEASE
+from datetime import datetime, timedelta
+import json
+import os
+import pytest
+import subprocess
+import sys
+import time
+import uuid
+
+calls = []
+
+@pytest.fixture(autouse=True)
+def workers():
+    start_workers()
+
+@job_pipeline("test_resume", ["outline", "draft"])
+def resume_job(job, payload):
+    def outline():
+        calls.append("outline")
+        return payload["idea"] + " outline"
+
+    def draft(outline):
+        calls.append("draft")
+        return outline + " drafted"
+
+    outline_text = job.run_stage("outline", outline)
+    return {"draft": job.run_stage("draft", draft, outline_text)}
+
+def interrupted_job(lease_expires_at, idea="a storm"):
+    # A job as a worker that died during its second stage leaves it
+    now = datetime.utcnow()
+    job = JobDB(
+        id=uuid.uuid4().hex,
+        job_type="test_resume",
+        status="running",
+        current_stage="draft",
+        progress=json.dumps([
+            {"stage": "outline", "status": "done", "started_at": now.isoformat(), "finished_at": now.isoformat()},
+            {"stage": "draft", "status": "running", "started_at": now.isoformat(), "finished_at": None},
+        ]),
+        stage_results=json.dumps({"outline": "a storm outline"}),
+        payload=json.dumps({"idea": idea}),
+        lease_expires_at=lease_expires_at,
+    )
+    everglen_web.db.session.add(job)
+    everglen_web.db.session.commit()
+    return job.id
+
+def wait_for(job_id, status, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        everglen_web.db.session.expire_all()
+        job = everglen_web.db.session.get(JobDB, job_id)
+        if job.status == status:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} is {job.status}, not {status}")
+
+def test_job_resumes_after_restart_without_rerunning_finished_stages():
+    calls.clear()
+    with everglen_web.app.app_context():
+        job_id = interrupted_job(datetime.utcnow() - timedelta(seconds=1))
+        resume_pending_jobs()
+        job = wait_for(job_id, "done")
+        assert json.loads(job.result) == {"draft": "a storm outline drafted"}
+        assert [entry["status"] for entry in json.loads(job.progress)] == ["done", "done"]
+        assert job.lease_expires_at is None
+    assert calls == ["draft"]
+
+def test_job_with_a_live_lease_is_left_to_its_worker():
+    calls.clear()
+    with everglen_web.app.app_context():
+        job_id = interrupted_job(datetime.utcnow() + JOB_LEASE)
+        resume_pending_jobs()
+        time.sleep(0.2)
+        everglen_web.db.session.expire_all()
+        assert everglen_web.db.session.get(JobDB, job_id).status == "running"
+    assert calls == []
+
+def test_requeued_job_keeps_finished_stages():
+    with everglen_web.app.app_context():
+        job_id = interrupted_job(datetime.utcnow() + JOB_LEASE)
+        job = everglen_web.db.session.get(JobDB, job_id)
+        requeue_job(job)
+        everglen_web.db.session.commit()
+        assert job.status == "queued" and job.current_stage is None
+        assert [entry["status"] for entry in json.loads(job.progress)] == ["done", "pending"]
+        assert json.loads(job.stage_results) == {"outline": "a storm outline"}
+        # Cleaned up by running it, so other tests do not find it queued
+        resume_pending_jobs()
+        wait_for(job_id, "done")
+
+def test_importing_the_app_starts_no_threads():
+    # Run in a fresh interpreter: the other tests here have started this process's workers
+    script = "import threading, everglen_web; print(sorted(thread.name for thread in threading.enumerate() if thread.name.startswith('everglen-job')))"
+    output = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(everglen_web.__file__), env=os.environ, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == "[]"
+
+def test_running_job_is_not_submitted_twice():
+    with everglen_web.app.app_context():
+        job_id = interrupted_job(datetime.utcnow() + JOB_LEASE, idea="a flood")
+        assert submit_job("test_resume", {"idea": "a flood"}, dedupe=True).id == job_id
@@ -0,0 +1,59 @@
+import everglen_web  # noqa: F401 (everglen_llm is imported through everglen_web)
+from everglen_llm import RequestScheduler, CompletionEstimates, StreamUsage, settled_stream, estimate_prompt_tokens
+import everglen_llm
+from groq.types.chat import ChatCompletionChunk
+
+def chunk(content, usage=None):
+    return ChatCompletionChunk.model_validate({
+        "id": "chatcmpl-test",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "test-model",
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+        "x_groq": {"id": "chatcmpl-test", "usage": usage, "error": None} if usage else None,
+    })
+
+def test_expected_completion_follows_the_task():
+    estimates = CompletionEstimates()
+    assert estimates.expected("scene", 4000) == 2000
+    estimates.observe("scene", 300)
+    assert estimates.expected("scene", 4000) == 300
+    # Never more than the call may use
+    assert estimates.expected("scene", 100) == 100
+    assert estimates.expected("other", None) == 0
+
+def test_models_have_their_own_budgets():
+    scheduler = RequestScheduler(lambda model: (30, 6000 if model == "small" else 1000))
+    scheduler.acquire(1000, model="large")
+    scheduler.acquire(1000, model="small")
+    assert scheduler.budgets["large"].tokens.level < 1
+    assert scheduler.budgets["small"].tokens.level > 4999
+    scheduler.settle("large", 1000, 400)
+    assert 599 < scheduler.budgets["large"].tokens.level < 601
+
+def settle_stream(monkeypatch, chunks, messages, estimated_tokens):
+    scheduler = RequestScheduler(lambda model: (30, 6000))
+    estimates = CompletionEstimates()
+    monkeypatch.setattr(everglen_llm, "scheduler", scheduler)
+    monkeypatch.setattr(everglen_llm, "completion_estimates", estimates)
+    scheduler.acquire(estimated_tokens, model="test-model")
+    stream = settled_stream(iter(chunks), StreamUsage("rewrite", "test-model", messages, estimated_tokens))
+    return scheduler.budgets["test-model"].tokens, estimates, stream
+
+def test_stream_settles_from_reported_usage(monkeypatch):
+    chunks = [chunk("Once"), chunk(" upon"), chunk(None, {"prompt_tokens": 50, "completion_tokens": 2, "total_tokens": 52})]
+    tokens, estimates, stream = settle_stream(monkeypatch, chunks, [{"role": "user", "content": "x"}], 2000)
+    assert "".join(c.choices[0].delta.content or "" for c in stream) == "Once upon"
+    assert 5947 < tokens.level < 5949
+    assert estimates.averages["rewrite"] == 2
+
+def test_dropped_stream_settles_from_what_came_through(monkeypatch):
+    messages = [{"role": "user", "content": "x" * 400}]
+    chunks = [chunk("a" * 40), chunk("b" * 40), chunk("never read")]
+    tokens, estimates, stream = settle_stream(monkeypatch, chunks, messages, 2000)
+    next(stream)
+    next(stream)
+    stream.close()
+    used = estimate_prompt_tokens(messages) + 80 // 4 + 1
+    assert 6000 - used - 1 < tokens.level < 6000 - used + 1
+    assert estimates.averages["rewrite"] == 80 // 4 + 1
@@ -0,0 +1,36 @@
+import everglen_web
+from everglen_metrics import Counter, Histogram, registry
+
+def test_exposition_format():
+    counter = Counter("test_calls_total", "Calls.", ["model"])
+    histogram = Histogram("test_call_seconds", "Call latency.", ["model"], buckets=(0.1, 1))
+    try:
+        counter.inc(model='a "quoted"\nname')
+        counter.inc(2, model='a "quoted"\nname')
+        histogram.observe(0.5, model="m")
+        assert counter.render() == [
+            "# HELP test_calls_total Calls.",
+            "# TYPE test_calls_total counter",
+            'test_calls_total{model="a \\"quoted\\"\\nname"} 3'
+        ]
+        assert histogram.render()[2:] == [
+            'test_call_seconds_bucket{model="m",le="0.1"} 0',
+            'test_call_seconds_bucket{model="m",le="1"} 1',
+            'test_call_seconds_bucket{model="m",le="+Inf"} 1',
+            'test_call_seconds_sum{model="m"} 0.5',
+            'test_call_seconds_count{model="m"} 1'
+        ]
+    finally:
+        registry.remove(counter)
+        registry.remove(histogram)
+
+def test_requests_show_up_on_the_metrics_route():
+    client = everglen_web.app.test_client()
+    client.get('/api/characters/list')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert 'everglen_http_request_seconds_count{route="/api/characters/list",method="GET",status="200"}' in text
+    assert 'everglen_sql_queries_total{route="/api/characters/list"}' in text
+    assert "# TYPE everglen_llm_requests_total counter" in text
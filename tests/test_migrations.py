@@ -0,0 +1,77 @@
+import everglen_web
+from everglen_migrations import configure_connections, migrate, SCHEMA_VERSION
+from sqlalchemy import create_engine
+import sqlite3
+
+# The tables as the first release created them, before any migration existed
+BASELINE_SCHEMA = """
+CREATE TABLE series (id INTEGER NOT NULL PRIMARY KEY, series_name VARCHAR(150) NOT NULL, series_desc VARCHAR(300) NOT NULL);
+CREATE TABLE stories (id INTEGER NOT NULL PRIMARY KEY, story_title VARCHAR(150) NOT NULL, episode_number INTEGER NOT NULL,
+    location VARCHAR(150) NOT NULL, plot TEXT NOT NULL, full_story TEXT NOT NULL, series_id INTEGER REFERENCES series (id));
+CREATE TABLE characters (id INTEGER NOT NULL PRIMARY KEY, character_name VARCHAR(150) NOT NULL, character_age INTEGER NOT NULL,
+    character_gender VARCHAR(50) NOT NULL, character_personality TEXT NOT NULL, high_school_clique VARCHAR(150), cultural_background TEXT,
+    native_languages TEXT, current_job VARCHAR(150), outfit TEXT, additional_desc TEXT);
+CREATE TABLE relationships (id INTEGER NOT NULL PRIMARY KEY, char_subject_id INTEGER REFERENCES characters (id),
+    char_object_id INTEGER REFERENCES characters (id), relation VARCHAR(150) NOT NULL);
+CREATE TABLE story_characters (id INTEGER NOT NULL PRIMARY KEY, story_id INTEGER REFERENCES stories (id), char_id INTEGER REFERENCES characters (id));
+INSERT INTO series VALUES (1, 'Harbor', 'A fishing town');
+INSERT INTO stories VALUES (1, 'Storm', 1, 'Harbor', 'A storm', 'The lighthouse keeper saw the storm first.', 1);
+INSERT INTO stories VALUES (2, 'Calm', 1, 'Harbor', 'The calm', 'The boats went out again.', 1);
+INSERT INTO characters VALUES (1, 'Maya', 16, 'female', 'bold', NULL, NULL, NULL, NULL, NULL, NULL);
+INSERT INTO characters VALUES (2, 'Jonah', 17, 'male', 'calm', NULL, NULL, NULL, NULL, NULL, NULL);
+INSERT INTO relationships VALUES (1, 1, 2, 'friends');
+"""
+
+def upgrade(path):
+    # What everglen_web does at startup: missing tables first, then the migrations
+    engine = create_engine(f"sqlite:///{path}")
+    configure_connections(engine)
+    everglen_web.db.metadata.create_all(engine)
+    migrate(engine)
+    engine.dispose()
+    return sqlite3.connect(path)
+
+def columns(connection, table):
+    return {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+
+def test_baseline_database_is_upgraded(tmp_path):
+    path = tmp_path / "baseline.db"
+    with sqlite3.connect(path) as connection:
+        connection.executescript(BASELINE_SCHEMA)
+    connection = upgrade(path)
+
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    # Stories saved with the same episode number are renumbered in saving order
+    assert connection.execute("SELECT id, episode_number FROM stories ORDER BY id").fetchall() == [(1, 1), (2, 2)]
+    assert "version" in columns(connection, "characters") and "version" in columns(connection, "relationships")
+    assert connection.execute("SELECT version FROM relationships").fetchall() == [(1,)]
+    # Rows written before the full-text index existed are searchable
+    assert connection.execute("SELECT rowid FROM stories_fts WHERE stories_fts MATCH 'lighthouse'").fetchall() == [(1,)]
+    # Triggers count writes from here on
+    before = dict(connection.execute("SELECT entity, version FROM entity_versions"))
+    connection.execute("UPDATE characters SET character_personality = 'reckless' WHERE id = 1")
+    after = dict(connection.execute("SELECT entity, version FROM entity_versions"))
+    assert after["characters"] == before["characters"] + 1
+    assert after["relationships"] == before["relationships"]
+
+def test_analysis_table_gets_accumulated_digests(tmp_path):
+    path = tmp_path / "version6.db"
+    with sqlite3.connect(path) as connection:
+        connection.executescript(BASELINE_SCHEMA)
+        connection.executescript("""
+            CREATE TABLE episode_analysis (story_id INTEGER NOT NULL PRIMARY KEY REFERENCES stories (id), content_hash VARCHAR(64) NOT NULL,
+                digest TEXT NOT NULL, context_hash VARCHAR(64), plot_holes TEXT, analyzed_at DATETIME NOT NULL);
+            INSERT INTO episode_analysis VALUES (1, 'abc', '{}', NULL, NULL, '2026-01-01 00:00:00');
+        """)
+    connection = upgrade(path)
+    assert {"accumulated_digest", "accumulated_hash"} <= columns(connection, "episode_analysis")
+    assert connection.execute("SELECT story_id, digest, accumulated_digest FROM episode_analysis").fetchall() == [(1, '{}', None)]
+
+def test_migrating_twice_changes_nothing(tmp_path):
+    path = tmp_path / "twice.db"
+    with sqlite3.connect(path) as connection:
+        connection.executescript(BASELINE_SCHEMA)
+    upgrade(path).close()
+    connection = upgrade(path)
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    assert connection.execute("SELECT COUNT(*) FROM stories_fts WHERE stories_fts MATCH 'boats'").fetchone()[0] == 1
@@ -0,0 +1,29 @@
+import everglen_web
+import os
+import sqlite3
+
+def test_etag_follows_writes_from_anywhere():
+    client = everglen_web.app.test_client()
+    first = client.get('/api/characters/list')
+    etag = first.headers['ETag']
+    assert client.get('/api/characters/list', headers={'If-None-Match': etag}).status_code == 304
+    # A series write leaves the character list alone
+    client.post('/api/series/add', data='series_name=Tides&series_desc=A coastal town')
+    assert client.get('/api/characters/list', headers={'If-None-Match': etag}).status_code == 304
+
+    # Written straight to the database, the way another worker process or a script would
+    with sqlite3.connect(os.environ["EVERGLEN_DB_NAME"]) as connection:
+        connection.execute("INSERT INTO characters (character_name, character_age, character_gender, character_personality) VALUES ('Wren', 15, 'female', 'curious')")
+    changed = client.get('/api/characters/list', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert 'Wren' in [character['character_name'] for character in changed.get_json()]
+
+def test_cached_body_is_rebuilt_after_an_edit():
+    client = everglen_web.app.test_client()
+    client.post('/api/characters/add', data='name=Ivo&age=16&gender=m&personality=shy&high_school_clique=n&current_job=none&additional_desc=none&cultural_background=none')
+    character = [row for row in client.get('/api/characters/list').get_json() if row['character_name'] == 'Ivo'][0]
+    assert client.get(f'/api/characters/view/{character["id"]}').get_json()['character']['character_personality'] == 'shy'
+    with sqlite3.connect(os.environ["EVERGLEN_DB_NAME"]) as connection:
+        connection.execute("UPDATE characters SET character_personality = 'brave' WHERE id = ?", (character['id'],))
+    assert client.get(f'/api/characters/view/{character["id"]}').get_json()['character']['character_personality'] == 'brave'
@@ -0,0 +1,99 @@
+import everglen_web  # noqa: F401 (everglen_llm is imported through everglen_web)
+from everglen_routing import ModelRouter, CIRCUIT_FAILURES, CIRCUIT_COOLDOWN_SECONDS, task_settings
+from groq.types.chat import ChatCompletion
+from types import SimpleNamespace
+import everglen_llm
+import everglen_routing
+import groq
+import httpx
+import pytest
+
+MODELS = ["first", "second", "third"]
+
+def groq_error(error_class, status, code=None):
+    response = httpx.Response(status, request=httpx.Request("POST", "http://groq"))
+    return error_class("Groq error", response=response, body={"error": {"code": code}} if code else None)
+
+def answer(model):
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": f"from {model}"}}],
+    })
+
+@pytest.fixture
+def groq_models(monkeypatch):
+    # models -> error to raise, every other model answers; returns the models called, in order
+    router = ModelRouter()
+    monkeypatch.setattr(everglen_llm, "model_router", router)
+    monkeypatch.setenv("LLM_MODELS_TITLE", ",".join(MODELS))
+    failing = {}
+    called = []
+    def create(**kwargs):
+        called.append(kwargs["model"])
+        if kwargs["model"] in failing:
+            raise failing[kwargs["model"]]
+        return answer(kwargs["model"])
+    api = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(everglen_llm, "client", SimpleNamespace(with_options=lambda **kwargs: api))
+    return SimpleNamespace(router=router, failing=failing, called=called)
+
+def title(**kwargs):
+    completion = everglen_llm.chat_completion(task="title", cache=False, max_retries=0, messages=[{"role": "user", "content": "Name it"}], **kwargs)
+    return completion.choices[0].message.content
+
+def test_task_fills_in_its_settings_and_models_can_be_overridden(monkeypatch):
+    assert task_settings("location")["max_tokens"] == 32
+    monkeypatch.setenv("LLM_MODELS_LOCATION", "a, b")
+    assert task_settings("location")["models"] == ["a", "b"]
+    with pytest.raises(ValueError):
+        task_settings("poetry")
+
+def test_failing_model_falls_back_and_leaves_rotation(groq_models):
+    groq_models.failing["first"] = groq_error(groq.InternalServerError, 500)
+    for _ in range(CIRCUIT_FAILURES):
+        assert title() == "from second"
+    assert groq_models.called == ["first", "second"] * CIRCUIT_FAILURES
+    # Out of rotation: tried last, not first
+    assert groq_models.router.route("title", MODELS) == ["second", "third", "first"]
+    assert title() == "from second"
+    assert groq_models.called[-1] == "second"
+
+def test_gone_model_is_disabled_straight_away(groq_models):
+    groq_models.failing["first"] = groq_error(groq.NotFoundError, 404, "model_decommissioned")
+    assert title() == "from second"
+    assert groq_models.router.route("title", MODELS)[-1] == "first"
+
+def test_client_errors_do_not_count_against_the_model(groq_models):
+    groq_models.failing["first"] = groq_error(groq.AuthenticationError, 401)
+    with pytest.raises(groq.AuthenticationError):
+        title()
+    assert groq_models.called == ["first"]
+    assert groq_models.router.route("title", MODELS) == MODELS
+
+def test_explicit_model_has_no_fallback(groq_models):
+    groq_models.failing["third"] = groq_error(groq.InternalServerError, 500)
+    with pytest.raises(groq.InternalServerError):
+        title(model="third")
+    assert groq_models.called == ["third"]
+
+def test_cooldown_doubles_and_success_resets_it(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(everglen_routing.time, "monotonic", lambda: now[0])
+    router = ModelRouter()
+    failures = [router.record_failure("first") for _ in range(CIRCUIT_FAILURES)]
+    assert failures == [0] * (CIRCUIT_FAILURES - 1) + [CIRCUIT_COOLDOWN_SECONDS]
+    now[0] += CIRCUIT_COOLDOWN_SECONDS + 1
+    assert router.route("title", MODELS) == MODELS
+    # Still failing after the cooldown: straight back out, for twice as long
+    assert router.record_failure("first") == CIRCUIT_COOLDOWN_SECONDS * 2
+    now[0] += CIRCUIT_COOLDOWN_SECONDS * 2 + 1
+    router.record_success("title", "first")
+    assert router.record_failure("first") == 0
+
+def test_much_slower_model_goes_after_the_others():
+    router = ModelRouter()
+    router.record_success("title", "first", 10.0)
+    router.record_success("title", "second", 1.0)
+    assert router.route("title", MODELS) == ["second", "third", "first"]
+    # Only for the task it was measured on
+    assert router.route("scene", MODELS) == MODELS
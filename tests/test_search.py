@@ -0,0 +1,53 @@
+import everglen_web
+from everglen_models import SeriesDB, StoryDB
+from everglen_search import fts_query
+
+def add_stories(*stories):
+    with everglen_web.app.app_context():
+        series = SeriesDB(series_name="Searchable", series_desc="stories to find")
+        everglen_web.db.session.add(series)
+        everglen_web.db.session.commit()
+        rows = [StoryDB(series_id=series.id, episode_number=number, location="Everglen", plot="plot", story_title=title, full_story=text)
+            for number, (title, text) in enumerate(stories, start=1)]
+        everglen_web.db.session.add_all(rows)
+        everglen_web.db.session.commit()
+        return [row.id for row in rows]
+
+def test_free_text_is_never_an_fts_syntax_error():
+    assert fts_query('rain "AND (boots') == '"rain" "AND" "boots"*'
+    assert fts_query("  ?! ") == ""
+    response = everglen_web.app.test_client().get('/api/search?q=%22NEAR(%20OR')
+    assert response.status_code == 200
+
+def test_title_matches_rank_first_and_snippets_are_escaped():
+    body_match, title_match = add_stories(
+        ("The Quiet Week", "Nobody mentioned the zeppelinfest until <b>Friday</b>."),
+        ("Zeppelinfest", "The fair came to town.")
+    )
+    found = everglen_web.app.test_client().get('/api/search?q=zeppelinfe').get_json()
+    assert [result['story_id'] for result in found['results']] == [title_match, body_match]
+    assert found['total'] == 2
+    assert "<mark>zeppelinfest</mark>" in found['results'][1]['snippet']
+    assert "&lt;b&gt;Friday&lt;/b&gt;" in found['results'][1]['snippet']
+
+def test_edits_are_searchable_and_results_page():
+    story_id, = add_stories(("Evening", "The lanterns went up over the marsh."))
+    with everglen_web.app.app_context():
+        everglen_web.db.session.get(StoryDB, story_id).full_story = "The kites went up over the marsh."
+        everglen_web.db.session.commit()
+    client = everglen_web.app.test_client()
+    assert client.get('/api/search?q=lanterns').get_json()['total'] == 0
+    assert [result['story_id'] for result in client.get('/api/search?q=kites').get_json()['results']] == [story_id]
+
+    add_stories(*[(f"Heron {number}", "herons everywhere") for number in range(3)])
+    first = client.get('/api/search?q=herons&limit=2').get_json()
+    second = client.get(f'/api/search?q=herons&limit=2&offset={first["next_offset"]}').get_json()
+    assert (len(first['results']), first['total'], first['next_offset']) == (2, 3, 2)
+    assert (len(second['results']), second['next_offset']) == (1, None)
+    assert client.get('/api/search?q=herons&type=planets').status_code == 400
+
+def test_characters_are_found_by_personality():
+    client = everglen_web.app.test_client()
+    client.post('/api/characters/add', data='name=Rue&age=16&gender=f&personality=an unflappable chess prodigy&high_school_clique=n&current_job=none&additional_desc=none&cultural_background=none')
+    results = client.get('/api/search?q=unflappable&type=characters').get_json()['results']
+    assert [result['character_name'] for result in results] == ["Rue"]
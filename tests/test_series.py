@@ -0,0 +1,45 @@
+import everglen_web
+from everglen_models import StoryDB
+
+def add_series(client, name, episodes=0):
+    series_id = client.post('/api/series/add', data=f'series_name={name}&series_desc=about {name}').get_json()['series_id']
+    with everglen_web.app.app_context():
+        for number in range(1, episodes + 1):
+            everglen_web.db.session.add(StoryDB(story_title=f"{name} {number}", episode_number=number, location="the pier",
+                plot=f"plot of {name} {number}", full_story=f"text of {name} {number}", series_id=series_id))
+        everglen_web.db.session.commit()
+    return series_id
+
+def all_pages(client, query=''):
+    pages = [client.get(f'/api/series/page?limit=2{query}').get_json()]
+    while pages[-1]['next_cursor'] is not None:
+        pages.append(client.get(f'/api/series/page?limit=2&cursor={pages[-1]["next_cursor"]}{query}').get_json())
+    return pages
+
+def test_pages_cover_every_series_once_in_order():
+    client = everglen_web.app.test_client()
+    added = [add_series(client, name, episodes=2) for name in ("Gull", "Heron", "Ibis")]
+    pages = all_pages(client)
+    assert all(len(page['series']) <= 2 for page in pages)
+    ids = [series['id'] for page in pages for series in page['series']]
+    assert ids == sorted(set(ids))
+    assert set(added) <= set(ids)
+
+def test_page_leaves_out_story_text_unless_asked():
+    client = everglen_web.app.test_client()
+    series_id = add_series(client, "Jay", episodes=2)
+    series = [row for page in all_pages(client) for row in page['series'] if row['id'] == series_id][0]
+    assert [story['story_title'] for story in series['stories']] == ["Jay 1", "Jay 2"]
+    assert set(series['stories'][0]) == {'id', 'story_title', 'episode_number', 'location'}
+
+    series = [row for page in all_pages(client, '&fields=id,full_story') for row in page['series'] if row['id'] == series_id][0]
+    assert series['stories'][1] == {'id': series['stories'][1]['id'], 'full_story': "text of Jay 2"}
+    assert client.get(f'/api/stories/view/{series["stories"][1]["id"]}').get_json()['full_story'] == "text of Jay 2"
+    assert client.get('/api/series/page?fields=id,password').status_code == 400
+
+def test_list_has_every_series_but_only_its_name():
+    client = everglen_web.app.test_client()
+    added = [add_series(client, name, episodes=1) for name in ("Kite", "Lark", "Moa")]
+    series = client.get('/api/series/list').get_json()
+    assert set(added) <= {row['id'] for row in series}
+    assert all(set(row) == {'id', 'series_name'} for row in series)
@@ -0,0 +1,95 @@
+import everglen_web  # noqa: F401 (everglen_llm is imported through everglen_web)
+from everglen_llm import SingleFlight, shared_create
+from groq.types.chat import ChatCompletion
+import everglen_llm
+import pytest
+import threading
+import time
+
+def answer(content):
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "test-model",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+    })
+
+def run_together(count, function):
+    results = [None] * count
+    def run(index):
+        try:
+            results[index] = function()
+        except Exception as e:
+            results[index] = e
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+def test_callers_in_flight_share_one_call():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+    threads, results = run_together(5, lambda: flights.run("key", call))
+    # Give every caller time to find the call in flight
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert sorted(results, key=lambda result: result[1]) == [("result", False)] + [("result", True)] * 4
+    # Nothing is kept once the call is done
+    assert flights.run("key", lambda: "again") == ("again", False)
+
+def test_callers_in_flight_share_the_error():
+    flights = SingleFlight()
+    release = threading.Event()
+    def call():
+        release.wait(5)
+        raise RuntimeError("Groq is down")
+    threads, results = run_together(3, lambda: flights.run("key", call))
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert [str(result) for result in results] == ["Groq is down"] * 3
+
+def test_identical_completions_reach_groq_once(monkeypatch):
+    release = threading.Event()
+    calls = []
+    def scheduled_create(priority, max_retries, task, rate_limit_retries, **kwargs):
+        calls.append(kwargs["model"])
+        release.wait(5)
+        return answer("A title")
+    monkeypatch.setattr(everglen_llm, "scheduled_create", scheduled_create)
+    complete = lambda: everglen_llm.chat_completion(task="title", model="test-model", cache=False, messages=[{"role": "user", "content": "Name the coalesced story"}])
+    threads, results = run_together(4, complete)
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == ["test-model"]
+    assert [result.choices[0].message.content for result in results] == ["A title"] * 4
+
+@pytest.mark.skipif(everglen_llm.fcntl is None, reason="needs fcntl")
+def test_process_waiting_on_the_lock_takes_the_stored_result(monkeypatch, tmp_path):
+    monkeypatch.setattr(everglen_llm, "SINGLE_FLIGHT_LOCK_DIR", str(tmp_path))
+    holding = threading.Event()
+    release = threading.Event()
+    def create():
+        holding.set()
+        release.wait(5)
+        return answer("made once")
+    # Each open() of the lock file locks on its own, like another process would
+    threads, results = run_together(1, lambda: shared_create("shared-key", create))
+    holding.wait(5)
+    waiting, waited = run_together(1, lambda: shared_create("shared-key", lambda: answer("made twice")))
+    time.sleep(0.2)
+    release.set()
+    for thread in threads + waiting:
+        thread.join()
+    assert results[0].choices[0].message.content == "made once"
+    assert waited[0].choices[0].message.content == "made once"
+    assert shared_create("shared-key", lambda: answer("made later")).choices[0].message.content == "made later"
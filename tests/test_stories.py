@@ -0,0 +1,65 @@
+import everglen_web
+import everglen_api_v2
+from everglen_models import StoryPlot, Scene
+import groq
+import httpx
+import pytest
+import threading
+import time
+
+GENERATE = 'location=Harbor&summary=A storm&series[id]=1&characters[0][id]=1'
+PLOT = StoryPlot(title="Storm", plot="A storm hits the harbor.", scenes=[Scene(title="Dawn", summary="Boats go out."), Scene(title="Dusk", summary="Boats come back.")])
+
+def groq_error(**kwargs):
+    raise groq.InternalServerError("Internal Server Error", response=httpx.Response(500, request=httpx.Request("POST", "http://groq")), body=None)
+
+@pytest.fixture
+def failing_scenes(monkeypatch):
+    monkeypatch.setattr(everglen_web, "generate_story", lambda **kwargs: PLOT)
+    monkeypatch.setattr(everglen_api_v2, "generate_story", lambda **kwargs: PLOT)
+    monkeypatch.setattr(everglen_web, "chat_completion", groq_error)
+
+def test_failed_scene_is_a_bad_gateway(failing_scenes):
+    response = everglen_web.app.test_client().post('/api/stories/generate', data=GENERATE)
+    assert response.status_code == 502
+    assert response.get_json()['message'] == 'GENERATION_FAILED'
+
+def test_failed_scene_is_a_bad_gateway_in_v2(failing_scenes):
+    response = everglen_web.app.test_client().post('/api/v2/stories/generate', json={"location": "Harbor", "summary": "A storm", "series_id": 1, "character_ids": []})
+    assert response.status_code == 502
+    assert response.get_json()['message'] == 'GENERATION_FAILED'
+
+def test_failed_single_scene_raises(monkeypatch):
+    monkeypatch.setattr(everglen_web, "chat_completion", groq_error)
+    with pytest.raises(everglen_web.GenerationError) as failed:
+        everglen_web.expand_plot_to_story("A storm hits the harbor.")
+    assert failed.value.stage == "scene 1"
+
+def test_failed_humanize_is_a_bad_gateway(monkeypatch):
+    monkeypatch.setattr(everglen_web, "chat_completion", groq_error)
+    client = everglen_web.app.test_client()
+    response = client.post('/api/stories/humanize', data='original_story=The tide came in.&story_characters[0][id]=1')
+    assert response.status_code == 502
+    assert response.get_json()['message'] == 'HUMANIZE_FAILED'
+    response = client.post('/api/v2/stories/humanize', json={"original_story": "The tide came in.", "character_ids": []})
+    assert response.status_code == 502
+    assert response.get_json()['message'] == 'HUMANIZE_FAILED'
+
+def test_failed_summary_raises(monkeypatch):
+    monkeypatch.setattr(everglen_web, "chat_completion", groq_error)
+    with pytest.raises(everglen_web.GenerationError) as failed:
+        everglen_web.summary_and_location_generator("The tide came in.")
+    assert failed.value.stage == "summary and location"
+
+def test_scenes_are_expanded_side_by_side_and_joined_in_order(monkeypatch):
+    # Both scene calls have to be in flight at once to get past the barrier
+    barrier = threading.Barrier(2, timeout=5)
+    def generate_detailed_scene(day, summary, language="English", story_plot=None):
+        barrier.wait()
+        if day == "Dawn":
+            time.sleep(0.1)
+        return f"{day}: {summary} ({story_plot})"
+    monkeypatch.setattr(everglen_web, "generate_detailed_scene", generate_detailed_scene)
+    scenes = everglen_web.plot_scenes(PLOT)
+    story = everglen_web.expand_plot_to_story(PLOT.plot, scenes=scenes)
+    assert story == "Dawn: Boats go out. (A storm hits the harbor.)\n\nDusk: Boats come back. (A storm hits the harbor.)"
@@ -0,0 +1,37 @@
+import everglen_web
+from everglen_models import StoryPlot
+import json
+
+GENERATE = 'location=Harbor&summary=A storm&series[id]=1&characters[0][id]=1'
+
+def read_events(response):
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        if block:
+            event, data = block.split("\n")
+            events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+def test_sse_event_framing():
+    assert everglen_web.sse_event("token", {"text": "a\nb"}) == 'event: token\ndata: {"text": "a\\nb"}\n\n'
+
+def test_single_scene_is_streamed_token_by_token(monkeypatch):
+    monkeypatch.setattr(everglen_web, "generate_story", lambda **kwargs: StoryPlot(title="Storm", plot="A storm hits the harbor."))
+    monkeypatch.setattr(everglen_web, "generate_detailed_scene_stream", lambda day, summary, language="English": iter(["The ", "wind ", "rose."]))
+    response = everglen_web.app.test_client().post('/api/stories/generate/stream', data=GENERATE)
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert response.headers['X-Accel-Buffering'] == 'no'
+    events = read_events(response)
+    assert [event for event, _ in events] == ["status", "plot", "status", "token", "token", "token", "done"]
+    assert events[0][1] == {"stage": "plot"}
+    assert "".join(data["text"] for event, data in events if event == "token") == "The wind rose."
+    assert events[-1][1]["story"] == "The wind rose."
+    assert events[-1][1]["story_title"] == "Storm"
+
+def test_failure_ends_the_stream_with_an_error_event(monkeypatch):
+    def generate_story(**kwargs):
+        raise RuntimeError("plot call failed")
+    monkeypatch.setattr(everglen_web, "generate_story", generate_story)
+    events = read_events(everglen_web.app.test_client().post('/api/stories/generate/stream', data=GENERATE))
+    assert events == [("status", {"stage": "plot"}), ("error", {"error": "plot call failed"})]
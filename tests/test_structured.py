@@ -0,0 +1,113 @@
+import everglen_web  # noqa: F401 (everglen_structured is imported through everglen_web)
+import everglen_structured
+from everglen_structured import check_output, repair_targets, repair_request, apply_repair, structured_completion, StructuredOutputError
+from everglen_models import ExtractedCharacters, StoryPlot
+from types import SimpleNamespace
+import json
+import pytest
+
+MAYA = {"name": "Maya", "age": 16, "gender": "female", "personality": "bold"}
+JONAH = {"name": "Jonah", "age": 17, "gender": "male", "personality": "calm"}
+
+def answer(document):
+    return json.dumps(document)
+
+def completion(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+def test_broken_list_item_is_repaired_alone():
+    content = answer({"characters": [MAYA, {**JONAH, "age": "seventeen"}]})
+    output, problem = check_output(ExtractedCharacters, content)
+    assert output is None
+    assert repair_targets(problem[0], problem[1]) == ["characters.1"]
+
+    repair_kwargs, fields = repair_request(ExtractedCharacters, content, problem, {"task": "extraction", "max_tokens": 4000})
+    assert fields == ["characters.1"]
+    assert repair_kwargs["task"] == "repair"
+    assert repair_kwargs["max_tokens"] < 4000
+    # Only the broken item is sent as a current value
+    assert "Maya" not in repair_kwargs["messages"][1]["content"].split("Rest of the object")[0]
+
+    output, problem = apply_repair(ExtractedCharacters, problem, fields, answer({"characters.1": JONAH}))
+    assert problem is None
+    assert [character.name for character in output.characters] == ["Maya", "Jonah"]
+    assert output.characters[1].age == 17
+
+def test_whole_field_covers_its_items():
+    document = {"title": None, "plot": "A storm", "scenes": [{"title": "Dawn"}]}
+    output, problem = check_output(StoryPlot, answer(document))
+    assert repair_targets(document, problem[1] + [{"field": "scenes", "error": "Input should be a valid list"}]) == ["scenes", "title"]
+
+def test_repair_leaves_the_original_answer_alone():
+    content = answer({"characters": [MAYA, {**JONAH, "age": None}]})
+    _, problem = check_output(ExtractedCharacters, content)
+    original = json.loads(json.dumps(problem[0]))
+    apply_repair(ExtractedCharacters, problem, ["characters.1"], answer({"characters.1": JONAH}))
+    assert problem[0] == original
+
+def test_answer_that_is_not_json_is_rewritten_whole():
+    _, problem = check_output(ExtractedCharacters, "Here are the characters: Maya and Jonah")
+    repair_kwargs, fields = repair_request(ExtractedCharacters, "Here are the characters", problem, {"task": "extraction", "max_tokens": 4000})
+    assert fields is None
+    assert repair_kwargs["max_tokens"] == 4000
+    output, problem = apply_repair(ExtractedCharacters, problem, fields, answer({"characters": [MAYA]}))
+    assert output.characters[0].name == "Maya"
+
+def test_structured_completion_merges_the_repair(monkeypatch):
+    answers = iter([answer({"characters": [MAYA, {**JONAH, "personality": None}]}), answer({"characters.1": JONAH})])
+    tasks = []
+
+    def chat_completion(**kwargs):
+        tasks.append(kwargs["task"])
+        return completion(next(answers))
+
+    monkeypatch.setattr(everglen_structured, "chat_completion", chat_completion)
+    output = structured_completion(ExtractedCharacters, task="extraction", messages=[{"role": "user", "content": "Story"}])
+    assert tasks == ["extraction", "repair"]
+    assert output.characters[1].personality == "calm"
+
+def test_unrepaired_answer_raises(monkeypatch):
+    broken = answer({"characters": [{**MAYA, "age": "old"}]})
+    monkeypatch.setattr(everglen_structured, "chat_completion", lambda **kwargs: completion(broken if kwargs["task"] == "extraction" else "{}"))
+    with pytest.raises(StructuredOutputError) as failed:
+        structured_completion(ExtractedCharacters, task="extraction", messages=[{"role": "user", "content": "Story"}])
+    assert failed.value.errors[0]["field"] == "characters.0.age"
+
+def test_invalid_answer_is_not_replayed_from_the_cache(monkeypatch):
+    import everglen_llm
+    from groq.types.chat import ChatCompletion
+    tasks = []
+
+    def scheduled_create(priority, max_retries, task, rate_limit_retries, **kwargs):
+        tasks.append(task)
+        return ChatCompletion.model_validate({
+            "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": kwargs["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": '{"characters": [{"name": "Maya"'}}],
+        })
+
+    monkeypatch.setattr(everglen_llm, "scheduled_create", scheduled_create)
+    client = everglen_web.app.test_client()
+    story = 'story=Maya met Jonah at the harbor on a day nobody else remembers'
+    assert client.post('/api/characters/scan', data=story).status_code == 502
+    assert tasks == ["extraction", "repair"]
+    assert client.post('/api/characters/scan', data=story).status_code == 502
+    assert tasks == ["extraction", "repair"] * 2
+
+def test_valid_answer_is_cached(monkeypatch):
+    import everglen_llm
+    from groq.types.chat import ChatCompletion
+    tasks = []
+
+    def scheduled_create(priority, max_retries, task, rate_limit_retries, **kwargs):
+        tasks.append(task)
+        return ChatCompletion.model_validate({
+            "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": kwargs["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": answer({"characters": [MAYA]})}}],
+        })
+
+    monkeypatch.setattr(everglen_llm, "scheduled_create", scheduled_create)
+    client = everglen_web.app.test_client()
+    story = 'story=Maya sailed out alone before the storm broke'
+    assert client.post('/api/characters/scan', data=story).status_code == 200
+    assert client.post('/api/characters/scan', data=story).status_code == 200
+    assert tasks == ["extraction"]